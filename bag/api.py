@@ -0,0 +1,188 @@
+import json
+
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
+
+from products.models import Product
+from .bag import Bag
+from .contexts import get_bag_contents
+
+
+def _bag_response(request, message=None):
+    """
+    Return the bag's totals and lines after a change,
+    so the page can update itself without reloading
+    """
+    current_bag = get_bag_contents(request, refresh=True)
+    lines = [{
+        'item_id': item['item_id'],
+        'size': item.get('size'),
+        'quantity': item['quantity'],
+        'name': item['product'].name,
+        'price': f'{item["product"].price:.2f}',
+        'subtotal': f'{item["product"].price * item["quantity"]:.2f}',
+    } for item in current_bag['bag_items']]
+
+    return JsonResponse({
+        'message': message,
+        'bag': {
+            'lines': lines,
+            'product_count': current_bag['product_count'],
+            'total': f'{current_bag["total"]:.2f}',
+            'delivery': f'{current_bag["delivery"]:.2f}',
+            'free_delivery_delta': f'{current_bag["free_delivery_delta"]:.2f}',
+            'grand_total': f'{current_bag["grand_total"]:.2f}',
+        },
+    })
+
+
+def _error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def _product(item_id):
+    """ The product, or None for an unknown or malformed id """
+    try:
+        return Product.objects.get(pk=item_id)
+    except (Product.DoesNotExist, ValueError):
+        return None
+
+
+def _quantity(value):
+    quantity = int(value)
+    if not 0 <= quantity <= 99:
+        raise ValueError(quantity)
+    return quantity
+
+
+def _size(product, value):
+    """ Products with sizes need one of Product.SIZES, others none """
+    size = value or None
+    if size not in (Product.SIZES if product.has_sizes else (None,)):
+        raise ValueError(size)
+    return size
+
+
+def _size_error(product):
+    if product.has_sizes:
+        sizes = ', '.join(size.upper() for size in Product.SIZES)
+        return _error(f'Please choose a size for {product.name}: {sizes}.')
+    return _error(f'{product.name} doesn\'t come in sizes.')
+
+
+def _label(product, size):
+    return f'size {size.upper()} {product.name}' if size else product.name
+
+
+@require_POST
+def add_to_bag(request, item_id):
+    """ Add a quantity of the specified product to the bag """
+    product = _product(item_id)
+    if product is None:
+        return _error('Unknown product', status=404)
+    try:
+        quantity = _quantity(request.POST.get('quantity'))
+        if not quantity:
+            raise ValueError(quantity)
+    except (TypeError, ValueError):
+        return _error('Please enter a quantity between 1 and 99.')
+    try:
+        size = _size(product, request.POST.get('product_size'))
+    except ValueError:
+        return _size_error(product)
+
+    bag = Bag.from_session(request.session)
+    already_in_bag = bag.quantity(item_id, size)
+    new_quantity = bag.add(item_id, quantity, size)
+    bag.save(request.session)
+
+    if already_in_bag:
+        message = f'Updated {_label(product, size)} quantity to {new_quantity}'
+    else:
+        message = f'Added {_label(product, size)} to your bag'
+    return _bag_response(request, message)
+
+
+@require_POST
+def adjust_bag(request, item_id):
+    """ Set the quantity of the specified product, removing it at 0 """
+    product = _product(item_id)
+    if product is None:
+        return _error('Unknown product', status=404)
+    try:
+        quantity = _quantity(request.POST.get('quantity'))
+    except (TypeError, ValueError):
+        return _error('Please enter a quantity between 0 and 99.')
+    size = request.POST.get('product_size') or None
+    if quantity:
+        # this can add the line, so it needs a size the product comes in
+        try:
+            _size(product, size)
+        except ValueError:
+            return _size_error(product)
+
+    bag = Bag.from_session(request.session)
+    try:
+        bag.adjust(item_id, quantity, size)
+    except KeyError:
+        return _error(f'{_label(product, size)} is not in your bag', status=404)
+    bag.save(request.session)
+
+    if quantity > 0:
+        message = f'Updated {_label(product, size)} quantity to {quantity}'
+    else:
+        message = f'Removed {_label(product, size)} from your bag'
+    return _bag_response(request, message)
+
+
+@require_POST
+def remove_from_bag(request, item_id):
+    """ Remove the specified product from the bag """
+    product = _product(item_id)
+    if product is None:
+        return _error('Unknown product', status=404)
+    size = request.POST.get('product_size') or None
+
+    bag = Bag.from_session(request.session)
+    try:
+        bag.remove(item_id, size)
+    except KeyError:
+        return _error(f'{_label(product, size)} is not in your bag', status=404)
+    bag.save(request.session)
+
+    return _bag_response(request, f'Removed {_label(product, size)} from your bag')
+
+
+@require_POST
+def update_bag(request):
+    """
+    Set the quantities of several bag lines at once from a JSON body:
+    {"lines": [{"item_id": "1", "size": null, "quantity": 2}, ...]}
+    """
+    try:
+        lines = [
+            (str(line['item_id']), line.get('size') or None, _quantity(line['quantity']))
+            for line in json.loads(request.body)['lines']
+        ]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return _error('Expected {"lines": [{"item_id", "size", "quantity"}, ...]}')
+
+    item_ids = {item_id for item_id, size, quantity in lines}
+    if not all(item_id.isdigit() for item_id in item_ids):
+        return _error('Unknown product', status=404)
+    products = Product.objects.in_bulk(item_ids)
+    if len(products) != len(item_ids):
+        return _error('Unknown product', status=404)
+    for item_id, size, quantity in lines:
+        try:
+            _size(products[int(item_id)], size)
+        except ValueError:
+            return _size_error(products[int(item_id)])
+
+    bag = Bag.from_session(request.session)
+    for item_id, size, quantity in lines:
+        if quantity or bag.quantity(item_id, size):
+            bag.adjust(item_id, quantity, size)
+    bag.save(request.session)
+
+    return _bag_response(request, 'Updated your bag')
@@ -0,0 +1,120 @@
+import json
+
+
+class BagLine:
+    """ A quantity of one product, in one size, in the bag """
+
+    __slots__ = ('item_id', 'size', 'quantity')
+
+    def __init__(self, item_id, quantity, size=None):
+        self.item_id = str(item_id)
+        self.size = size or None
+        self.quantity = quantity
+
+    def __repr__(self):
+        return f'BagLine({self.item_id!r}, {self.quantity!r}, size={self.size!r})'
+
+
+class Bag:
+    """
+    The shopping bag kept in the session.
+
+    Lines are keyed on (item_id, size) so adding, adjusting and removing
+    are all O(1). The bag is stored as a compact versioned list of
+    [item_id, size, quantity] triples, and bags saved in the old
+    {item_id: quantity or {'items_by_size': {...}}} format can still be read.
+    """
+
+    SESSION_KEY = 'bag'
+    VERSION = 2
+
+    __slots__ = ('_lines',)
+
+    def __init__(self, data=None):
+        self._lines = {}
+        if data:
+            self._load(data)
+
+    @classmethod
+    def from_session(cls, session):
+        return cls(session.get(cls.SESSION_KEY))
+
+    @classmethod
+    def loads(cls, text):
+        """ Read a bag serialized with dumps, in either format """
+        return cls(json.loads(text) if text else None)
+
+    def _load(self, data):
+        if 'v' in data:
+            for item_id, size, quantity in data['lines']:
+                self._set(item_id, quantity, size)
+            return
+
+        for item_id, item_data in data.items():
+            if isinstance(item_data, int):
+                self._set(item_id, item_data)
+            else:
+                for size, quantity in item_data['items_by_size'].items():
+                    self._set(item_id, quantity, size)
+
+    def serialize(self):
+        return {
+            'v': self.VERSION,
+            'lines': [[line.item_id, line.size, line.quantity] for line in self],
+        }
+
+    def dumps(self):
+        return json.dumps(self.serialize(), separators=(',', ':'))
+
+    def save(self, session):
+        """ Store the bag, leaving the session unmodified if nothing changed """
+        data = self.serialize()
+        if session.get(self.SESSION_KEY) != data:
+            session[self.SESSION_KEY] = data
+
+    def _set(self, item_id, quantity, size=None):
+        line = BagLine(item_id, quantity, size)
+        self._lines[(line.item_id, line.size)] = line
+        return line
+
+    def quantity(self, item_id, size=None):
+        """ The quantity of a product and size in the bag, or 0 """
+        line = self._lines.get((str(item_id), size or None))
+        return line.quantity if line else 0
+
+    def add(self, item_id, quantity, size=None):
+        """ Add to a product's quantity and return the new quantity """
+        line = self._lines.get((str(item_id), size or None))
+        if line:
+            line.quantity += quantity
+        else:
+            line = self._set(item_id, quantity, size)
+        return line.quantity
+
+    def adjust(self, item_id, quantity, size=None):
+        """ Set a product's quantity, removing it if the quantity is 0 """
+        if quantity > 0:
+            self._set(item_id, quantity, size)
+        else:
+            self.remove(item_id, size)
+
+    def remove(self, item_id, size=None):
+        """ Remove a product (in a size) from the bag; KeyError if absent """
+        del self._lines[(str(item_id), size or None)]
+
+    def product_ids(self):
+        """ The distinct product ids in the bag, in the order added """
+        return list(dict.fromkeys(line.item_id for line in self))
+
+    @property
+    def count(self):
+        return sum(line.quantity for line in self)
+
+    def __iter__(self):
+        return iter(list(self._lines.values()))
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __bool__(self):
+        return bool(self._lines)
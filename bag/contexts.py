@@ -1,36 +1,83 @@
 from decimal import Decimal
 from django.conf import settings
-from django.shortcuts import get_object_or_404
+from boutique_ado import metrics
+from boutique_ado.async_utils import run_in_thread
 from products.models import Product
+from .bag import Bag
+
+BAG_CONTEXT_KEYS = (
+    'bag_items',
+    'total',
+    'product_count',
+    'delivery',
+    'free_delivery_delta',
+    'grand_total',
+)
+
+
+def get_bag_contents(request, refresh=False):
+    """
+    Work out the bag contents, at most once per request
+    unless the bag has been changed since
+    """
+    if refresh or not hasattr(request, '_bag_contents'):
+        with metrics.section('bag_contents'):
+            request._bag_contents = _calculate_bag_contents(request)
+    return request._bag_contents
+
+
+async def get_bag_contents_async(request, refresh=False):
+    """
+    get_bag_contents for async views. Working it out before rendering
+    means the bag_contents context processor finds it already done
+    """
+    if refresh or not hasattr(request, '_bag_contents'):
+        await run_in_thread(get_bag_contents, request, refresh)
+    return request._bag_contents
+
 
 def bag_contents(request):
+    """
+    Context processor exposing the bag to every template.
+
+    Each value is a callable the template engine only calls when a
+    template actually uses it, so pages that never show the bag
+    don't pay for the product lookups or the totals.
+    """
+    def lazy(key):
+        return lambda: get_bag_contents(request)[key]
+
+    context = {key: lazy(key) for key in BAG_CONTEXT_KEYS}
+    context['free_delivery_threshold'] = settings.FREE_DELIVERY_THRESHOLD
+    return context
+
+
+def _calculate_bag_contents(request):
 
     bag_items = []
     total = 0
     product_count = 0
-    bag = request.session.get('bag', {})
-
-    for item_id, item_data in bag.items():
-        if isinstance(item_data, int):
-            product = get_object_or_404(Product, pk=item_id)
-            total += item_data * product.price
-            product_count += item_data
-            bag_items.append({
-                'item_id': item_id,
-                'quantity': item_data,
-                'product': product,
-            })
-        else:
-            product = get_object_or_404(Product, pk=item_id)
-            for size, quantity in item_data['items_by_size'].items():
-                total += quantity * product.price
-                product_count += quantity
-                bag_items.append({
-                    'item_id': item_id,
-                    'quantity': quantity,
-                    'product': product,
-                    'size': size,
-                })
+    bag = Bag.from_session(request.session)
+
+    # fetch every product in the bag in one query rather than one per item
+    item_ids = [item_id for item_id in bag.product_ids() if item_id.isdigit()]
+    products = Product.objects.select_related('category').in_bulk(item_ids)
+
+    for line in bag:
+        product = products.get(int(line.item_id)) if line.item_id.isdigit() else None
+        if product is None:
+            # the product has been deleted since it was added to the bag
+            continue
+        total += line.quantity * product.price
+        product_count += line.quantity
+        item = {
+            'item_id': line.item_id,
+            'quantity': line.quantity,
+            'product': product,
+        }
+        if line.size:
+            item['size'] = line.size
+        bag_items.append(item)
 
     if total < settings.FREE_DELIVERY_THRESHOLD:
         delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
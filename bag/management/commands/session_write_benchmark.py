@@ -0,0 +1,77 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from products.models import Product
+
+CONFIGURATIONS = (
+    ('db sessions, session messages', {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        'MESSAGE_STORAGE': 'django.contrib.messages.storage.session.SessionStorage',
+    }),
+    ('cached_db sessions, fallback messages', {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db',
+        'MESSAGE_STORAGE': 'django.contrib.messages.storage.fallback.FallbackStorage',
+    }),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Count django_session reads and writes for a run of add to bag '
+        'requests under the old and new session and message backends'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50)
+
+    def _run(self, product, requests):
+        """
+        Add to the bag and load the page showing the toast,
+        counting the session queries each interaction makes
+        """
+        client = Client(HTTP_HOST='localhost')
+        counts = {'reads': 0, 'writes': 0}
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(requests):
+                client.post(f'/bag/add/{product.pk}/', {
+                    'quantity': 1,
+                    'redirect_url': '/bag/',
+                })
+                client.get('/bag/')
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if 'django_session' not in sql:
+                continue
+            if sql.startswith('SELECT'):
+                counts['reads'] += 1
+            else:
+                counts['writes'] += 1
+        return counts
+
+    def handle(self, *args, **options):
+        product = Product.objects.first()
+        if product is None:
+            raise CommandError('Load some products before running the benchmark')
+
+        requests = options['requests']
+        results = []
+        try:
+            with transaction.atomic():
+                for name, config in CONFIGURATIONS:
+                    with override_settings(**config):
+                        results.append((name, self._run(product, requests)))
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(f'{requests} x (add to bag + view bag)')
+        for name, counts in results:
+            self.stdout.write(
+                f'{name:<40} session reads/interaction: {counts["reads"] / requests:.2f}  '
+                f'session writes/interaction: {counts["writes"] / requests:.2f}')
@@ -0,0 +1,75 @@
+/*
+    Progressive enhancement for the shopping bag.
+
+    bagApi.add/adjust/remove/update post to the JSON bag endpoints and
+    resolve with the updated bag, so a bag change is one light request
+    instead of a POST, a redirect and a full page render. Every update
+    refreshes the bag totals on the page and fires a "bag:updated" event.
+    If the request fails the promise rejects and callers fall back to
+    the plain form behaviour.
+*/
+var bagApi = (function() {
+    function csrfToken() {
+        var input = $('input[name="csrfmiddlewaretoken"]').filter(function() {
+            return this.value;
+        }).first();
+        if (input.length) {
+            return input.val();
+        }
+        var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+        return match ? decodeURIComponent(match[1]) : '';
+    }
+
+    function post(url, data, json) {
+        return $.ajax({
+            url: url,
+            method: 'POST',
+            headers: {'X-CSRFToken': csrfToken()},
+            contentType: json ? 'application/json' : 'application/x-www-form-urlencoded; charset=UTF-8',
+            data: json ? JSON.stringify(data) : data,
+            dataType: 'json',
+        }).then(function(response) {
+            render(response.bag);
+            $(document).trigger('bag:updated', [response.bag, response.message]);
+            return response;
+        });
+    }
+
+    function render(bag) {
+        $('[data-bag-value]').each(function() {
+            $(this).text(bag[$(this).data('bag-value')]);
+        });
+        $('[data-bag-free-delivery]').toggleClass('d-none', parseFloat(bag.free_delivery_delta) <= 0);
+        bag.lines.forEach(function(line) {
+            $(`[data-bag-line-subtotal="${line.item_id}_${line.size || ''}"]`).text(line.subtotal);
+        });
+        $('[data-bag-total]').each(function() {
+            var link = $(this);
+            var active = parseFloat(bag.grand_total) > 0;
+            link.toggleClass('text-black', !active).toggleClass(link.data('bag-active-class'), active);
+            link.find('p').text('$' + bag.grand_total);
+        });
+    }
+
+    function sized(data, size) {
+        if (size) {
+            data.product_size = size;
+        }
+        return data;
+    }
+
+    return {
+        add: function(itemId, quantity, size) {
+            return post(`/bag/api/add/${itemId}/`, sized({'quantity': quantity}, size));
+        },
+        adjust: function(itemId, quantity, size) {
+            return post(`/bag/api/adjust/${itemId}/`, sized({'quantity': quantity}, size));
+        },
+        remove: function(itemId, size) {
+            return post(`/bag/api/remove/${itemId}/`, sized({}, size));
+        },
+        update: function(lines) {
+            return post('/bag/api/update/', {'lines': lines}, true);
+        },
+    };
+})();
@@ -1,3 +1,290 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django.test import Client, TestCase, RequestFactory
+from django.urls import reverse
+
+from boutique_ado.testing import BAG_LINES, QueryBudgetTestCase
+
+from products.models import Category, Product
+from .bag import Bag
+from .contexts import bag_contents, get_bag_contents
+
+
+class BagTests(TestCase):
+
+    def test_reads_legacy_session_format(self):
+        bag = Bag({'1': 2, '7': {'items_by_size': {'s': 1, 'xl': 3}}})
+        self.assertEqual(bag.quantity('1'), 2)
+        self.assertEqual(bag.quantity(7, 'xl'), 3)
+        self.assertEqual(bag.product_ids(), ['1', '7'])
+        self.assertEqual(bag.count, 6)
+
+    def test_round_trips_through_compact_format(self):
+        bag = Bag()
+        bag.add('1', 2)
+        bag.add('7', 1, 's')
+        bag.add('7', 4, 's')
+        self.assertEqual(bag.serialize(), {'v': 2, 'lines': [['1', None, 2], ['7', 's', 5]]})
+        restored = Bag.loads(bag.dumps())
+        self.assertEqual(restored.serialize(), bag.serialize())
+
+    def test_adjust_and_remove(self):
+        bag = Bag()
+        bag.add('1', 2)
+        bag.add('7', 1, 's')
+        bag.adjust('1', 5)
+        bag.adjust('7', 0, 's')
+        self.assertEqual(bag.quantity('1'), 5)
+        self.assertEqual(len(bag), 1)
+        bag.remove('1')
+        self.assertFalse(bag)
+        with self.assertRaises(KeyError):
+            bag.remove('1')
+
+
+class BagContentsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.products = [
+            Product.objects.create(
+                category=category, name=f'Shirt {i}', description='A shirt',
+                price='10.00', has_sizes=i % 2 == 0)
+            for i in range(20)
+        ]
+
+    def _request(self, bag):
+        request = RequestFactory().get('/')
+        request.session = {'bag': bag}
+        return request
+
+    def _bag(self, products):
+        bag = {}
+        for product in products:
+            if product.has_sizes:
+                bag[str(product.id)] = {'items_by_size': {'s': 1, 'm': 2}}
+            else:
+                bag[str(product.id)] = 1
+        return bag
+
+    def test_query_count_does_not_grow_with_bag_size(self):
+        for size in (1, 5, 20):
+            request = self._request(self._bag(self.products[:size]))
+            with self.assertNumQueries(1):
+                context = get_bag_contents(request)
+                for item in context['bag_items']:
+                    item['product'].category.friendly_name
+
+    def test_empty_bag_runs_no_queries(self):
+        with self.assertNumQueries(0):
+            context = get_bag_contents(self._request({}))
+        self.assertEqual(context['bag_items'], [])
+        self.assertEqual(context['grand_total'], 0)
+
+    def test_deleted_product_is_skipped(self):
+        kept, deleted = self.products[1], self.products[3]
+        bag = self._bag([kept, deleted])
+        deleted.delete()
+        context = get_bag_contents(self._request(bag))
+        self.assertEqual([item['product'] for item in context['bag_items']], [kept])
+        self.assertEqual(context['product_count'], 1)
+
+    def test_context_processor_is_lazy(self):
+        request = self._request(self._bag(self.products[:5]))
+        with self.assertNumQueries(0):
+            context = bag_contents(request)
+        with self.assertNumQueries(1):
+            grand_total = context['grand_total']()
+            bag_items = context['bag_items']()
+        self.assertEqual(len(bag_items), 8)
+        self.assertEqual(grand_total, get_bag_contents(request)['grand_total'])
+
+
+class BagApiTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.shirt = Product.objects.create(
+            category=category, name='Shirt', description='', price='10.00', has_sizes=True)
+        cls.hat = Product.objects.create(
+            category=category, name='Hat', description='', price='5.50', has_sizes=False)
+
+    def post(self, name, item_id, data):
+        return self.client.post(reverse(name, args=[item_id]), data)
+
+    def update(self, body):
+        return self.client.post(reverse('api_update_bag'), body, content_type='application/json')
+
+    def session_bag(self):
+        return Bag.from_session(self.client.session).serialize()['lines']
+
+    def assertError(self, response, status, message):
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn(message, response.json()['error'])
+
+    def test_add_adjust_remove(self):
+        response = self.post('api_add_to_bag', self.shirt.pk, {'quantity': 2, 'product_size': 'm'})
+        self.assertEqual(response.json(), {
+            'message': 'Added size M Shirt to your bag',
+            'bag': {
+                'lines': [{
+                    'item_id': str(self.shirt.pk), 'size': 'm', 'quantity': 2,
+                    'name': 'Shirt', 'price': '10.00', 'subtotal': '20.00',
+                }],
+                'product_count': 2,
+                'total': '20.00',
+                'delivery': '2.00',
+                'free_delivery_delta': '30.00',
+                'grand_total': '22.00',
+            },
+        })
+
+        response = self.post('api_add_to_bag', self.hat.pk, {'quantity': 1})
+        self.assertEqual(response.json()['bag']['total'], '25.50')
+        response = self.post('api_add_to_bag', self.hat.pk, {'quantity': 2})
+        self.assertEqual(response.json()['message'], 'Updated Hat quantity to 3')
+        self.assertEqual(self.session_bag(), [[str(self.shirt.pk), 'm', 2], [str(self.hat.pk), None, 3]])
+
+        response = self.post('api_adjust_bag', self.shirt.pk, {'quantity': 0, 'product_size': 'm'})
+        self.assertEqual(response.json()['message'], 'Removed size M Shirt from your bag')
+        response = self.post('api_remove_from_bag', self.hat.pk, {})
+        self.assertEqual(response.json()['bag']['lines'], [])
+        self.assertEqual(self.session_bag(), [])
+
+    def test_unknown_products(self):
+        for name in ('api_add_to_bag', 'api_adjust_bag', 'api_remove_from_bag'):
+            for item_id in (self.hat.pk + 100, 'abc'):
+                with self.subTest(view=name, item_id=item_id):
+                    response = self.post(name, item_id, {'quantity': 1})
+                    self.assertError(response, 404, 'Unknown product')
+        self.assertError(self.update(json.dumps({'lines': [
+            {'item_id': self.hat.pk + 100, 'size': None, 'quantity': 1},
+        ]})), 404, 'Unknown product')
+
+    def test_lines_not_in_the_bag(self):
+        response = self.post('api_adjust_bag', self.hat.pk, {'quantity': 0})
+        self.assertError(response, 404, 'Hat is not in your bag')
+        response = self.post('api_remove_from_bag', self.shirt.pk, {'product_size': 's'})
+        self.assertError(response, 404, 'size S Shirt is not in your bag')
+
+    def test_bad_quantities(self):
+        for quantity in ('', 'two', '0', '-1', '100'):
+            with self.subTest(quantity=quantity):
+                response = self.post('api_add_to_bag', self.hat.pk, {'quantity': quantity})
+                self.assertError(response, 400, 'between 1 and 99')
+        response = self.post('api_adjust_bag', self.hat.pk, {'quantity': '100'})
+        self.assertError(response, 400, 'between 0 and 99')
+        self.assertEqual(self.session_bag(), [])
+
+    def test_bad_sizes(self):
+        for size in ('', 'xxl', 'M'):
+            with self.subTest(size=size):
+                response = self.post(
+                    'api_add_to_bag', self.shirt.pk, {'quantity': 1, 'product_size': size})
+                self.assertError(response, 400, 'Please choose a size for Shirt')
+        response = self.post('api_add_to_bag', self.hat.pk, {'quantity': 1, 'product_size': 's'})
+        self.assertError(response, 400, "Hat doesn't come in sizes")
+        response = self.post('api_adjust_bag', self.hat.pk, {'quantity': 1, 'product_size': 's'})
+        self.assertError(response, 400, "Hat doesn't come in sizes")
+        self.assertError(self.update(json.dumps({'lines': [
+            {'item_id': self.shirt.pk, 'size': None, 'quantity': 1},
+        ]})), 400, 'Please choose a size for Shirt')
+        self.assertEqual(self.session_bag(), [])
+
+    def test_update(self):
+        self.post('api_add_to_bag', self.hat.pk, {'quantity': 4})
+        response = self.update(json.dumps({'lines': [
+            {'item_id': self.shirt.pk, 'size': 'l', 'quantity': 3},
+            {'item_id': str(self.hat.pk), 'quantity': 0},
+        ]}))
+        self.assertEqual(response.json()['message'], 'Updated your bag')
+        self.assertEqual(response.json()['bag']['product_count'], 3)
+        self.assertEqual(self.session_bag(), [[str(self.shirt.pk), 'l', 3]])
+
+    def test_malformed_updates(self):
+        self.post('api_add_to_bag', self.hat.pk, {'quantity': 1})
+        for body in ('nope', '[]', '{}', '{"lines": "x"}', '{"lines": [1]}',
+                     json.dumps({'lines': [{'item_id': self.hat.pk}]}),
+                     json.dumps({'lines': [{'item_id': self.hat.pk, 'quantity': -1}]})):
+            with self.subTest(body=body):
+                self.assertError(self.update(body), 400, 'Expected {"lines"')
+        self.assertEqual(self.session_bag(), [[str(self.hat.pk), None, 1]])
+
+
+class BagSummaryTests(TestCase):
+
+    def setUp(self):
+        self.shirt = Product.objects.create(name='Shirt', description='', price='10.00')
+        self.client = Client(enforce_csrf_checks=True)
+
+    def test_empty_bag(self):
+        summary = self.client.get(reverse('bag_summary')).json()
+        self.assertIsNone(summary['grand_total'])
+        self.assertEqual(summary['product_count'], 0)
+        self.assertTrue(summary['csrf_token'])
+
+    def test_total_messages_and_token(self):
+        # a page cached for every visitor has no token, so the form uses the summary's
+        token = self.client.get(reverse('bag_summary')).json()['csrf_token']
+        response = self.client.post(reverse('add_to_bag', args=[self.shirt.pk]), {
+            'quantity': 2, 'redirect_url': reverse('products'), 'csrfmiddlewaretoken': token})
+        self.assertEqual(response.status_code, 302)
+
+        summary = self.client.get(reverse('bag_summary')).json()
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        self.assertEqual(summary['grand_total'], f'{get_bag_contents(request)["grand_total"]:.2f}')
+        self.assertEqual(summary['product_count'], 2)
+        self.assertIn('Added Shirt to your bag', summary['messages'])
+        # and each message is only shown once
+        self.assertNotIn('Added Shirt', self.client.get(reverse('bag_summary')).json()['messages'])
+
+
+class BagQueryBudgetTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.login()
+        self.fill_bag()
+        self.product = self.products[BAG_LINES]
+
+    def test_view_bag(self):
+        self.assertQueryBudget(2, reverse('view_bag'), status=200)
+
+    def test_bag_summary(self):
+        self.assertQueryBudget(1, reverse('bag_summary'), status=200)
+
+    def test_add_adjust_remove(self):
+        item_id = self.product.pk
+        self.assertQueryBudget(4, reverse('add_to_bag', args=[item_id]), {
+            'quantity': 1, 'product_size': 'm', 'redirect_url': reverse('view_bag'),
+        }, method='post', status=302)
+        self.assertQueryBudget(4, reverse('adjust_bag', args=[item_id]), {
+            'quantity': 3, 'product_size': 'm',
+        }, method='post', status=302)
+        self.assertQueryBudget(4, reverse('remove_from_bag', args=[item_id]), {
+            'product_size': 'm',
+        }, method='post', status=200)
+
+    def test_api(self):
+        item_id = self.product.pk
+        size = 'm' if self.product.has_sizes else ''
+        self.assertQueryBudget(5, reverse('api_add_to_bag', args=[item_id]), {
+            'quantity': 1, 'product_size': size,
+        }, method='post', status=200)
+        self.assertQueryBudget(5, reverse('api_adjust_bag', args=[item_id]), {
+            'quantity': 3, 'product_size': size,
+        }, method='post', status=200)
+        self.assertQueryBudget(5, reverse('api_remove_from_bag', args=[item_id]), {
+            'product_size': size,
+        }, method='post', status=200)
+        lines = [
+            {'item_id': product.pk, 'size': 'm' if product.has_sizes else None, 'quantity': 2}
+            for product in self.products[:BAG_LINES]
+        ]
+        self.assertQueryBudget(
+            5, reverse('api_update_bag'), json.dumps({'lines': lines}),
+            method='post', status=200, content_type='application/json')
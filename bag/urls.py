@@ -1,9 +1,15 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import views, api
 
 urlpatterns = [
-    path('', views.view_bag, name='view_bag'),
+    path('', views.view_bag_async if settings.ASYNC_VIEWS else views.view_bag, name='view_bag'),
+    path('summary/', views.bag_summary, name='bag_summary'),
     path('add/<item_id>/', views.add_to_bag, name='add_to_bag'),
     path('adjust/<item_id>/', views.adjust_bag, name='adjust_bag'),
     path('remove/<item_id>/', views.remove_from_bag, name='remove_from_bag'),
+    path('api/add/<item_id>/', api.add_to_bag, name='api_add_to_bag'),
+    path('api/adjust/<item_id>/', api.adjust_bag, name='api_adjust_bag'),
+    path('api/remove/<item_id>/', api.remove_from_bag, name='api_remove_from_bag'),
+    path('api/update/', api.update_bag, name='api_update_bag'),
 ]
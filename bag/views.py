@@ -1,7 +1,14 @@
 from django.shortcuts import render, redirect, reverse, HttpResponse, get_object_or_404
 from django.contrib import messages
+from django.http import JsonResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.views.decorators.cache import never_cache
 
 from products.models import Product
+from .bag import Bag
+from boutique_ado.async_utils import run_in_thread
+from .contexts import get_bag_contents, get_bag_contents_async
 
 # Create your views here.
 
@@ -10,6 +17,30 @@ def view_bag(request):
 
     return render(request, 'bag/bag.html')
 
+
+async def view_bag_async(request):
+    """ view_bag for ASGI """
+
+    await get_bag_contents_async(request)
+    return await run_in_thread(render, request, 'bag/bag.html')
+
+@never_cache
+def bag_summary(request):
+    """
+    Return the visitor's own bag total, toasts and CSRF token
+    for pages that are cached for every visitor
+    """
+    current_bag = get_bag_contents(request)
+    grand_total = current_bag['grand_total']
+
+    return JsonResponse({
+        'grand_total': f'{grand_total:.2f}' if grand_total else None,
+        'product_count': current_bag['product_count'],
+        'messages': render_to_string('includes/messages.html', request=request),
+        'csrf_token': get_token(request),
+    })
+
+
 def add_to_bag(request, item_id):
     """ Add a quantity of the specified product to the shopping bag """
 
@@ -19,28 +50,22 @@ def add_to_bag(request, item_id):
     size = None
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-    bag = request.session.get('bag', {})
+    bag = Bag.from_session(request.session)
 
+    already_in_bag = bag.quantity(item_id, size)
+    new_quantity = bag.add(item_id, quantity, size)
     if size:
-        if item_id in list(bag.keys()):
-            if size in bag[item_id]['items_by_size'].keys():
-                bag[item_id]['items_by_size'][size] += quantity
-                messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')
-            else:
-                bag[item_id]['items_by_size'][size] = quantity
-                messages.success(request, f'Added size {size.upper()} {product.name} to your bag')
+        if already_in_bag:
+            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {new_quantity}')
         else:
-            bag[item_id] = {'items_by_size': {size: quantity}}
             messages.success(request, f'Added size {size.upper()} {product.name} to your bag')
     else:
-        if item_id in list(bag.keys()):
-            bag[item_id] += quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')
+        if already_in_bag:
+            messages.success(request, f'Updated {product.name} quantity to {new_quantity}')
         else:
-            bag[item_id] = quantity
             messages.success(request, f'Added {product.name} to your bag')
 
-    request.session['bag'] = bag
+    bag.save(request.session)
     return redirect(redirect_url)
 
 
@@ -52,26 +77,21 @@ def adjust_bag(request, item_id):
     size = None
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-    bag = request.session.get('bag', {})
+    bag = Bag.from_session(request.session)
 
+    bag.adjust(item_id, quantity, size)
     if size:
         if quantity > 0:
-            bag[item_id]['items_by_size'][size] = quantity
-            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')
+            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {quantity}')
         else:
-            del bag[item_id]['items_by_size'][size]
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
             messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')
     else:
         if quantity > 0:
-            bag[item_id] = quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')
+            messages.success(request, f'Updated {product.name} quantity to {quantity}')
         else:
-            bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
 
-    request.session['bag'] = bag
+    bag.save(request.session)
     return redirect(reverse('view_bag'))
 
 
@@ -83,18 +103,15 @@ def remove_from_bag(request, item_id):
         size = None
         if 'product_size' in request.POST:
             size = request.POST['product_size']
-        bag = request.session.get('bag', {})
+        bag = Bag.from_session(request.session)
 
+        bag.remove(item_id, size)
         if size:
-            del bag[item_id]['items_by_size'][size]
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
             messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')
         else:
-            bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
 
-        request.session['bag'] = bag
+        bag.save(request.session)
         return HttpResponse(status=200)
 
     except Exception as e:
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class BoutiqueAdoConfig(AppConfig):
+    name = 'boutique_ado'
+
+    def ready(self):
+        from . import metrics
+        metrics.install()
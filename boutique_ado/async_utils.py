@@ -0,0 +1,52 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    The pool async views run blocking work on, created on first use.
+    Each thread holds a database connection, so its size also caps the
+    connections one worker opens.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.ASYNC_VIEWS_THREADS, thread_name_prefix='async-views')
+        return _executor
+
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # like the end of a request: the thread keeps its connection for
+        # the next call unless it broke or is older than CONN_MAX_AGE
+        close_old_connections()
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """
+    Await blocking work, like queries, cache calls or rendering, from an
+    async view.
+
+    Django 3.2 has no async ORM, so async views hand their blocking calls
+    to a thread pool. It isn't the single thread Django runs sync views
+    on under ASGI, so one worker can have many requests waiting on the
+    database at once, and one request can make independent queries
+    concurrently. Anything that touches the session or request.user for
+    the first time has to go through here too, as both load lazily.
+    """
+    # the copied context carries the request's metrics over to the thread
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_executor(), partial(context.run, _call, func, args, kwargs))
@@ -0,0 +1,346 @@
+import asyncio
+import bisect
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth.decorators import user_passes_test
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, JsonResponse
+from django.template.backends.django import Template as DjangoTemplate
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """ Observation counts in fixed buckets, so memory use never grows """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, value, error=False):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.errors += error
+
+    def percentile(self, fraction):
+        """ The upper bound of the bucket the percentile falls in """
+        with self._lock:
+            target = fraction * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+                seen += count
+                if count and seen >= target:
+                    return bound
+        return 0.0
+
+    def snapshot(self):
+        with self._lock:
+            cumulative, buckets = 0, []
+            for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+                cumulative += count
+                buckets.append((bound, cumulative))
+            return {'count': self.count, 'sum': self.sum, 'errors': self.errors, 'buckets': buckets}
+
+
+class HistogramFamily:
+    """ One histogram per label value, e.g. per view """
+
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def labels(self, value):
+        histogram = self._histograms.get(value)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(value, Histogram(self.buckets))
+        return histogram
+
+    def items(self):
+        with self._lock:
+            return sorted(self._histograms.items())
+
+
+class RequestTimings:
+    """ What one request spent its time on """
+
+    __slots__ = ('db_queries', 'db_seconds', 'template_seconds',
+                 'stripe_seconds', 'sections', 'lock')
+
+    def __init__(self):
+        # async views can run a request's queries on several threads at once
+        self.lock = threading.Lock()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.stripe_seconds = 0.0
+        self.sections = {}
+
+
+_current = contextvars.ContextVar('request_timings', default=None)
+# how many renders deep the current thread or task is, kept apart for
+# each of a request's threads and each concurrent request
+_template_depth = contextvars.ContextVar('template_depth', default=0)
+
+REQUEST_SECONDS = HistogramFamily(
+    'boutique_request_duration_seconds', 'Wall time of each request', 'view')
+DB_QUERIES = HistogramFamily(
+    'boutique_db_queries', 'Database queries made by each request', 'view', QUERY_COUNT_BUCKETS)
+DB_SECONDS = HistogramFamily(
+    'boutique_db_duration_seconds', 'Time each request spent in database queries', 'view')
+TEMPLATE_SECONDS = HistogramFamily(
+    'boutique_template_duration_seconds', 'Time each request spent rendering templates', 'view')
+STRIPE_SECONDS = HistogramFamily(
+    'boutique_stripe_duration_seconds', 'Time each request spent calling Stripe', 'view')
+SECTION_SECONDS = HistogramFamily(
+    'boutique_section_duration_seconds', 'Time spent in named sections of a request, '
+    'such as working out the bag contents', 'section')
+FAMILIES = (REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, TEMPLATE_SECONDS, STRIPE_SECONDS, SECTION_SECONDS)
+
+# the most recent requests, for looking at individual slow requests
+recent = deque(maxlen=settings.METRICS_BUFFER_SIZE)
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        with timings.lock:
+            timings.db_queries += 1
+            timings.db_seconds += elapsed
+
+
+def _instrument(connection, **kwargs):
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+def _timed_render(render):
+    @wraps(render)
+    def wrapper(self, *args, **kwargs):
+        timings = _current.get()
+        if timings is None:
+            return render(self, *args, **kwargs)
+        # templates rendered while rendering another, like the product
+        # cards, are already inside the outer template's time
+        token = _template_depth.set(_template_depth.get() + 1)
+        started = time.perf_counter()
+        try:
+            return render(self, *args, **kwargs)
+        finally:
+            _template_depth.reset(token)
+            if not _template_depth.get():
+                with timings.lock:
+                    timings.template_seconds += time.perf_counter() - started
+    wrapper._timed = True
+    return wrapper
+
+
+def install():
+    """
+    Time template renders and instrument database connections as
+    they're opened, like on the async views' pool threads. Called once,
+    from the app's ready().
+    """
+    if not getattr(DjangoTemplate.render, '_timed', False):
+        DjangoTemplate.render = _timed_render(DjangoTemplate.render)
+    connection_created.connect(_instrument, dispatch_uid='boutique_ado.metrics')
+
+
+def observe_stripe(seconds):
+    """ Add the time a Stripe call took to the current request's """
+    timings = _current.get()
+    if timings is not None:
+        with timings.lock:
+            timings.stripe_seconds += seconds
+
+
+class section:
+    """ Time a block of code under a name, e.g. with section('bag_contents'): """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        SECTION_SECONDS.labels(self.name).observe(elapsed)
+        timings = _current.get()
+        if timings is not None:
+            timings.sections[self.name] = timings.sections.get(self.name, 0) + elapsed
+
+
+class MetricsMiddleware:
+    """
+    Record each request's wall time, database queries and time, template
+    time and Stripe time against the view that handled it. Works in
+    sync and async middleware chains; under ASGI, queries made on
+    async views' pool threads are counted too.
+
+    The cost is bounded: timing is a few perf_counter calls per query and
+    per render, histograms have fixed buckets, the recent request buffer
+    has a fixed size, and METRICS_SAMPLE_RATE can record only a fraction
+    of requests.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # so Django awaits this middleware, as it does MiddlewareMixin
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def _sampled(self):
+        if not settings.METRICS_ENABLED or random.random() >= settings.METRICS_SAMPLE_RATE:
+            return False
+        for connection in connections.all():
+            _instrument(connection)
+        return True
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not self._sampled():
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, timings, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not self._sampled():
+            return await self.get_response(request)
+
+        # threads the request's work is handed to get a copy of this context,
+        # so they add to the same timings
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, timings, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, timings, elapsed):
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        REQUEST_SECONDS.labels(view).observe(elapsed, error=response.status_code >= 500)
+        DB_QUERIES.labels(view).observe(timings.db_queries)
+        DB_SECONDS.labels(view).observe(timings.db_seconds)
+        TEMPLATE_SECONDS.labels(view).observe(timings.template_seconds)
+        STRIPE_SECONDS.labels(view).observe(timings.stripe_seconds)
+        recent.append({
+            'view': view,
+            'method': request.method,
+            'status': response.status_code,
+            'seconds': elapsed,
+            'db_queries': timings.db_queries,
+            'db_seconds': timings.db_seconds,
+            'template_seconds': timings.template_seconds,
+            'stripe_seconds': timings.stripe_seconds,
+            'sections': timings.sections,
+            'time': time.time(),
+        })
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, help_text, label, histograms):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+    for value, histogram in histograms:
+        snapshot = histogram.snapshot()
+        labels = f'{label}="{_label(value)}"'
+        for bound, count in snapshot['buckets']:
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {snapshot["sum"]}')
+        lines.append(f'{name}_count{{{labels}}} {snapshot["count"]}')
+    return lines
+
+
+def _counter_lines(name, help_text, values, kind='counter'):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for labels, value in values:
+        label_text = ','.join(f'{key}="{_label(val)}"' for key, val in labels.items())
+        lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+    return lines
+
+
+def render_prometheus():
+    """ Every metric in the Prometheus text exposition format """
+    # imported here as the apps' modules import this one
+    from checkout import payments
+    from checkout.intents import payment_intent_stats
+    from products.caching import card_cache_stats, page_cache_stats
+
+    lines = []
+    for family in FAMILIES:
+        lines += _histogram_lines(family.name, family.help_text, family.label, family.items())
+    lines += _histogram_lines(
+        'boutique_stripe_call_duration_seconds', 'Latency of each Stripe API operation',
+        'operation', payments.histograms())
+
+    cache_counts = []
+    for name, stats in (('cards', card_cache_stats()), ('pages', page_cache_stats())):
+        cache_counts.append(({'cache': name, 'result': 'hit'}, stats['hits']))
+        cache_counts.append(({'cache': name, 'result': 'miss'}, stats['misses']))
+    lines += _counter_lines(
+        'boutique_cache_lookups_total', 'Product card and catalog page cache lookups', cache_counts)
+
+    intents = payment_intent_stats()
+    lines += _counter_lines(
+        'boutique_payment_intent_calls_total',
+        'PaymentIntent calls made and avoided by the checkout page',
+        [({'result': name}, value) for name, value in intents.items() if name != 'calls_avoided'])
+    lines += _counter_lines(
+        'boutique_stripe_circuit_open', 'Whether calls to Stripe are currently being refused',
+        [({}, int(payments.breaker.state == 'open'))], kind='gauge')
+    return '\n'.join(lines) + '\n'
+
+
+@user_passes_test(lambda user: user.is_superuser)
+def metrics_view(request):
+    """
+    Metrics in Prometheus text format, or the recent requests
+    as JSON with ?recent
+    """
+    if 'recent' in request.GET:
+        return JsonResponse({'requests': list(recent)})
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4')
@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     'bag',
     'checkout',
     'profiles',
+    'boutique_ado',
 
     # Other
     'crispy_forms',
@@ -56,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'boutique_ado.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -94,7 +96,16 @@ TEMPLATES = [
     },
 ]
 
-MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+# Sessions are read through the cache and written through to the database,
+# when there's a shared cache; otherwise each worker would read back its own
+# stale copy of a session another one changed.
+# Messages go in a cookie where they fit, so showing one doesn't save the session.
+SESSION_ENGINE = os.environ.get(
+    'SESSION_ENGINE',
+    'django.contrib.sessions.backends.cached_db' if 'REDIS_URL' in os.environ
+    else 'django.contrib.sessions.backends.db')
+MESSAGE_STORAGE = os.environ.get(
+    'MESSAGE_STORAGE', 'django.contrib.messages.storage.fallback.FallbackStorage')
 
 AUTHENTICATION_BACKENDS = [
     # Needed to login by username in Django admin, regardless of `allauth`
@@ -123,8 +134,12 @@ WSGI_APPLICATION = 'boutique_ado.wsgi.application'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
 if 'DATABASE_URL' in os.environ:
+    # keep connections open between requests, and between the async
+    # views' calls on their pool threads, rather than reconnecting each time
     DATABASES = {
-        'default': dj_database_url.parse(os.environ.get('DATABASE_URL'))
+        'default': dj_database_url.parse(
+            os.environ.get('DATABASE_URL'),
+            conn_max_age=int(os.getenv('DATABASE_CONN_MAX_AGE', 600)))
     }
 else:
     DATABASES = {
@@ -135,6 +150,44 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# With REDIS_URL set the cache is shared between processes and dynos,
+# so a version bump or invalidation in one is seen by all, and add and
+# incr are atomic, which the counters and locks built on them rely on.
+# Without it production falls back to a cache table in the database,
+# which is slower but still shared, so versions stored without a timeout
+# can't go stale in one worker. Create it with createcachetable.
+# Only development keeps a cache in each process.
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                # Heroku Redis's TLS certificates are self-signed
+                'CONNECTION_POOL_KWARGS': (
+                    {'ssl_cert_reqs': None}
+                    if os.environ.get('REDIS_URL').startswith('rediss://') else {}
+                ),
+            },
+        }
+    }
+elif DEBUG:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -207,6 +260,40 @@ if 'USE_AWS' in os.environ:
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Metrics
+# recorded per view by boutique_ado.metrics.MetricsMiddleware, and shown to superusers at /metrics/
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', 1))
+METRICS_BUFFER_SIZE = 1000
+
+# Async
+# Serve the home, product listing, product detail and bag pages with
+# async views, for running under an ASGI server. They're slower under
+# WSGI, which has to start an event loop for each request.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+# Threads their queries run on, each with its own database connection.
+# Each worker process can hold this many plus one for the sync views, so
+# keep it times the number of workers and dynos under the database's
+# connection limit, which is only 20 on the smaller Heroku Postgres plans
+ASYNC_VIEWS_THREADS = int(os.getenv('ASYNC_VIEWS_THREADS', 4))
+
+# Products
+PRODUCTS_PER_PAGE = 24
+PRODUCTS_COUNT_CACHE_TIMEOUT = 60
+# Only this many of the most relevant search results are fetched,
+# though all of them are counted
+PRODUCTS_SEARCH_RESULTS_LIMIT = 1000
+PRODUCT_CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Serve catalog pages to anonymous visitors without their bag in them,
+# so the pages can be cached whole, and load the bag separately
+BAG_FRAGMENT_MODE = True
+CATALOG_PAGE_CACHE_TIMEOUT = 60 * 10
+
+# Profiles
+PROFILE_ORDERS_PER_PAGE = 10
+PROFILE_SUMMARY_CACHE_TIMEOUT = 60 * 60 * 24
+
 # Stripe
 FREE_DELIVERY_THRESHOLD = 50
 STANDARD_DELIVERY_PERCENTAGE = 10
@@ -214,6 +301,31 @@ STRIPE_CURRENCY = 'usd'
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WH_SECRET = os.getenv('STRIPE_WH_SECRET', '')
+# 'live' calls the Stripe API, 'fake' answers from memory for offline load tests
+STRIPE_BACKEND = os.getenv('STRIPE_BACKEND', 'live')
+STRIPE_FAKE_LATENCY = float(os.getenv('STRIPE_FAKE_LATENCY', 0))
+STRIPE_FAKE_LATENCY_JITTER = float(os.getenv('STRIPE_FAKE_LATENCY_JITTER', 0))
+STRIPE_CONNECT_TIMEOUT = 3
+STRIPE_READ_TIMEOUT = 10
+STRIPE_MAX_NETWORK_RETRIES = 1
+STRIPE_POOL_SIZE = 10
+# stop calling stripe for STRIPE_BREAKER_COOLDOWN seconds after this many failures in a row
+STRIPE_BREAKER_THRESHOLD = 5
+STRIPE_BREAKER_COOLDOWN = 30
+# how long to remember the metadata sent to each intent, and how often
+# and for how long a repeated update polls while another request is
+# sending the same intent's, before it sends its own anyway
+CHECKOUT_METADATA_CACHE_TIMEOUT = 60 * 60 * 24
+CHECKOUT_METADATA_POLL_INTERVAL = 0.05
+CHECKOUT_METADATA_LOCK_WAIT = 0.5
+# how often, and how many times, the webhook handler looks for an order
+# the checkout view hasn't saved yet before creating it itself
+STRIPE_WH_RECONCILE_DELAY = 1
+STRIPE_WH_RECONCILE_ATTEMPTS = 5
+# webhook events are stored, then processed on a 'thread' or 'process'
+# pool in the web process, or by process_webhook_events for 'command'
+STRIPE_WH_WORKER_MODE = os.getenv('STRIPE_WH_WORKER_MODE', 'thread')
+STRIPE_WH_WORKERS = int(os.getenv('STRIPE_WH_WORKERS', 4))
 
 if 'DEVELOPMENT' in os.environ:
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -227,6 +339,12 @@ else:
     EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASS')
     DEFAULT_FROM_EMAIL = os.environ.get('EMAIL_HOST_USER')
 
+# queued emails are retried after 30s, 60s, 120s... until they've been tried this many times
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 30
+# Seconds before an email left sending, e.g. by a worker that died, is sent again
+EMAIL_OUTBOX_LEASE = 300
+
 
 # The reason we're getting these from the environment
 # is because even though the public key is already in our github from the last commit.
@@ -0,0 +1,136 @@
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from allauth.account.models import EmailAddress
+
+from bag.bag import Bag
+from checkout.models import Order, OrderLineItem
+from products import search
+from products.models import Category, Product
+
+PRODUCTS = 300
+ORDERS = 60
+LINES_PER_ORDER = 8
+BAG_LINES = 40
+
+
+def populate():
+    """
+    A catalog, a customer with a long order history and a superuser,
+    big enough that a query per product, order or line item shows up
+    as a budget overrun
+    """
+    Category.objects.bulk_create([
+        Category(name=f'category_{i}', friendly_name=f'Category {i}') for i in range(10)
+    ])
+    categories = list(Category.objects.order_by('pk'))
+    Product.objects.bulk_create([
+        Product(
+            category=categories[i % len(categories)],
+            sku=f'sku{i:05}',
+            name=f'{"Shirt" if i % 3 else "Jacket"} {i}',
+            description=f'A comfortable garment, number {i}',
+            has_sizes=bool(i % 2),
+            price=Decimal('10.00') + i,
+            rating=Decimal(i % 5),
+        )
+        for i in range(PRODUCTS)
+    ])
+    products = list(Product.objects.order_by('pk'))
+
+    shopper = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+    EmailAddress.objects.create(user=shopper, email=shopper.email, verified=True, primary=True)
+    admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    Order.objects.bulk_create([
+        Order(
+            order_number=uuid.uuid4().hex.upper(),
+            user_profile=shopper.userprofile,
+            full_name='Shopper', email=shopper.email, phone_number='0123456789',
+            country='IE', town_or_city='Dublin', street_address1=f'{i} Main Street',
+            original_bag='{"v":2,"lines":[]}', stripe_pid=f'pi_{uuid.uuid4().hex}',
+            grand_total=Decimal('100.00'),
+        )
+        for i in range(ORDERS)
+    ])
+    orders = list(Order.objects.order_by('pk'))
+    OrderLineItem.objects.bulk_create([
+        OrderLineItem(
+            order=order, product=products[(n + j) % len(products)],
+            product_size='m' if products[(n + j) % len(products)].has_sizes else None,
+            quantity=2, lineitem_total=products[(n + j) % len(products)].price * 2,
+        )
+        for n, order in enumerate(orders)
+        for j in range(LINES_PER_ORDER)
+    ])
+    return {
+        'categories': categories,
+        'products': products,
+        'shopper': shopper,
+        'admin': admin,
+        'orders': orders,
+    }
+
+
+def large_bag(products, lines=BAG_LINES):
+    bag = Bag()
+    for product in products[:lines]:
+        bag.add(product.pk, 1, 'm' if product.has_sizes else None)
+    return bag
+
+
+# budgeted as deployed with a shared cache, so sessions are read through it
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+    STRIPE_BACKEND='fake',
+    STRIPE_WH_SECRET='whsec_test',
+    STRIPE_WH_WORKER_MODE='command',
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+)
+class QueryBudgetTestCase(TestCase):
+    """
+    Checks the number of queries each URL makes against a budget.
+
+    Every test starts with an empty cache and a built search index, so
+    budgets are for a cold page on a warm process. Going over budget
+    fails with the SQL the request ran.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = populate()
+        cls.products = cls.data['products']
+        cls.orders = cls.data['orders']
+
+    def setUp(self):
+        cache.clear()
+        search.rebuild()
+
+    def login(self, user='shopper'):
+        self.client.force_login(self.data[user])
+
+    def fill_bag(self, lines=BAG_LINES):
+        session = self.client.session
+        large_bag(self.products, lines).save(session)
+        session.save()
+
+    def assertQueryBudget(self, budget, url, data=None, method='get', status=None, **extra):
+        """ Request the url and fail if it ran more than budget queries """
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data, **extra)
+        if status is not None:
+            self.assertEqual(response.status_code, status, f'{method.upper()} {url}')
+        if len(queries) > budget:
+            sql = '\n'.join(
+                f'{i}. {query["sql"]}' for i, query in enumerate(queries.captured_queries, start=1))
+            self.fail(
+                f'{method.upper()} {url} ran {len(queries)} queries, over its budget of {budget}:\n{sql}')
+        return response
@@ -0,0 +1,175 @@
+import contextvars
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import path, reverse
+
+from bag.views import view_bag_async
+from home.views import index_async
+from products import search
+from products.models import Category, Product
+from products.views import all_products_async, product_detail_async
+from . import metrics
+from .urls import urlpatterns as site_urlpatterns
+from .testing import QueryBudgetTestCase
+
+
+# the site with its async views, for AsyncViewTests
+urlpatterns = [
+    path('', index_async, name='home'),
+    path('products/', all_products_async, name='products'),
+    path('products/<int:product_id>/', product_detail_async, name='product_detail'),
+    path('bag/', view_bag_async, name='view_bag'),
+] + site_urlpatterns
+
+
+class MetricsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.product = Product.objects.create(
+            category=category, name='Shirt', description='A shirt', price='10.00')
+
+    def test_requests_are_recorded_per_view(self):
+        self.client.get(reverse('product_detail', args=[self.product.pk]))
+        record = metrics.recent[-1]
+        self.assertEqual(record['view'], 'product_detail')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['db_queries'], 0)
+        self.assertGreater(record['template_seconds'], 0)
+        self.assertLessEqual(record['template_seconds'], record['seconds'])
+        self.assertGreater(metrics.REQUEST_SECONDS.labels('product_detail').count, 0)
+
+    def test_concurrent_renders_are_each_timed(self):
+        started = threading.Barrier(2)
+
+        def render(template):
+            started.wait()
+            time.sleep(0.05)
+
+        timed = metrics._timed_render(render)
+        timings = metrics.RequestTimings()
+        token = metrics._current.set(timings)
+        try:
+            # as the async views hand a request's renders to their pool threads
+            threads = [
+                threading.Thread(target=contextvars.copy_context().run, args=(timed, None))
+                for i in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            metrics._current.reset(token)
+        self.assertGreaterEqual(timings.template_seconds, 0.1)
+
+    def test_endpoint_is_for_superusers_only(self):
+        self.client.get(reverse('bag_summary'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 302)
+
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('boutique_request_duration_seconds_bucket{view="bag_summary",le="+Inf"}', body)
+        self.assertIn('boutique_section_duration_seconds_count{section="bag_contents"}', body)
+        self.assertIn('boutique_cache_lookups_total{cache="cards",result="hit"}', body)
+
+
+class SiteQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_admin(self):
+        self.login('admin')
+        order = self.orders[0]
+        self.assertQueryBudget(2, reverse('admin:index'), status=200)
+        self.assertQueryBudget(4, reverse('admin:checkout_order_changelist'), status=200)
+        self.assertQueryBudget(11, reverse('admin:checkout_order_change', args=[order.pk]), status=200)
+        self.assertQueryBudget(4, reverse('admin:products_product_changelist'), status=200)
+        self.assertQueryBudget(6, reverse('admin:products_product_change', args=[self.products[0].pk]), status=200)
+
+    def test_login_and_logout(self):
+        self.fill_bag()
+        self.assertQueryBudget(2, reverse('account_login'), status=200)
+        self.assertQueryBudget(12, reverse('account_login'), {
+            'login': 'shopper', 'password': 'password',
+        }, method='post', status=302)
+        self.assertQueryBudget(3, reverse('account_logout'), method='post', status=302)
+
+    def test_signup(self):
+        self.assertQueryBudget(0, reverse('account_signup'), status=200)
+        self.assertQueryBudget(13, reverse('account_signup'), {
+            'email': 'new@example.com', 'email2': 'new@example.com', 'username': 'newshopper',
+            'password1': 'a long password 123', 'password2': 'a long password 123',
+        }, method='post', status=302)
+
+    def test_password_reset(self):
+        self.assertQueryBudget(0, reverse('account_reset_password'), status=200)
+        self.assertQueryBudget(5, reverse('account_reset_password'), {
+            'email': 'shopper@example.com',
+        }, method='post', status=302)
+
+    def test_metrics(self):
+        self.login('admin')
+        self.assertQueryBudget(1, reverse('metrics'), status=200)
+        self.assertQueryBudget(1, reverse('metrics'), {'recent': 1}, status=200)
+
+
+@override_settings(
+    ROOT_URLCONF='boutique_ado.tests',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class AsyncViewTests(TransactionTestCase):
+    # the async views query on pool threads, which have their own
+    # connections and so only see committed rows
+
+    def setUp(self):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        self.products = [
+            Product.objects.create(
+                category=category, name=f'Shirt {i}', description='A shirt', price='10.00')
+            for i in range(30)
+        ]
+        # rather than the one earlier tests left behind
+        search.rebuild()
+
+    async def test_catalog_pages(self):
+        response = await self.async_client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+
+        # the 3.2 AsyncClient drops a GET's data, so query strings go in the url
+        response = await self.async_client.get(reverse('products') + '?q=shirt&sort=price')
+        self.assertContains(response, 'Shirt 0')
+        self.assertEqual(response.context['total_products'], 30)
+        self.assertTrue(response.context['next_url'])
+        record = metrics.recent[-1]
+        self.assertEqual(record['view'], 'products')
+        self.assertGreater(record['db_queries'], 0)
+
+        response = await self.async_client.get(reverse('products') + '?q=')
+        self.assertRedirects(response, reverse('products'), fetch_redirect_response=False)
+
+        url = reverse('product_detail', args=[self.products[3].pk])
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'Shirt 3')
+        # and extra keyword arguments are sent as raw header names
+        response = await self.async_client.get(url, **{'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        response = await self.async_client.get(reverse('product_detail', args=[0]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_bag(self):
+        product = self.products[5]
+        response = await self.async_client.post(
+            reverse('api_add_to_bag', args=[product.pk]), 'quantity=2',
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get(reverse('view_bag'))
+        self.assertContains(response, 'Shirt 5')
+        self.assertEqual(response.context['total'](), 20)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from .models import Order, OrderLineItem, WebhookEvent, OutboundEmail
 
 # This inline item is going to allow us to add and edit line items in the admin
 # right from inside the order model.
@@ -11,6 +11,21 @@ class OrderLineItemAdminInline(admin.TabularInline):
     model = OrderLineItem
     readonly_fields = ('lineitem_total',)
 
+    def get_queryset(self, request):
+        # each row is labelled with its product's sku and order number
+        return super().get_queryset(request).select_related('product', 'order').defer(
+            'product__description', 'order__original_bag')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # every line item's product dropdown would otherwise query all
+        # the products again, so share one list for the whole page
+        field = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'product':
+            if not hasattr(request, '_product_choices'):
+                request._product_choices = list(field.choices)
+            field.choices = request._product_choices
+        return field
+
 
 class OrderAdmin(admin.ModelAdmin):
     inlines = (OrderLineItemAdminInline,)
@@ -33,7 +48,45 @@ class OrderAdmin(admin.ModelAdmin):
 
     ordering = ('-date',)
 
+    def get_queryset(self, request):
+        # the changelist doesn't show the bag, so leave it out of the listing query
+        queryset = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name.endswith('_changelist'):
+            queryset = queryset.lean()
+        return queryset
+
 # register the Order model and the OrderAdmin.
 admin.site.register(Order, OrderAdmin)
 # skip registering the OrderLineItem model.
 # Since it's accessible via the inline on the order model.
+
+
+class WebhookEventAdmin(admin.ModelAdmin):
+    readonly_fields = ('event_id', 'type', 'payload', 'attempts',
+                       'last_error', 'created_at', 'updated_at',
+                       'processed_at')
+
+    list_display = ('event_id', 'type', 'status', 'attempts',
+                    'created_at', 'processed_at')
+
+    list_filter = ('status', 'type')
+
+    ordering = ('-created_at',)
+
+
+admin.site.register(WebhookEvent, WebhookEventAdmin)
+
+
+class OutboundEmailAdmin(admin.ModelAdmin):
+    readonly_fields = ('key', 'attempts', 'last_error', 'created_at',
+                       'claimed_at', 'claim', 'sent_at')
+
+    list_display = ('subject', 'to', 'status', 'attempts',
+                    'next_attempt_at', 'sent_at')
+
+    list_filter = ('status',)
+
+    ordering = ('-created_at',)
+
+
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
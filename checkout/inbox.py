@@ -0,0 +1,121 @@
+import json
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from . import payments
+from .models import WebhookEvent
+from .reconciliation import scheduler
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    The pool webhook events are processed on, created on first use.
+    Process workers are spawned rather than forked so they don't share
+    this process's database connections, and set Django up themselves.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = settings.STRIPE_WH_WORKERS
+            if settings.STRIPE_WH_WORKER_MODE == 'process':
+                _executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=django.setup)
+            else:
+                _executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='stripe-webhook')
+        return _executor
+
+
+def enqueue(event_pk, delay=0):
+    """
+    Hand a stored event to the worker pool, after delay seconds if
+    given. With STRIPE_WH_WORKER_MODE set to 'command' events are left
+    for process_webhook_events instead.
+    """
+    if settings.STRIPE_WH_WORKER_MODE == 'command':
+        return
+    if delay:
+        # only a wake-up; the event stays pending in the database, so
+        # process_webhook_events picks it up if this process goes away
+        scheduler.schedule(delay, enqueue, event_pk)
+        return
+    future = _get_executor().submit(run_event, event_pk)
+    future.add_done_callback(lambda future: _wake_if_deferred(event_pk, future))
+
+
+def _wake_if_deferred(event_pk, future):
+    if not future.cancelled() and future.result() == WebhookEvent.PENDING:
+        enqueue(event_pk, delay=settings.STRIPE_WH_RECONCILE_DELAY)
+
+
+def run_event(event_pk):
+    """ Process an event on a pool worker, closing its connections after """
+    try:
+        return process_event(event_pk)
+    except Exception:
+        logger.exception('Webhook event %s could not be processed', event_pk)
+    finally:
+        connections.close_all()
+
+
+def process_event(event_pk):
+    """
+    Claim a due pending or failed event and dispatch it to its handler.
+    Returns the event's new status, pending if the handler deferred it,
+    or None if it wasn't due or another worker had already claimed or
+    finished it.
+    """
+    # the conditional update means only one worker can claim an event.
+    # update() skips auto_now, and process_webhook_events releases events
+    # left processing too long by updated_at, so the claim stamps it
+    now = timezone.now()
+    claimed = WebhookEvent.objects.filter(
+        pk=event_pk, status__in=(WebhookEvent.PENDING, WebhookEvent.FAILED),
+        next_attempt_at__lte=now,
+    ).update(status=WebhookEvent.PROCESSING, attempts=F('attempts') + 1, updated_at=now)
+    if not claimed:
+        return None
+
+    # imported here to avoid a circular import with the webhook view
+    from .webhooks import dispatch_event
+
+    event_record = WebhookEvent.objects.get(pk=event_pk)
+    try:
+        event = payments.event_from_dict(json.loads(event_record.payload))
+        response = dispatch_event(event, attempt=event_record.attempts)
+        if response.status_code >= 400:
+            raise RuntimeError(response.content.decode())
+    except Exception as e:
+        event_record.status = WebhookEvent.FAILED
+        event_record.last_error = str(e)
+        event_record.processed_at = timezone.now()
+        logger.warning('Webhook event %s failed: %s', event_record.event_id, e)
+    else:
+        if response.status_code == 202:
+            # the handler asked to try again later
+            event_record.status = WebhookEvent.PENDING
+            event_record.next_attempt_at = timezone.now() + timedelta(
+                seconds=settings.STRIPE_WH_RECONCILE_DELAY)
+        else:
+            event_record.status = WebhookEvent.SUCCEEDED
+            event_record.processed_at = timezone.now()
+        event_record.last_error = ''
+    event_record.save(update_fields=[
+        'status', 'last_error', 'next_attempt_at', 'processed_at', 'updated_at'])
+    return event_record.status
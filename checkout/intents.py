@@ -0,0 +1,171 @@
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+import stripe
+
+from products.caching import incr_counter
+from . import payments
+from .models import Order
+
+SESSION_KEY = 'checkout_intent'
+
+CREATED_KEY = 'checkout:intents:created'
+MODIFIED_KEY = 'checkout:intents:modified'
+REUSED_KEY = 'checkout:intents:reused'
+METADATA_SENT_KEY = 'checkout:metadata:sent'
+METADATA_SKIPPED_KEY = 'checkout:metadata:skipped'
+METADATA_KEY = 'checkout:metadata:{}'
+METADATA_LOCK_KEY = 'checkout:metadata-lock:{}'
+
+
+# the statuses an intent can still be confirmed from
+REUSABLE_STATUSES = ('requires_payment_method', 'requires_confirmation', 'requires_action')
+
+
+def bag_fingerprint(bag):
+    return hashlib.sha1(bag.dumps().encode()).hexdigest()
+
+
+def get_payment_intent(request, bag, amount):
+    """
+    Return the id and client secret of a PaymentIntent for the bag.
+
+    The intent is kept in the session, so reloading the checkout page
+    with the same bag reuses it without calling Stripe. If the bag has
+    changed the intent's amount is modified rather than a new one
+    created, which also stops reloads leaving orphaned intents behind.
+    Once a payment has been attempted with the intent its status is
+    checked before it's reused, and once it has been paid, or an order
+    made for it, a new one is created.
+    """
+    fingerprint = bag_fingerprint(bag)
+    cached = request.session.get(SESSION_KEY)
+    # the webhook can make the order without the checkout forgetting it
+    if cached and Order.objects.filter(stripe_pid=cached['id']).exists():
+        cached = None
+    # the card may have been charged without the checkout form posting
+    if cached and cached.get('submitted'):
+        if payments.retrieve_payment_intent(cached['id']).status not in REUSABLE_STATUSES:
+            cached = None
+
+    if cached and cached['amount'] == amount and cached.get('fingerprint') == fingerprint:
+        incr_counter(REUSED_KEY)
+        return cached['id'], cached['client_secret']
+
+    intent = None
+    if cached:
+        try:
+            intent = payments.modify_payment_intent(cached['id'], amount=amount)
+            incr_counter(MODIFIED_KEY)
+        except stripe.error.InvalidRequestError:
+            # it has been paid or cancelled, so it can't be changed
+            intent = None
+    if intent is None:
+        intent = payments.create_payment_intent(
+            amount=amount,
+            currency=settings.STRIPE_CURRENCY,
+        )
+        incr_counter(CREATED_KEY)
+
+    request.session[SESSION_KEY] = {
+        'id': intent.id,
+        'client_secret': intent.client_secret,
+        'amount': amount,
+        'fingerprint': fingerprint,
+        'submitted': bool(cached and cached.get('submitted') and cached['id'] == intent.id),
+    }
+    return intent.id, intent.client_secret
+
+
+def mark_payment_intent_submitted(session, pid):
+    """
+    Note that the client is about to confirm a payment with the session's
+    intent, so the next checkout checks its status before reusing it
+    """
+    cached = session.get(SESSION_KEY)
+    if cached and cached['id'] == pid and not cached.get('submitted'):
+        cached['submitted'] = True
+        session[SESSION_KEY] = cached
+
+
+def update_payment_intent_metadata(pid, bag, save_info, username):
+    """
+    Copy the bag and checkout options into the intent's metadata for
+    the webhook, skipping the Stripe call if the intent already has
+    exactly this metadata.
+
+    Calls for the same intent are coalesced: while one request is
+    sending an update, the others wait briefly for it and then only
+    send their own if it differs, so a double submit costs one call.
+    A request that can't get the lock in time sends its update anyway
+    rather than tie up the worker.
+    This needs a cache with an atomic add, like redis; with the local
+    memory cache it only coalesces calls within one process.
+    Returns True if Stripe was called.
+    """
+    metadata = {
+        'bag': bag.dumps(),
+        'save_info': save_info,
+        'username': str(username),
+    }
+    fingerprint = hashlib.sha1(
+        '\0'.join(str(value) for value in metadata.values()).encode()).hexdigest()
+    key = METADATA_KEY.format(pid)
+    lock_key = METADATA_LOCK_KEY.format(pid)
+    lock_timeout = settings.STRIPE_CONNECT_TIMEOUT + settings.STRIPE_READ_TIMEOUT
+    deadline = time.monotonic() + settings.CHECKOUT_METADATA_LOCK_WAIT
+    token = uuid.uuid4().hex
+    locked = False
+
+    while True:
+        if cache.get(key) == fingerprint:
+            incr_counter(METADATA_SKIPPED_KEY)
+            return False
+        # the lock expires on its own if the request holding it dies
+        locked = cache.add(lock_key, token, lock_timeout)
+        if locked or time.monotonic() > deadline:
+            break
+        time.sleep(settings.CHECKOUT_METADATA_POLL_INTERVAL)
+
+    try:
+        # the request we waited for may have just sent the same update
+        if cache.get(key) == fingerprint:
+            incr_counter(METADATA_SKIPPED_KEY)
+            return False
+        payments.modify_payment_intent(pid, metadata=metadata)
+        cache.set(key, fingerprint, settings.CHECKOUT_METADATA_CACHE_TIMEOUT)
+        incr_counter(METADATA_SENT_KEY)
+    finally:
+        # only release our own lock, not one another request took after
+        # ours expired or while we gave up waiting
+        if locked and cache.get(lock_key) == token:
+            cache.delete(lock_key)
+    return True
+
+
+def forget_payment_intent(session):
+    """ Stop reusing the session's intent once its order has been placed """
+    session.pop(SESSION_KEY, None)
+
+
+def payment_intent_stats():
+    """
+    Count the checkout page's intents created, modified and reused,
+    and the metadata updates sent and skipped. Each reuse or skip is
+    a Stripe call avoided, and each modify an orphaned intent avoided.
+    """
+    keys = {
+        'created': CREATED_KEY,
+        'modified': MODIFIED_KEY,
+        'reused': REUSED_KEY,
+        'metadata_sent': METADATA_SENT_KEY,
+        'metadata_skipped': METADATA_SKIPPED_KEY,
+    }
+    counts = cache.get_many(keys.values())
+    stats = {name: counts.get(key, 0) for name, key in keys.items()}
+    stats['calls_avoided'] = stats['reused'] + stats['metadata_skipped']
+    return stats
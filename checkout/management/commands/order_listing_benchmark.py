@@ -0,0 +1,99 @@
+import json
+import time
+import tracemalloc
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from checkout.models import Order
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the memory, time and result set size of listing orders '
+        'with and without their wide columns, on generated orders that '
+        'are rolled back afterwards'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=100000)
+        parser.add_argument('--lines', type=int, default=8,
+                            help='Lines in each generated order\'s bag')
+
+    def _generate(self, count, lines):
+        bag = json.dumps({
+            'v': 2,
+            'lines': [[str(1000 + i), 'm' if i % 2 else None, i + 1] for i in range(lines)],
+        }, separators=(',', ':'))
+        batch = []
+        for i in range(count):
+            batch.append(Order(
+                order_number=uuid.uuid4().hex.upper(),
+                full_name=f'Customer {i}',
+                email=f'customer{i}@example.com',
+                phone_number='0123456789',
+                country='IE',
+                town_or_city='Dublin',
+                street_address1=f'{i} Main Street',
+                original_bag=bag,
+                stripe_pid=f'pi_{uuid.uuid4().hex}',
+            ))
+            if len(batch) == 5000:
+                Order.objects.bulk_create(batch)
+                batch = []
+        Order.objects.bulk_create(batch)
+
+    def _transfer(self, queryset):
+        """ The number of bytes of column data the query returns """
+        sql, params = queryset.query.sql_with_params()
+        total = 0
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for row in cursor:
+                total += sum(len(str(value)) for value in row if value is not None)
+        return total
+
+    def _measure(self, queryset):
+        transfer = self._transfer(queryset)
+        # timed separately, as tracing allocations slows everything down
+        started = time.perf_counter()
+        list(queryset.all())
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        orders = list(queryset.all())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del orders
+        return {'seconds': elapsed, 'peak_bytes': peak, 'transfer_bytes': transfer}
+
+    def handle(self, *args, **options):
+        count = options['orders']
+        results = []
+        try:
+            with transaction.atomic():
+                self._generate(count, options['lines'])
+                for name, queryset in (
+                    ('full', Order.objects.order_by('-date')),
+                    ('lean', Order.objects.lean().order_by('-date')),
+                ):
+                    results.append((name, self._measure(queryset)))
+                raise Rollback
+        except Rollback:
+            pass
+
+        self.stdout.write(f'listing {count} orders with {options["lines"]}-line bags')
+        for name, result in results:
+            self.stdout.write(
+                f'{name:<5} {result["seconds"]:.2f}s  '
+                f'peak memory: {result["peak_bytes"] / 2 ** 20:.1f} MiB  '
+                f'transfer: {result["transfer_bytes"] / 2 ** 20:.1f} MiB')
+        full, lean = results[0][1], results[1][1]
+        self.stdout.write(
+            f'lean saves {1 - lean["peak_bytes"] / full["peak_bytes"]:.1%} of peak memory, '
+            f'{1 - lean["transfer_bytes"] / full["transfer_bytes"]:.1%} of transfer and '
+            f'{1 - lean["seconds"] / full["seconds"]:.1%} of time')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from checkout.intents import payment_intent_stats
+
+
+class Command(BaseCommand):
+    help = 'Show how many PaymentIntent calls checkout made, and how many it avoided'
+
+    def handle(self, *args, **options):
+        stats = payment_intent_stats()
+        self.stdout.write(
+            f'intents: created: {stats["created"]}  modified: {stats["modified"]}  '
+            f'reused: {stats["reused"]}')
+        self.stdout.write(
+            f'metadata updates: sent: {stats["metadata_sent"]}  '
+            f'skipped: {stats["metadata_skipped"]}')
+        self.stdout.write(f'stripe calls avoided: {stats["calls_avoided"]}')
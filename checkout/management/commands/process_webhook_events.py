@@ -0,0 +1,59 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from checkout.inbox import run_event
+from checkout.models import WebhookEvent
+
+
+class Command(BaseCommand):
+    help = (
+        'Process stored Stripe webhook events on a pool of worker threads, '
+        'including deferred events once they are due. Use --replay-failed '
+        'to retry events that failed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.STRIPE_WH_WORKERS)
+        parser.add_argument('--replay-failed', action='store_true',
+                            help='Also process events whose last attempt failed')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Seconds after which an event left processing, '
+                                 'e.g. by a worker that died, is picked up again')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling for new events')
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds between polls with --loop')
+
+    def _queued(self, replay_failed, stale_after):
+        # release events a dead worker claimed so they can be claimed again
+        stale = timezone.now() - timedelta(seconds=stale_after)
+        WebhookEvent.objects.filter(
+            status=WebhookEvent.PROCESSING, updated_at__lt=stale,
+        ).update(status=WebhookEvent.PENDING)
+
+        statuses = [WebhookEvent.PENDING]
+        if replay_failed:
+            statuses.append(WebhookEvent.FAILED)
+        return list(WebhookEvent.objects.filter(
+            status__in=statuses, next_attempt_at__lte=timezone.now(),
+        ).order_by('created_at').values_list('pk', flat=True))
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                event_pks = self._queued(options['replay_failed'], options['stale_after'])
+                results = list(pool.map(run_event, event_pks))
+                if event_pks:
+                    self.stdout.write(
+                        f'processed {len(event_pks)} events: '
+                        f'{results.count(WebhookEvent.SUCCEEDED)} succeeded, '
+                        f'{results.count(WebhookEvent.PENDING)} deferred, '
+                        f'{results.count(WebhookEvent.FAILED)} failed')
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from checkout.outbox import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = 'Send queued emails in batches over a single mail server connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling for new emails')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            sent, failed = send_queued_emails(options['batch_size'])
+            elapsed = time.perf_counter() - started
+            if sent or failed:
+                self.stdout.write(
+                    f'sent {sent}, failed {failed} in {elapsed:.2f}s '
+                    f'({(sent + failed) / elapsed:.1f} emails/s)')
+            if not options['loop']:
+                break
+            # keep going straight away while there's a backlog
+            if sent + failed < options['batch_size']:
+                time.sleep(options['interval'])
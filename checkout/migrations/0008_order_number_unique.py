@@ -0,0 +1,40 @@
+# Generated by Django 3.2.9 on 2026-10-18 17:51
+
+import uuid
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def renumber_duplicate_orders(apps, schema_editor):
+    """
+    Give every order but the first a new number wherever two orders
+    share one, so the unique index can be created.
+    """
+    Order = apps.get_model('checkout', 'Order')
+    duplicates = (
+        Order.objects.values('order_number')
+        .annotate(count=Count('id')).filter(count__gt=1)
+        .values_list('order_number', flat=True)
+    )
+    for order_number in list(duplicates):
+        orders = Order.objects.filter(order_number=order_number).order_by('id')
+        for order in orders[1:]:
+            order.order_number = uuid.uuid4().hex.upper()
+            order.save(update_fields=['order_number'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_outboundemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(renumber_duplicate_orders, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(editable=False, max_length=32, unique=True),
+        ),
+    ]
@@ -1,8 +1,9 @@
 import uuid  # used to generate the order no
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.db.models import Sum
 from django.conf import settings
+from django.utils import timezone
 
 from django_countries.fields import CountryField
 
@@ -10,8 +11,26 @@ from products.models import Product
 from profiles.models import UserProfile
 
 
+class OrderQuerySet(models.QuerySet):
+    # columns only needed to reconcile an order with its payment,
+    # and which can be much larger than the rest of the row
+    WIDE_FIELDS = ('original_bag',)
+
+    def lean(self):
+        """ Orders without their wide columns, for listing and display """
+        return self.defer(*self.WIDE_FIELDS)
+
+    def with_lineitems(self):
+        """
+        Fetch the orders' line items and their products in two more
+        queries, for pages listing what was ordered
+        """
+        lineitems = OrderLineItem.objects.select_related('product').defer('product__description')
+        return self.prefetch_related(models.Prefetch('lineitems', queryset=lineitems))
+
+
 class Order(models.Model):
-    order_number = models.CharField(max_length=32, null=False, editable=False)
+    order_number = models.CharField(max_length=32, null=False, editable=False, unique=True)
     user_profile = models.ForeignKey(UserProfile, on_delete=models.SET_NULL,
                                      null=True, blank=True, related_name='orders')
     full_name = models.CharField(max_length=50, null=False, blank=False)
@@ -28,7 +47,11 @@ class Order(models.Model):
     order_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
     grand_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
     original_bag = models.TextField(null=False, blank=False, default='')
-    stripe_pid = models.CharField(max_length=254, null=False, blank=False, default='')
+    stripe_pid = models.CharField(max_length=254, null=False, blank=False, default='', db_index=True)
+
+    ORDER_NUMBER_ATTEMPTS = 5
+
+    objects = OrderQuerySet.as_manager()
 
     # order method _means private method that will only be used inside this class
     def _generate_order_number(self):
@@ -57,15 +80,54 @@ class Order(models.Model):
         self.grand_total = self.order_total + self.delivery_cost
         self.save()
 
+    def add_lineitems_from_bag(self, bag):
+        """
+        Create a line item for every line in the bag with one product query
+        and one bulk insert, then update the order total once.
+        bulk_create skips OrderLineItem.save and its post_save signal, so
+        lineitem_total is worked out here and the total isn't recomputed
+        per line. Raises Product.DoesNotExist if a product has gone.
+        """
+        item_ids = [item_id for item_id in bag.product_ids() if item_id.isdigit()]
+        products = Product.objects.in_bulk(item_ids)
+
+        lineitems = []
+        for line in bag:
+            product = products.get(int(line.item_id)) if line.item_id.isdigit() else None
+            if product is None:
+                raise Product.DoesNotExist(f'Product {line.item_id} does not exist')
+            lineitems.append(OrderLineItem(
+                order=self,
+                product=product,
+                quantity=line.quantity,
+                product_size=line.size,
+                lineitem_total=product.price * line.quantity,
+            ))
+
+        OrderLineItem.objects.bulk_create(lineitems)
+        self.update_total()
+
     # override the default save method
     def save(self, *args, **kwargs):
         """
         Override the original save method to set the order number
-        if it hasn't been set already.
+        if it hasn't been set already. order_number is unique, so in the
+        unlikely event a new number is already taken, try another one.
         """
-        if not self.order_number:
+        if self.order_number:
+            return super().save(*args, **kwargs)
+
+        for attempt in range(self.ORDER_NUMBER_ATTEMPTS):
             self.order_number = self._generate_order_number()
-        super().save(*args, **kwargs)
+            try:
+                # a savepoint, so a clash doesn't break the caller's transaction
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if not Order.objects.filter(order_number=self.order_number).exists():
+                    raise  # some other constraint failed
+        self.order_number = ''
+        raise IntegrityError('Could not generate a unique order number')
 
     # standard string method, returning just the order number for the order model.
     def __str__(self):
@@ -98,3 +160,79 @@ class OrderLineItem(models.Model):
 # And the SKU of the product along with the order number it's part of for each order line item
     def __str__(self):
         return f'SKU {self.product.sku} on order {self.order.order_number}'
+
+
+class WebhookEvent(models.Model):
+    """
+    A verified Stripe webhook event, stored before it is processed so
+    a redelivery of the same event id is recognised and ignored.
+    An event whose handler asked to be tried again later stays pending
+    until next_attempt_at.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.type} {self.event_id}'
+
+
+class OutboundEmail(models.Model):
+    """
+    An email waiting to be sent by send_queued_emails, so requests
+    never wait on the mail server.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    # stops the same email being queued twice, e.g. for a redelivered webhook
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)
+    to = models.CharField(max_length=254)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # set when a worker claims the email; it's sent again if the worker
+    # hasn't finished with it within EMAIL_OUTBOX_LEASE
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    claim = models.CharField(max_length=32, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.subject} to {self.to}'
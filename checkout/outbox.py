@@ -0,0 +1,126 @@
+import logging
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_email(subject, body, to, key=None):
+    """
+    Queue an email for send_queued_emails. If an email with the same
+    key is already queued or sent, nothing is added.
+    """
+    try:
+        # a savepoint, so a duplicate key doesn't break the caller's transaction
+        with transaction.atomic():
+            return OutboundEmail.objects.create(
+                key=key,
+                subject=subject.strip(),
+                body=body,
+                from_email=settings.DEFAULT_FROM_EMAIL or '',
+                to=to,
+            )
+    except IntegrityError:
+        if key and OutboundEmail.objects.filter(key=key).exists():
+            return None
+        raise
+
+
+def _claim(batch_size):
+    """
+    Mark up to batch_size due emails as sending and return them,
+    first releasing any whose lease has run out
+    """
+    now = timezone.now()
+    OutboundEmail.objects.filter(
+        status=OutboundEmail.SENDING,
+        claimed_at__lt=now - timedelta(seconds=settings.EMAIL_OUTBOX_LEASE),
+    ).update(status=OutboundEmail.PENDING)
+
+    due = list(OutboundEmail.objects.filter(
+        status=OutboundEmail.PENDING, next_attempt_at__lte=now,
+    ).order_by('next_attempt_at').values_list('pk', flat=True)[:batch_size])
+    if not due:
+        return []
+    # one conditional update, so two workers can't send the same email;
+    # the token tells this worker which of the due emails it got
+    claim = uuid.uuid4().hex
+    OutboundEmail.objects.filter(pk__in=due, status=OutboundEmail.PENDING).update(
+        status=OutboundEmail.SENDING, claimed_at=now, claim=claim)
+    return list(OutboundEmail.objects.filter(
+        claim=claim, status=OutboundEmail.SENDING).order_by('next_attempt_at'))
+
+
+def _renew(email):
+    """
+    Extend this worker's lease on an email just before sending it, so a
+    slow batch doesn't outlast it. False if the lease ran out part way
+    through the batch and the email has been claimed again since.
+    """
+    return OutboundEmail.objects.filter(
+        pk=email.pk, claim=email.claim, status=OutboundEmail.SENDING,
+    ).update(claimed_at=timezone.now()) == 1
+
+
+def _failed(email, error):
+    """ Schedule a retry with exponential backoff, or give up """
+    email.last_error = str(error)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboundEmail.FAILED
+        logger.error('Giving up on email %s: %s', email.pk, error)
+    else:
+        email.status = OutboundEmail.PENDING
+        email.next_attempt_at = timezone.now() + timedelta(
+            seconds=settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1))
+
+
+def send_queued_emails(batch_size=100):
+    """
+    Send a batch of due emails over one mail server connection,
+    skipping any another worker has taken over. A failed email is retried with exponential backoff until it has
+    been tried EMAIL_OUTBOX_MAX_ATTEMPTS times. Returns (sent, failed).
+    """
+    emails = _claim(batch_size)
+    if not emails:
+        return 0, 0
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        connection_error = e
+    else:
+        connection_error = None
+
+    try:
+        for email in emails:
+            if not _renew(email):
+                continue
+            email.attempts += 1
+            try:
+                if connection_error:
+                    raise connection_error
+                EmailMessage(
+                    email.subject, email.body, email.from_email or None, [email.to],
+                    connection=connection).send()
+            except Exception as e:
+                failed += 1
+                _failed(email, e)
+            else:
+                sent += 1
+                email.status = OutboundEmail.SENT
+                email.last_error = ''
+                email.sent_at = timezone.now()
+            email.save(update_fields=[
+                'status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at'])
+    finally:
+        connection.close()
+    return sent, failed
@@ -0,0 +1,248 @@
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from django.conf import settings
+
+from boutique_ado import metrics
+
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(stripe.error.APIConnectionError):
+    """ Raised instead of calling Stripe while the circuit is open """
+
+
+class CircuitBreaker:
+    """
+    Open after `threshold` consecutive failures and reject calls until
+    `cooldown` seconds have passed, then let one trial call through.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < settings.STRIPE_BREAKER_COOLDOWN:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self):
+        with self._lock:
+            if self.state == 'open':
+                raise CircuitOpenError('Stripe is unavailable, please try again shortly')
+            if self.state == 'half-open':
+                # only one trial call at a time; others fail fast until it returns
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= settings.STRIPE_BREAKER_THRESHOLD:
+                self.opened_at = time.monotonic()
+
+
+# All calls to Stripe go through the functions below, so they share one
+# pooled session, one circuit breaker and the latency histograms.
+breaker = CircuitBreaker()
+_histograms = {}
+_histograms_lock = threading.Lock()
+_client_lock = threading.Lock()
+_client_backend = None
+
+
+def _histogram(operation):
+    with _histograms_lock:
+        if operation not in _histograms:
+            _histograms[operation] = metrics.Histogram()
+        return _histograms[operation]
+
+
+def histograms():
+    """ (operation, histogram) pairs for every Stripe operation called """
+    with _histograms_lock:
+        return sorted(_histograms.items())
+
+
+def latency_stats():
+    """ Latency histograms and p50/p95/p99 for each Stripe operation """
+    stats = {}
+    for operation, histogram in histograms():
+        stats[operation] = histogram.snapshot()
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[operation][name] = histogram.percentile(fraction)
+    return stats
+
+
+def _configure():
+    """ Point Stripe at a pooled requests session, or the fake backend """
+    global _client_backend
+    with _client_lock:
+        if _client_backend == settings.STRIPE_BACKEND:
+            return
+        if settings.STRIPE_BACKEND == 'fake':
+            stripe.default_http_client = FakeStripeClient()
+        else:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_maxsize=settings.STRIPE_POOL_SIZE))
+            stripe.default_http_client = stripe.http_client.RequestsClient(
+                timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+                session=session)
+        stripe.max_network_retries = settings.STRIPE_MAX_NETWORK_RETRIES
+        _client_backend = settings.STRIPE_BACKEND
+
+
+def _api_key():
+    # the fake backend doesn't check keys, so offline runs don't need one
+    if settings.STRIPE_BACKEND == 'fake':
+        return settings.STRIPE_SECRET_KEY or 'sk_test_fake'
+    return settings.STRIPE_SECRET_KEY
+
+
+def _call(operation, func, *args, **kwargs):
+    """
+    Call the Stripe SDK through the circuit breaker, timing the call.
+    Only connection and server errors count towards opening the
+    circuit; a declined card or bad request means Stripe is up.
+    """
+    _configure()
+    breaker.before_call()
+    started = time.perf_counter()
+    error = True
+    try:
+        result = func(*args, api_key=_api_key(), **kwargs)
+        error = False
+    except (stripe.error.APIConnectionError, stripe.error.APIError):
+        breaker.record_failure()
+        raise
+    except stripe.error.StripeError:
+        breaker.record_success()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _histogram(operation).observe(elapsed, error=error)
+        metrics.observe_stripe(elapsed)
+    breaker.record_success()
+    return result
+
+
+def create_payment_intent(**params):
+    return _call('PaymentIntent.create', stripe.PaymentIntent.create, **params)
+
+
+def modify_payment_intent(pid, **params):
+    return _call('PaymentIntent.modify', stripe.PaymentIntent.modify, pid, **params)
+
+
+def retrieve_payment_intent(pid):
+    return _call('PaymentIntent.retrieve', stripe.PaymentIntent.retrieve, pid)
+
+
+def construct_event(payload, sig_header):
+    """ Verify a webhook's signature and return its event; no network call """
+    return stripe.Webhook.construct_event(
+        payload, sig_header, settings.STRIPE_WH_SECRET, api_key=_api_key())
+
+
+def event_from_dict(data):
+    """ Rebuild an event that was verified and stored earlier """
+    return stripe.Event.construct_from(data, _api_key())
+
+
+class FakeStripeClient(stripe.http_client.HTTPClient):
+    """
+    Answers the PaymentIntent calls checkout makes from memory instead
+    of the network, after STRIPE_FAKE_LATENCY seconds (with up to
+    STRIPE_FAKE_LATENCY_JITTER more), for offline load testing.
+    Posting to /confirm marks an intent as succeeded.
+    """
+
+    name = 'fake'
+    PATH = re.compile(r'^/v1/payment_intents(?:/(?P<pid>[^/]+))?(?:/(?P<action>\w+))?$')
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self.intents = {}
+
+    def _sleep(self):
+        latency = settings.STRIPE_FAKE_LATENCY
+        jitter = settings.STRIPE_FAKE_LATENCY_JITTER
+        if latency or jitter:
+            time.sleep(latency + random.uniform(0, jitter))
+
+    @staticmethod
+    def _params(post_data):
+        """ Decode form data, turning metadata[bag]=... into nested dicts """
+        params = {}
+        for key, value in parse_qsl(post_data or '', keep_blank_values=True):
+            match = re.match(r'^(\w+)\[(\w+)\]$', key)
+            if match:
+                params.setdefault(match.group(1), {})[match.group(2)] = value
+            else:
+                params[key] = int(value) if value.isdigit() else value
+        return params
+
+    @staticmethod
+    def _response(body, status=200):
+        return json.dumps(body), status, {'Request-Id': f'req_fake_{secrets.token_hex(8)}'}
+
+    def _error(self, status, message):
+        return self._response(
+            {'error': {'type': 'invalid_request_error', 'message': message}}, status)
+
+    def request(self, method, url, headers, post_data=None):
+        self._sleep()
+        match = self.PATH.match(urlsplit(url).path)
+        if not match:
+            return self._error(404, f'Unrecognized request URL ({method.upper()}: {url})')
+        pid, action = match.group('pid'), match.group('action')
+        params = self._params(post_data)
+
+        with self._lock:
+            if pid is None and method == 'post':
+                pid = f'pi_fake_{secrets.token_hex(12)}'
+            elif pid is None:
+                return self._error(405, 'Listing payment intents is not supported')
+            if pid not in self.intents:
+                # intents created by another process's fake are recreated,
+                # so several workers can share one load test
+                self.intents[pid] = {
+                    'id': pid,
+                    'object': 'payment_intent',
+                    'client_secret': f'{pid}_secret_{secrets.token_hex(12)}',
+                    'status': 'requires_payment_method',
+                    'metadata': {},
+                    'created': int(time.time()),
+                }
+            intent = self.intents[pid]
+
+            if method == 'post':
+                if intent['status'] in ('succeeded', 'canceled'):
+                    return self._error(
+                        400, f'This PaymentIntent has a status of {intent["status"]} '
+                             'and cannot be updated.')
+                intent.setdefault('metadata', {}).update(params.pop('metadata', {}))
+                intent.update(params)
+                if action == 'confirm':
+                    intent['status'] = 'succeeded'
+            return self._response(dict(intent))
+
+    def close(self):
+        pass
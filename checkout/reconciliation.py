@@ -0,0 +1,68 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class RetryScheduler:
+    """
+    Run delayed jobs on a single background thread.
+
+    Jobs wait in a heap ordered by due time, so the webhook inbox can
+    come back to a deferred event without a worker sleeping on it.
+    The heap is lost if the process stops, so it only ever holds
+    wake-ups for work that's also recorded in the database.
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, func, *args):
+        """ Run func(*args) on the scheduler thread after delay seconds """
+        with self._condition:
+            heapq.heappush(
+                self._jobs, (time.monotonic() + delay, next(self._counter), func, args))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='checkout-retry-scheduler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._jobs:
+                    wait = self._jobs[0][0] - time.monotonic()
+                    if wait <= 0:
+                        return heapq.heappop(self._jobs)
+                    self._condition.wait(wait)
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            due, count, func, args = self._next_job()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Scheduled job %s failed', getattr(func, '__name__', func))
+            finally:
+                # the job ran outside a request, so nothing else will close
+                # the database connection this thread opened
+                connections.close_all()
+
+
+scheduler = RetryScheduler()
+
@@ -1,3 +1,555 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from decimal import Decimal
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.http import HttpResponse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import stripe
+
+from bag.bag import Bag
+from boutique_ado.testing import BAG_LINES, QueryBudgetTestCase
+from products.models import Category, Product
+from profiles.models import UserProfile
+from . import inbox, outbox, payments
+from .inbox import process_event
+from .intents import METADATA_LOCK_KEY, update_payment_intent_metadata
+from .management.commands.process_webhook_events import Command as ProcessWebhookEvents
+from .models import Order, OutboundEmail, WebhookEvent
+from .outbox import enqueue_email, send_queued_emails
+from .webhook_handler import StripeWH_Handler
+
+
+class OrderLineItemBatchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.products = [
+            Product.objects.create(
+                category=category, name=f'Shirt {i}', description='A shirt', price='10.00')
+            for i in range(10)
+        ]
+
+    def _order(self):
+        return Order.objects.create(
+            full_name='Test Buyer', email='buyer@example.com', phone_number='123',
+            country='IE', town_or_city='Dublin', street_address1='1 Main St')
+
+    def test_query_count_does_not_grow_with_lines(self):
+        for count in (1, 10):
+            bag = Bag()
+            for product in self.products[:count]:
+                bag.add(product.id, 2, 'm')
+            order = self._order()
+            # product fetch, bulk insert, total aggregate, order update
+            with self.assertNumQueries(4):
+                order.add_lineitems_from_bag(bag)
+            self.assertEqual(order.lineitems.count(), count)
+            self.assertEqual(order.order_total, Decimal('20.00') * count)
+
+    def test_missing_product_raises(self):
+        bag = Bag()
+        bag.add(self.products[0].id, 1)
+        bag.add('999999', 1)
+        with self.assertRaises(Product.DoesNotExist):
+            self._order().add_lineitems_from_bag(bag)
+
+
+class PaymentIntentReconciliationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.product = Product.objects.create(
+            category=category, name='Shirt', description='A shirt', price='10.00')
+
+    def _event(self, pid='pi_test', save_info='', username='AnonymousUser'):
+        bag = Bag()
+        bag.add(self.product.id, 2)
+        address = {
+            'city': 'Dublin', 'country': 'IE', 'line1': '1 Main St', 'line2': '',
+            'postal_code': '', 'state': '',
+        }
+        return stripe.Event.construct_from({
+            'type': 'payment_intent.succeeded',
+            'data': {'object': {
+                'id': pid,
+                'metadata': {'bag': bag.dumps(), 'save_info': save_info, 'username': username},
+                'charges': {'data': [{
+                    'amount': 2200,
+                    'billing_details': {'email': 'buyer@example.com'},
+                }]},
+                'shipping': {'name': 'Test Buyer', 'phone': '123', 'address': address},
+            }},
+        }, None)
+
+    def test_existing_order_is_verified_by_stripe_pid(self):
+        Order.objects.create(
+            full_name='Test Buyer', email='buyer@example.com', phone_number='123',
+            country='IE', town_or_city='Dublin', street_address1='1 Main St',
+            stripe_pid='pi_test')
+        response = StripeWH_Handler(None).handle_payment_intent_succeeded(self._event())
+        self.assertContains(response, 'Verified order already in database')
+        # the confirmation is queued, not sent, by the webhook
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboundEmail.objects.get().to, 'buyer@example.com')
+
+    def test_missing_order_is_deferred(self):
+        attempt = settings.STRIPE_WH_RECONCILE_ATTEMPTS - 1
+        response = StripeWH_Handler(None, attempt).handle_payment_intent_succeeded(self._event())
+        self.assertContains(response, 'DEFERRED', status_code=202)
+        self.assertFalse(Order.objects.exists())
+
+    def test_profile_is_only_updated_once_the_order_exists(self):
+        user = User.objects.create_user('shopper', 'buyer@example.com', 'password')
+        event = self._event(save_info='true', username='shopper')
+        attempt = settings.STRIPE_WH_RECONCILE_ATTEMPTS - 1
+        with mock.patch.object(UserProfile, 'save') as save:
+            StripeWH_Handler(None, attempt).handle_payment_intent_succeeded(event)
+        save.assert_not_called()
+
+        StripeWH_Handler(None, attempt + 1).handle_payment_intent_succeeded(event)
+        user.userprofile.refresh_from_db()
+        self.assertEqual(user.userprofile.default_town_or_city, 'Dublin')
+
+    def test_final_attempt_creates_order(self):
+        attempt = settings.STRIPE_WH_RECONCILE_ATTEMPTS
+        response = StripeWH_Handler(None, attempt).handle_payment_intent_succeeded(self._event())
+        self.assertContains(response, 'Created order in webhook')
+        order = Order.objects.get(stripe_pid='pi_test')
+        self.assertEqual(order.lineitems.get().quantity, 2)
+
+    def test_deferred_event_stays_in_the_inbox(self):
+        event = self._event()
+        event_record = WebhookEvent.objects.create(
+            event_id='evt_deferred', type=event.type, payload=json.dumps(event.to_dict_recursive()))
+        for attempt in range(1, settings.STRIPE_WH_RECONCILE_ATTEMPTS):
+            self.assertEqual(process_event(event_record.pk), WebhookEvent.PENDING)
+            event_record.refresh_from_db()
+            self.assertGreater(event_record.next_attempt_at, timezone.now())
+            # not claimed again before it's due
+            self.assertIsNone(process_event(event_record.pk))
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertFalse(Order.objects.exists())
+
+        self.assertEqual(process_event(event_record.pk), WebhookEvent.SUCCEEDED)
+        self.assertTrue(Order.objects.filter(stripe_pid='pi_test').exists())
+        event_record.refresh_from_db()
+        self.assertEqual(event_record.attempts, settings.STRIPE_WH_RECONCILE_ATTEMPTS)
+
+    @override_settings(STRIPE_WH_WORKER_MODE='thread')
+    def test_deferred_event_is_woken_up(self):
+        future = Future()
+        future.set_result(WebhookEvent.PENDING)
+        with mock.patch('checkout.inbox._get_executor') as executor, \
+                mock.patch('checkout.inbox.scheduler') as scheduler:
+            executor.return_value.submit.return_value = future
+            inbox.enqueue(1)
+        scheduler.schedule.assert_called_once_with(
+            settings.STRIPE_WH_RECONCILE_DELAY, inbox.enqueue, 1)
+
+
+@override_settings(STRIPE_WH_SECRET='whsec_test', STRIPE_WH_WORKER_MODE='command')
+class WebhookInboxTests(TestCase):
+
+    def _post(self, event):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(
+            b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    def _event(self, event_id='evt_1'):
+        return {'id': event_id, 'object': 'event', 'type': 'charge.refunded', 'data': {'object': {}}}
+
+    def test_event_is_stored_once(self):
+        with mock.patch('checkout.inbox.enqueue') as enqueue:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertContains(self._post(self._event()), 'QUEUED')
+            self.assertContains(self._post(self._event()), 'DUPLICATE')
+        event_record = WebhookEvent.objects.get()
+        enqueue.assert_called_once_with(event_record.pk)
+        self.assertEqual(event_record.status, WebhookEvent.PENDING)
+
+    def test_bad_signature_is_rejected(self):
+        response = self.client.post(
+            reverse('webhook'), json.dumps(self._event()), content_type='application/json',
+            HTTP_STRIPE_SIGNATURE='t=1,v1=bad')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_failed_event_can_be_replayed(self):
+        self._post(self._event())
+        event_record = WebhookEvent.objects.get()
+        with mock.patch('checkout.webhooks.dispatch_event', side_effect=ValueError('boom')), \
+                self.assertLogs('checkout.inbox', 'WARNING'):
+            self.assertEqual(process_event(event_record.pk), WebhookEvent.FAILED)
+        event_record.refresh_from_db()
+        self.assertEqual(event_record.last_error, 'boom')
+
+        self.assertEqual(process_event(event_record.pk), WebhookEvent.SUCCEEDED)
+        # already handled, so it isn't claimed again
+        self.assertIsNone(process_event(event_record.pk))
+        event_record.refresh_from_db()
+        self.assertEqual(event_record.attempts, 2)
+
+    def test_old_event_is_not_released_while_processing(self):
+        self._post(self._event())
+        event_record = WebhookEvent.objects.get()
+        WebhookEvent.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+
+        def dispatch(event, attempt):
+            # the command's sweep for events a dead worker left processing
+            queued = ProcessWebhookEvents()._queued(replay_failed=False, stale_after=600)
+            self.assertEqual(queued, [])
+            self.assertEqual(WebhookEvent.objects.get().status, WebhookEvent.PROCESSING)
+            return HttpResponse()
+
+        with mock.patch('checkout.webhooks.dispatch_event', side_effect=dispatch):
+            self.assertEqual(process_event(event_record.pk), WebhookEvent.SUCCEEDED)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class EmailOutboxTests(TestCase):
+
+    def test_batch_is_sent_over_one_connection(self):
+        for i in range(3):
+            enqueue_email(f'Order {i}', 'Thanks', f'buyer{i}@example.com', key=f'order:{i}')
+        # queuing the same key again is ignored
+        self.assertIsNone(enqueue_email('Order 0', 'Thanks', 'buyer0@example.com', key='order:0'))
+
+        with mock.patch('checkout.outbox.get_connection', wraps=get_connection) as connect:
+            self.assertEqual(send_queued_emails(), (3, 0))
+        connect.assert_called_once()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 3)
+        self.assertEqual(send_queued_emails(), (0, 0))
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_email_backs_off_then_gives_up(self):
+        email = enqueue_email('Order', 'Thanks', 'buyer@example.com')
+        with mock.patch('django.core.mail.EmailMessage.send', side_effect=OSError('down')):
+            self.assertEqual(send_queued_emails(), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual(email.status, OutboundEmail.PENDING)
+            self.assertGreater(email.next_attempt_at, timezone.now())
+            # not due again yet
+            self.assertEqual(send_queued_emails(), (0, 0))
+
+            OutboundEmail.objects.update(next_attempt_at=timezone.now())
+            with self.assertLogs('checkout.outbox', 'ERROR'):
+                self.assertEqual(send_queued_emails(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.FAILED)
+        self.assertEqual(email.last_error, 'down')
+
+    def test_emails_left_sending_are_sent_again(self):
+        for i in range(3):
+            enqueue_email(f'Order {i}', 'Thanks', f'buyer{i}@example.com')
+        # as if a worker claimed them and died before sending
+        with mock.patch('checkout.outbox.get_connection', side_effect=SystemExit):
+            with self.assertRaises(SystemExit):
+                send_queued_emails()
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENDING).count(), 3)
+
+        # left alone while the lease lasts
+        self.assertEqual(send_queued_emails(), (0, 0))
+        OutboundEmail.objects.update(
+            claimed_at=timezone.now() - timedelta(seconds=settings.EMAIL_OUTBOX_LEASE + 1))
+        # the release, the due emails, the claim and the claimed emails
+        with self.assertNumQueries(4):
+            emails = outbox._claim(100)
+        self.assertEqual(len(emails), 3)
+        self.assertEqual(outbox._claim(100), [])
+
+
+    def test_emails_reclaimed_during_a_slow_batch_are_skipped(self):
+        for i in range(3):
+            enqueue_email(f'Order {i}', 'Thanks', f'buyer{i}@example.com')
+
+        def slow_send(message):
+            # the lease runs out and another worker claims the rest
+            OutboundEmail.objects.exclude(to=message.to[0]).update(claim='other')
+            mail.outbox.append(message)
+            return 1
+
+        with mock.patch('django.core.mail.EmailMessage.send', autospec=True, side_effect=slow_send):
+            self.assertEqual(send_queued_emails(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(OutboundEmail.objects.filter(claim='other', attempts=0).count(), 2)
+
+
+class PaymentIntentReuseTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.product = Product.objects.create(
+            category=category, name='Shirt', description='A shirt', price='10.00')
+
+    def _set_quantity(self, quantity):
+        session = self.client.session
+        bag = Bag()
+        bag.add(self.product.id, quantity)
+        bag.save(session)
+        session.save()
+
+    def test_reload_reuses_and_bag_change_modifies(self):
+        intent = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_1', 'client_secret': 'pi_1_secret_x'}, None)
+        self._set_quantity(1)
+        with mock.patch('stripe.PaymentIntent.create', return_value=intent) as create, \
+                mock.patch('stripe.PaymentIntent.modify', return_value=intent) as modify:
+            for i in range(3):
+                response = self.client.get(reverse('checkout'))
+                self.assertEqual(response.context['client_secret'], 'pi_1_secret_x')
+            create.assert_called_once()
+            modify.assert_not_called()
+
+            self._set_quantity(2)
+            self.client.get(reverse('checkout'))
+            self.client.get(reverse('checkout'))
+            create.assert_called_once()
+            # 2 shirts plus 10% delivery
+            modify.assert_called_once_with('pi_1', api_key=settings.STRIPE_SECRET_KEY, amount=2200)
+
+    def test_paid_intent_is_not_reused(self):
+        paid = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_1', 'client_secret': 'pi_1_secret_x'}, None)
+        fresh = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_2', 'client_secret': 'pi_2_secret_y'}, None)
+        self._set_quantity(1)
+        with mock.patch('stripe.PaymentIntent.create', side_effect=[paid, fresh]) as create, \
+                mock.patch('stripe.PaymentIntent.modify') as modify:
+            self.client.get(reverse('checkout'))
+            # the webhook made the order, but the session still has the intent
+            Order.objects.create(
+                full_name='Test Buyer', email='buyer@example.com', phone_number='123',
+                country='IE', town_or_city='Dublin', street_address1='1 Main St',
+                stripe_pid='pi_1')
+            response = self.client.get(reverse('checkout'))
+            self.assertEqual(response.context['client_secret'], 'pi_2_secret_y')
+            self.assertEqual(create.call_count, 2)
+            modify.assert_not_called()
+
+    def test_intent_is_checked_once_a_payment_was_attempted(self):
+        intent = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_1', 'client_secret': 'pi_1_secret_x'}, None)
+        fresh = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_2', 'client_secret': 'pi_2_secret_y'}, None)
+        self._set_quantity(1)
+        with mock.patch('stripe.PaymentIntent.create', side_effect=[intent, fresh]) as create, \
+                mock.patch('stripe.PaymentIntent.modify'), \
+                mock.patch('stripe.PaymentIntent.retrieve') as retrieve:
+            self.client.get(reverse('checkout'))
+            self.client.get(reverse('checkout'))
+            retrieve.assert_not_called()
+
+            # the card is charged, but the checkout form never posts
+            self.client.post(reverse('cache_checkout_data'), {
+                'client_secret': 'pi_1_secret_x', 'save_info': 'false'})
+            retrieve.return_value = stripe.PaymentIntent.construct_from(
+                {'id': 'pi_1', 'status': 'requires_payment_method'}, None)
+            response = self.client.get(reverse('checkout'))
+            self.assertEqual(response.context['client_secret'], 'pi_1_secret_x')
+
+            retrieve.return_value = stripe.PaymentIntent.construct_from(
+                {'id': 'pi_1', 'status': 'succeeded'}, None)
+            response = self.client.get(reverse('checkout'))
+            self.assertEqual(response.context['client_secret'], 'pi_2_secret_y')
+            self.assertEqual(create.call_count, 2)
+            self.assertEqual(retrieve.call_count, 2)
+
+            # and the new intent hasn't been used to pay yet
+            self.client.get(reverse('checkout'))
+            self.assertEqual(retrieve.call_count, 2)
+
+    def test_different_bag_with_the_same_total_is_not_reused(self):
+        other = Product.objects.create(
+            category=self.product.category, name='Other shirt', description='A shirt', price='10.00')
+        intent = stripe.PaymentIntent.construct_from(
+            {'id': 'pi_1', 'client_secret': 'pi_1_secret_x'}, None)
+        self._set_quantity(1)
+        with mock.patch('stripe.PaymentIntent.create', return_value=intent) as create, \
+                mock.patch('stripe.PaymentIntent.modify', return_value=intent) as modify:
+            self.client.get(reverse('checkout'))
+            session = self.client.session
+            bag = Bag()
+            bag.add(other.id, 1)
+            bag.save(session)
+            session.save()
+            self.client.get(reverse('checkout'))
+            create.assert_called_once()
+            modify.assert_called_once_with('pi_1', api_key=settings.STRIPE_SECRET_KEY, amount=1100)
+
+
+@override_settings(STRIPE_BACKEND='fake', STRIPE_BREAKER_THRESHOLD=2)
+class PaymentsClientTests(TestCase):
+
+    def setUp(self):
+        payments.breaker.record_success()
+
+    def test_fake_backend_round_trip(self):
+        intent = payments.create_payment_intent(amount=1000, currency='usd')
+        self.assertTrue(intent.client_secret.startswith(f'{intent.id}_secret_'))
+        intent = payments.modify_payment_intent(intent.id, amount=1500, metadata={'bag': '{}'})
+        self.assertEqual((intent.amount, intent.metadata.bag), (1500, '{}'))
+
+        stripe.default_http_client.intents[intent.id]['status'] = 'succeeded'
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            payments.modify_payment_intent(intent.id, amount=2000)
+        self.assertEqual(payments.latency_stats()['PaymentIntent.modify']['errors'], 1)
+        self.assertEqual(payments.breaker.state, 'closed')
+
+    def test_breaker_opens_after_connection_errors(self):
+        failing = mock.Mock(side_effect=stripe.error.APIConnectionError('down'))
+        for i in range(2):
+            with self.assertRaises(stripe.error.APIConnectionError):
+                payments._call('test', failing)
+        with self.assertRaises(payments.CircuitOpenError):
+            payments._call('test', failing)
+        self.assertEqual(failing.call_count, 2)
+
+        with override_settings(STRIPE_BREAKER_COOLDOWN=0):
+            self.assertEqual(payments._call('test', mock.Mock(return_value='ok')), 'ok')
+        self.assertEqual(payments.breaker.state, 'closed')
+
+
+# a cache of its own, so the test doesn't depend on REDIS_URL
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PaymentIntentMetadataTests(TestCase):
+
+    def setUp(self):
+        self.pid = f'pi_{uuid.uuid4().hex}'
+        self.bag = Bag()
+        self.bag.add('1', 2)
+
+    def test_unchanged_metadata_is_not_resent(self):
+        with mock.patch('checkout.payments.modify_payment_intent') as modify:
+            self.assertTrue(update_payment_intent_metadata(self.pid, self.bag, 'true', 'AnonymousUser'))
+            self.assertFalse(update_payment_intent_metadata(self.pid, self.bag, 'true', 'AnonymousUser'))
+            self.assertTrue(update_payment_intent_metadata(self.pid, self.bag, 'false', 'AnonymousUser'))
+        self.assertEqual(modify.call_count, 2)
+
+    def test_concurrent_updates_are_coalesced(self):
+        def slow_modify(pid, metadata):
+            time.sleep(0.1)
+
+        with mock.patch('checkout.payments.modify_payment_intent', side_effect=slow_modify) as modify:
+            threads = [
+                threading.Thread(
+                    target=update_payment_intent_metadata,
+                    args=(self.pid, self.bag, 'true', 'AnonymousUser'))
+                for i in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        modify.assert_called_once()
+
+    @override_settings(CHECKOUT_METADATA_LOCK_WAIT=0.1)
+    def test_held_lock_is_waited_for_briefly_and_left_alone(self):
+        lock_key = METADATA_LOCK_KEY.format(self.pid)
+        cache.add(lock_key, 'other-request', 60)
+        started = time.monotonic()
+        with mock.patch('checkout.payments.modify_payment_intent') as modify:
+            self.assertTrue(update_payment_intent_metadata(self.pid, self.bag, 'true', 'AnonymousUser'))
+        self.assertLess(time.monotonic() - started, 1)
+        modify.assert_called_once()
+        self.assertEqual(cache.get(lock_key), 'other-request')
+        cache.delete(lock_key)
+
+
+class OrderIndexTests(TestCase):
+
+    def _order(self, **kwargs):
+        return Order.objects.create(
+            full_name='Test Buyer', email='buyer@example.com', phone_number='123',
+            country='IE', town_or_city='Dublin', street_address1='1 Main St', **kwargs)
+
+    def assertUsesIndex(self, queryset, column):
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite':
+            self.assertRegex(plan, rf'SEARCH .*USING (COVERING )?INDEX .*\({column}=\?\)')
+        elif connection.vendor == 'postgresql':
+            self.assertIn('Index', plan)
+        self.assertNotIn('SCAN checkout_order', plan)
+
+    def test_lookups_use_indexes(self):
+        self.assertUsesIndex(Order.objects.filter(order_number='ABC'), 'order_number')
+        self.assertUsesIndex(Order.objects.filter(stripe_pid='pi_test'), 'stripe_pid')
+
+    def test_lean_orders_leave_out_the_bag(self):
+        order = self._order(original_bag='{"v":2,"lines":[]}')
+        with CaptureQueriesContext(connection) as queries:
+            lean = Order.objects.lean().get(pk=order.pk)
+            lean.full_name = 'New Name'
+            lean.save()
+        self.assertNotIn('original_bag', ' '.join(query['sql'] for query in queries))
+        order.refresh_from_db()
+        self.assertEqual((order.full_name, order.original_bag), ('New Name', '{"v":2,"lines":[]}'))
+
+    def test_order_number_clash_is_retried(self):
+        taken = self._order().order_number
+        numbers = iter([taken, 'NEW'])
+        with mock.patch.object(Order, '_generate_order_number', side_effect=lambda: next(numbers)):
+            order = self._order()
+        self.assertEqual(order.order_number, 'NEW')
+
+
+class CheckoutQueryBudgetTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.login()
+        self.fill_bag()
+
+    def test_checkout_flow(self):
+        response = self.assertQueryBudget(7, reverse('checkout'), status=200)
+        client_secret = response.context['client_secret']
+        # the user, and marking the session's intent as submitted
+        self.assertQueryBudget(4, reverse('cache_checkout_data'), {
+            'client_secret': client_secret, 'save_info': 'true',
+        }, method='post', status=200)
+        response = self.assertQueryBudget(12, reverse('checkout'), {
+            'full_name': 'Shopper', 'email': 'shopper@example.com',
+            'phone_number': '0123456789', 'country': 'IE', 'postcode': '',
+            'town_or_city': 'Dublin', 'street_address1': '1 Main Street',
+            'street_address2': '', 'county': '', 'client_secret': client_secret,
+            'save-info': 'on',
+        }, method='post', status=302)
+        order = Order.objects.get(stripe_pid=client_secret.split('_secret')[0])
+        self.assertEqual(order.lineitems.count(), BAG_LINES)
+        self.assertQueryBudget(9, response.url, status=200)
+
+    def test_webhook(self):
+        payload = json.dumps({
+            'id': 'evt_budget', 'object': 'event', 'type': 'payment_intent.succeeded',
+            'data': {'object': {'id': self.orders[0].stripe_pid}},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(
+            b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        self.assertQueryBudget(
+            4, reverse('webhook'), payload, method='post', status=200,
+            content_type='application/json', HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
@@ -5,29 +5,38 @@ from django.shortcuts import (
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.conf import settings
+from django.db import transaction
 
 from .forms import OrderForm
-from .models import Order, OrderLineItem
+from .models import Order
+from .intents import (
+    get_payment_intent, forget_payment_intent, mark_payment_intent_submitted,
+    update_payment_intent_metadata
+)
 
 from products.models import Product
 from profiles.models import UserProfile
 from profiles.forms import UserProfileForm
-from bag.contexts import bag_contents
+from bag.bag import Bag
+from bag.contexts import get_bag_contents
 
 import stripe
-import json
 
 
 @require_POST
 def cache_checkout_data(request):
     try:
         pid = request.POST.get('client_secret').split('_secret')[0]
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        stripe.PaymentIntent.modify(pid, metadata={
-            'bag': json.dumps(request.session.get('bag', {})),
-            'save_info': request.POST.get('save_info'),
-            'username': request.user,
-        })
+        # the client confirms the payment next, so it may be paid from now on
+        mark_payment_intent_submitted(request.session, pid)
+        # skipped when this intent already has the same bag and options,
+        # e.g. for a double submit or a retried request
+        update_payment_intent_metadata(
+            pid,
+            Bag.from_session(request.session),
+            request.POST.get('save_info'),
+            request.user,
+        )
         return HttpResponse(status=200)
     except Exception as e:
         messages.error(request, 'Sorry, your payment cannot be \
@@ -37,11 +46,10 @@ def cache_checkout_data(request):
 
 def checkout(request):
     stripe_public_key = settings.STRIPE_PUBLIC_KEY
-    stripe_secret_key = settings.STRIPE_SECRET_KEY
 
     if request.method == 'POST':  # check whether the method is post.That
         # means we should also wrap the current code into an else block to handle the get requests. In the post method code we will need the shopping bag.
-        bag = request.session.get('bag', {})
+        bag = Bag.from_session(request.session)
 
         form_data = {  # form data will be in a dictionary
             'full_name': request.POST['full_name'],
@@ -59,34 +67,19 @@ def checkout(request):
             order = order_form.save(commit=False)  # prevent multiple save events from being executed on the database By adding commit equals false here to prevent the first one from happening
             pid = request.POST.get('client_secret').split('_secret')[0]
             order.stripe_pid = pid
-            order.original_bag = json.dumps(bag)
-            order.save()
-            for item_id, item_data in bag.items():  # then itterate throught the bag items to create each line item
-                try:
-                    product = Product.objects.get(id=item_id)  # first we get the product id out of the bag
-                    if isinstance(item_data, int):  # if no sizes then its just item data
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:  # otherwise we iterate through each size and create a line item accordingly
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-                except Product.DoesNotExist:  # just incase a product isnt found we add an error message
-                    messages.error(request, (
-                        "One of the products in your bag wasn't found in our database. "
-                        "Please call us for assistance!")
-                    )
-                    order.delete()  # delete the empty order
-                    return redirect(reverse('view_bag'))  # and return the user to the shopping bag page
+            order.original_bag = bag.dumps()
+            try:
+                # save the order and all its line items together, so if anything
+                # goes wrong the whole order is rolled back
+                with transaction.atomic():
+                    order.save()
+                    order.add_lineitems_from_bag(bag)
+            except Product.DoesNotExist:  # just incase a product isnt found we add an error message
+                messages.error(request, (
+                    "One of the products in your bag wasn't found in our database. "
+                    "Please call us for assistance!")
+                )
+                return redirect(reverse('view_bag'))  # and return the user to the shopping bag page
 
             request.session['save_info'] = 'save-info' in request.POST  # We'll attach whether or not the user wanted to save their profile information to the session.
             return redirect(reverse('checkout_success', args=[order.order_number]))  # And then redirect them to a new page checkout success and pass it the order number
@@ -94,20 +87,23 @@ def checkout(request):
             messages.error(request, 'There was an error with your form. \
                 Please double check your information.')  # if the order form isnt valid they will be sent back to the checkout pg
     else:
-        bag = request.session.get('bag', {})  # get the bag from the session
+        bag = Bag.from_session(request.session)  # get the bag from the session
         if not bag:
             messages.error(request, "There's nothing in your bag at the moment")
             return redirect(reverse('products'))  # redirect back to the products page
 
         # for stripe
-        current_bag = bag_contents(request)  # for stripe store variable called current bag
+        current_bag = get_bag_contents(request)  # for stripe store variable called current bag
         total = current_bag['grand_total']  # to get the total all I need to do is get the grand_total key out of the current bag.
         stripe_total = round(total * 100)  # I'll multiply that by a hundred and round it to zero decimal places using the round function
-        stripe.api_key = stripe_secret_key  # set the secret key on stripe
-        intent = stripe.PaymentIntent.create(
-            amount=stripe_total,
-            currency=settings.STRIPE_CURRENCY,
-        )
+        # reuses the session's intent when the page is reloaded, so this
+        # usually doesn't need to call stripe at all
+        try:
+            _, client_secret = get_payment_intent(request, bag, stripe_total)
+        except stripe.error.StripeError:
+            messages.error(request, 'Sorry, checkout is unavailable right now. \
+                Please try again later.')
+            return redirect(reverse('view_bag'))
 
         # Attempt to prefill the form with any info the user maintains in their profile
         # check whether the user is authenticated.
@@ -141,7 +137,7 @@ def checkout(request):
     context = {
         'order_form': order_form,  # context containing the order form
         'stripe_public_key': stripe_public_key,
-        'client_secret': intent.client_secret,
+        'client_secret': client_secret,
     }
 
     return render(request, template, context)
@@ -152,7 +148,7 @@ def checkout_success(request, order_number):
     Handle successful checkouts
     """
     save_info = request.session.get('save_info')  # first check whether the user wanted to save their info by getting that from the session 
-    order = get_object_or_404(Order, order_number=order_number)  # use the order number to get the order created in the previous view which we'll send back to the template.
+    order = get_object_or_404(Order.objects.lean().with_lineitems(), order_number=order_number)  # use the order number to get the order created in the previous view which we'll send back to the template.
 
     if request.user.is_authenticated:
         profile = UserProfile.objects.get(user=request.user)
@@ -181,6 +177,7 @@ def checkout_success(request, order_number):
 
     if 'bag' in request.session:
         del request.session['bag']  # delete the user shopping bag from the session
+    forget_payment_intent(request.session)  # the next checkout needs a new payment intent
 
     template = 'checkout/checkout_success.html'
     context = {
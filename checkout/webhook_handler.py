@@ -1,24 +1,23 @@
 from django.http import HttpResponse
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
+from django.db import transaction
 
-from .models import Order, OrderLineItem
-from products.models import Product
+from .models import Order
+from .outbox import enqueue_email
 from profiles.models import UserProfile
-
-import json
-import time
+from bag.bag import Bag
 
 
 class StripeWH_Handler:
     """Handle Stripe webhooks"""
 
-    def __init__(self, request):  # The init method of the class is a setup method that's called every time an instance of the class is created.
+    def __init__(self, request, attempt=1):  # The init method of the class is a setup method that's called every time an instance of the class is created.
         self.request = request  # we're going to use it to assign the request as an attribute of the class just in case we need to access any attributes of the request coming from stripe.
+        self.attempt = attempt  # how many times the inbox has tried this event, counting this one
 
     def _send_confirmation_email(self, order):  # starts with an underscore as will only be used inside this class
-        """Send the user a confirmation email"""
+        """Queue the user a confirmation email"""
         cust_email = order.email
         subject = render_to_string(  # render to strings
             'checkout/confirmation_emails/confirmation_email_subject.txt',
@@ -27,12 +26,9 @@ class StripeWH_Handler:
             'checkout/confirmation_emails/confirmation_email_body.txt',
             {'order': order, 'contact_email': settings.DEFAULT_FROM_EMAIL})
 
-        send_mail(
-            subject,
-            body,
-            settings.DEFAULT_FROM_EMAIL,
-            [cust_email]
-        )
+        # send_queued_emails sends it, so a slow mail server doesn't slow the webhook.
+        # The key means a redelivered webhook doesn't email the customer twice.
+        enqueue_email(subject, body, cust_email, key=f'order-confirmation:{order.order_number}')
 
     def handle_event(self, event):  # create a class method called handle event which will take the event stripe is sending us and simply return an HTTP response indicating it was received.
         """
@@ -42,18 +38,62 @@ class StripeWH_Handler:
             content=f'Unhandled webhook received: {event["type"]}',  
             status=200)  # to designate that the generic handle event method here is receiving the webhook we are otherwise not handling change the content to unhandled webhook receive
 
+    def _get_profile(self, intent):
+        """ The profile of the user who paid, or None for anonymous checkouts """
+        username = intent.metadata.username
+        if username == 'AnonymousUser':
+            return None
+        return UserProfile.objects.get(user__username=username)
+
+    def _update_profile(self, intent):
+        """ Save the shipping details to the user's profile if save_info was checked """
+        shipping_details = intent.shipping
+        profile = self._get_profile(intent)  # None for anonymous users, so they can still checkout.
+        if profile and intent.metadata.save_info:  # If they've got the save info box checked which comes from the metadata. Then we want to update their profile by adding the shipping details as their default delivery information
+            profile.default_phone_number = shipping_details.phone
+            profile.default_country = shipping_details.address.country
+            profile.default_postcode = shipping_details.address.postal_code
+            profile.default_town_or_city = shipping_details.address.city
+            profile.default_street_address1 = shipping_details.address.line1
+            profile.default_street_address2 = shipping_details.address.line2
+            profile.default_county = shipping_details.address.state
+            profile.save()
+
+    def _create_order(self, intent, profile):
+        """ Create the order and its line items from the payment intent """
+        billing_details = intent.charges.data[0].billing_details
+        shipping_details = intent.shipping
+        bag = intent.metadata.bag
+        # create the order and its line items together, so a failure
+        # part way through leaves nothing behind for stripe's retry
+        with transaction.atomic():
+            order = Order.objects.create(
+                full_name=shipping_details.name,
+                # since we've already got their profile and if they weren't logged in it will just be none.
+                # We can simply add it to their order when the webhook creates it.
+                # In this way, the webhook handler can create orders for both authenticated users by attaching their profile.
+                # And for anonymous users by setting that field to none.
+                user_profile=profile,
+                email=billing_details.email,
+                phone_number=shipping_details.phone,
+                country=shipping_details.address.country,
+                postcode=shipping_details.address.postal_code,
+                town_or_city=shipping_details.address.city,
+                street_address1=shipping_details.address.line1,
+                street_address2=shipping_details.address.line2,
+                county=shipping_details.address.state,
+                original_bag=bag,
+                stripe_pid=intent.id,
+            )
+            order.add_lineitems_from_bag(Bag.loads(bag))
+        return order
+
     def handle_payment_intent_succeeded(self, event):  # This will be sent each time a user completes the payment process.
         """
         Handle the payment_intent.succeeded webhook from Stripe
         """
         intent = event.data.object
-        pid = intent.id
-        bag = intent.metadata.bag
-        save_info = intent.metadata.save_info
-
-        billing_details = intent.charges.data[0].billing_details
         shipping_details = intent.shipping
-        grand_total = round(intent.charges.data[0].amount / 100, 2)
 
         # Clean data in the shipping details
         for field, value in shipping_details.address.items():  # to ensure the data is in the same form as what we want in our database. 
@@ -61,96 +101,46 @@ class StripeWH_Handler:
             if value == "":
                 shipping_details.address[field] = None
 
-        # Update profile information if save_info was checked
-        profile = None  # profile set to none. Just so we know we can still allow anonymous users to checkout.
-        username = intent.metadata.username  # get the username
-        if username != 'AnonymousUser':
-            profile = UserProfile.objects.get(user__username=username)  # if not anonymous let's try to get their profile using their username
-            if save_info:  # If they've got the save info box checked which comes from the metadata. Then we want to update their profile by adding the shipping details as their default delivery information
-                profile.default_phone_number = shipping_details.phone
-                profile.default_country = shipping_details.address.country
-                profile.default_postcode = shipping_details.address.postal_code
-                profile.default_town_or_city = shipping_details.address.city
-                profile.default_street_address1 = shipping_details.address.line1
-                profile.default_street_address2 = shipping_details.address.line2
-                profile.default_county = shipping_details.address.state
-                profile.save()
-
-        order_exists = False  # assum the order doesnt exist
-        attempt = 1
-        while attempt <= 5:
-            try:  # try to get the order using all the information from the payment intent. And I'm using the iexact lookup field to make it an exact match but case-insensitive
-                order = Order.objects.get(
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=billing_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True
-                break  # if the order is found break out of the loop
-            except Order.DoesNotExist:
-                attempt += 1
-                time.sleep(1)
-        if order_exists:  # if the order is found we'll set order exists to true and return a 200 HTTP response to stripe, with the message that we verified the order already exists.
+        final_attempt = self.attempt >= settings.STRIPE_WH_RECONCILE_ATTEMPTS
+        response = self.reconcile_payment_intent(event, final_attempt=final_attempt)
+        if response is not None:
+            # only once the order is there, so deferred attempts don't rewrite the profile
+            if response.status_code == 200:
+                self._update_profile(intent)
+            return response
+
+        # The checkout view usually creates the order a moment after the payment
+        # succeeds, so rather than holding this worker while we wait for it, a 202
+        # asks the inbox to keep the event and try it again later. The order is
+        # only created here as a last resort, on the final attempt.
+        return HttpResponse(
+            content=f'Webhook received: {event["type"]} | DEFERRED: Order not in database yet, will check again',
+            status=202)
+
+    def reconcile_payment_intent(self, event, final_attempt):
+        """
+        Find the order for a succeeded payment intent by its stripe_pid,
+        creating it from the intent on the final attempt. Returns None
+        if the order isn't there yet and another attempt should be made.
+        """
+        intent = event.data.object
+        order = Order.objects.lean().filter(stripe_pid=intent.id).first()
+        if order:  # if the order is found return a 200 HTTP response to stripe, with the message that we verified the order already exists.
             self._send_confirmation_email(order)
             return HttpResponse(
                 content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',
                 status=200)
-        else:
-            order = None
-            try:
-                order = Order.objects.create(
-                    full_name=shipping_details.name,
-                    # since we've already got their profile and if they weren't logged in it will just be none.
-                    # We can simply add it to their order when the webhook creates it.
-                    # In this way, the webhook handler can create orders for both authenticated users by attaching their profile.
-                    # And for anonymous users by setting that field to none.
-                    user_profile=profile,
-                    email=billing_details.email,
-                    phone_number=shipping_details.phone,
-                    country=shipping_details.address.country,
-                    postcode=shipping_details.address.postal_code,
-                    town_or_city=shipping_details.address.city,
-                    street_address1=shipping_details.address.line1,
-                    street_address2=shipping_details.address.line2,
-                    county=shipping_details.address.state,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-            except Exception as e:
-                if order:
-                    order.delete()
-                return HttpResponse(
-                    content=f'Webhook received: {event["type"]} | ERROR: {e}',
-                    status=500)
-        self._send_confirmation_email(order)        
-        return HttpResponse(  # if anything goes wrong I'll just delete the order if it was created. And return a 500 server error response to stripe. This will cause stripe to automatically try the webhook again later
+        if not final_attempt:
+            return None
+
+        try:
+            order = self._create_order(intent, self._get_profile(intent))
+        except Exception as e:  # nothing was saved, so return a 500 and the order can be created on a later attempt
+            return HttpResponse(
+                content=f'Webhook received: {event["type"]} | ERROR: {e}',
+                status=500)
+        self._send_confirmation_email(order)
+        return HttpResponse(
             content=f'Webhook received: {event["type"]} | SUCCESS: Created order in webhook',
             status=200)
 
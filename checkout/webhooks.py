@@ -1,8 +1,10 @@
-from django.conf import settings  # to get the webhook and the stripe API secrets
 from django.http import HttpResponse  # so these exception handlers will work
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
+from django.db import transaction
 
+from checkout import inbox, payments
+from checkout.models import WebhookEvent
 from checkout.webhook_handler import StripeWH_Handler  # webhook handler class and stripe
 
 import stripe
@@ -12,19 +14,13 @@ import stripe
 #-------------------- this code is taken directly from stripe -------------------------
 def webhook(request):
     """Listen for webhooks from Stripe"""
-    # Setup
-    wh_secret = settings.STRIPE_WH_SECRET  # change the name of endpoint_secret to wh_secret which we'll create in a moment
-    stripe.api_key = settings.STRIPE_SECRET_KEY  
-
     # Get the webhook data and verify its signature
     payload = request.body
     sig_header = request.META['HTTP_STRIPE_SIGNATURE']  # webhook secret which will be used to verify that the webhook actually came from stripe
     event = None
 
     try:
-        event = stripe.Webhook.construct_event(
-        payload, sig_header, wh_secret
-        )
+        event = payments.construct_event(payload, sig_header)  # checks it against our webhook secret
     except ValueError as e:
         # Invalid payload
         return HttpResponse(status=400)
@@ -35,8 +31,32 @@ def webhook(request):
         return HttpResponse(content=e, status=400)
 
 # -------------------------------- from here is code we have replaced with our own ---------------------
+    # Store the event before doing anything with it. Stripe retries events it
+    # doesn't get a 200 for, so a redelivered event id is only stored once.
+    event_record, created = WebhookEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={'type': event['type'], 'payload': payload.decode()},
+    )
+    if not created:
+        return HttpResponse(
+            content=f'Webhook received: {event["type"]} | DUPLICATE: {event_record.status}',
+            status=200)
+
+    # Process it on the worker pool once the row is committed, so stripe
+    # gets its response without waiting for the handler
+    transaction.on_commit(lambda: inbox.enqueue(event_record.pk))
+    return HttpResponse(
+        content=f'Webhook received: {event["type"]} | QUEUED',
+        status=200)
+
+
+def dispatch_event(event, attempt=1):
+    """
+    Call the handler for a verified event and return its response.
+    A 202 means the handler wants the event tried again later.
+    """
     # Set up a webhook handler
-    handler = StripeWH_Handler(request)  # create an instance of it passing in the request
+    handler = StripeWH_Handler(None, attempt)  # create an instance of it; events are handled outside the request
 
     # Map webhook events to relevant handler functions
     event_map = {  # dictionary called event_map with keys webhooks coming from stripe and values are the actual methods inside the handler
@@ -52,6 +72,4 @@ def webhook(request):
     event_handler = event_map.get(event_type, handler.handle_event)
 
     # Call the event handler with the event
-    response = event_handler(event)
-    return response
-    
\ No newline at end of file
+    return event_handler(event)
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from urllib.parse import urlencode
+
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from django.urls import resolve, reverse
+
+from products.models import Category, Product
+
+from .run_benchmarks import summarize
+
+# wsgi: one request at a time, like a sync worker
+# wsgi-threads: --concurrency threads, like a threaded worker
+# asgi: the sync views under ASGI, which all run on one thread
+# asgi-async: the async views under ASGI
+MODES = ('wsgi', 'wsgi-threads', 'asgi', 'asgi-async')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare how many concurrent requests for the home, product '
+        'listing, product detail and bag pages one worker process can '
+        'serve under WSGI and ASGI, with the sync and the async views. '
+        'Each mode runs in its own process, calling the WSGI or ASGI '
+        'handler directly so no server is measured. --db-latency adds a '
+        'delay to every query, like a database across a network, which '
+        'is the waiting async views can overlap.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', default=','.join(MODES),
+                            help=f'Comma separated, from {", ".join(MODES)}')
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Timed requests per mode')
+        parser.add_argument('--warmup', type=int, default=50,
+                            help='Untimed requests per mode first')
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help='Requests in flight at once, except in wsgi mode')
+        parser.add_argument('--db-latency', type=float, default=0.002,
+                            help='Seconds added to every query')
+        parser.add_argument('--page-cache', action='store_true',
+                            help='Leave BAG_FRAGMENT_MODE on, so most pages come from the cache')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the report to this file instead of stdout')
+        # runs a single mode and prints its result, in the child processes
+        parser.add_argument('--mode', choices=MODES, help='Run just this mode, in this process')
+
+    def _paths(self, rng):
+        products = list(Product.objects.values_list('pk', flat=True)[:1000])
+        categories = list(Category.objects.values_list('name', flat=True))
+        if not products:
+            raise CommandError('There are no products; fill the database with generate_catalog first')
+        paths = [reverse('home'), reverse('view_bag')]
+        for _ in range(20):
+            paths.append(reverse('product_detail', args=[rng.choice(products)]))
+            params = {'sort': rng.choice(('price', 'rating', 'name')),
+                      'direction': rng.choice(('asc', 'desc'))}
+            if categories:
+                params['category'] = rng.choice(categories)
+            paths.append(f'{reverse("products")}?{urlencode(params)}')
+        paths.append(f'{reverse("products")}?q=shirt')
+        return paths
+
+    def _delay_queries(self, latency):
+        def wrapper(execute, sql, params, many, context):
+            time.sleep(latency)
+            return execute(sql, params, many, context)
+
+        def instrument(connection, **kwargs):
+            # sent again every time a wrapper reconnects
+            if wrapper not in connection.execute_wrappers:
+                connection.execute_wrappers.append(wrapper)
+
+        connection_created.connect(instrument, weak=False, dispatch_uid='asgi_benchmark')
+        for conn in connections.all():
+            if conn.connection is not None:
+                instrument(conn)
+
+    # One mode, run in this process
+
+    def _wsgi(self, paths, options, threads):
+        handler = WSGIHandler()
+
+        def request(path):
+            path_info, _, query_string = path.partition('?')
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path_info, 'QUERY_STRING': query_string,
+                'SCRIPT_NAME': '', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'localhost', 'REMOTE_ADDR': '127.0.0.1',
+                'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(),
+                'wsgi.errors': sys.stderr, 'wsgi.multithread': threads > 1,
+                'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            }
+            status = []
+            started = time.perf_counter()
+            response = handler(environ, lambda s, headers, exc_info=None: status.append(s))
+            try:
+                b''.join(response)
+            finally:
+                # sends request_finished, which closes old connections
+                response.close()
+            return time.perf_counter() - started, int(status[0].split()[0]) >= 400
+
+        def work(count, offset):
+            results = [request(paths[(offset + i) % len(paths)]) for i in range(count)]
+            connections.close_all()
+            return results
+
+        def run(count):
+            shares = [count // threads + (i < count % threads) for i in range(threads)]
+            with ThreadPoolExecutor(threads) as pool:
+                futures = [pool.submit(work, share, i * 7) for i, share in enumerate(shares)]
+                return [result for future in futures for result in future.result()]
+
+        run(options['warmup'])
+        started = time.perf_counter()
+        results = run(options['requests'])
+        return results, time.perf_counter() - started
+
+    def _asgi(self, paths, options):
+        handler = ASGIHandler()
+
+        async def request(path):
+            path_info, _, query_string = path.partition('?')
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': 'GET', 'scheme': 'http', 'path': path_info,
+                'raw_path': path_info.encode(), 'query_string': query_string.encode(),
+                'root_path': '', 'headers': [(b'host', b'localhost')],
+                'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+            }
+            status = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            started = time.perf_counter()
+            await handler(scope, receive, send)
+            return time.perf_counter() - started, status[0] >= 400
+
+        async def work(count, offset):
+            return [await request(paths[(offset + i) % len(paths)]) for i in range(count)]
+
+        async def run(count):
+            tasks = options['concurrency']
+            shares = [count // tasks + (i < count % tasks) for i in range(tasks)]
+            batches = await asyncio.gather(*(work(share, i * 7) for i, share in enumerate(shares)))
+            return [result for batch in batches for result in batch]
+
+        async def main():
+            await run(options['warmup'])
+            started = time.perf_counter()
+            results = await run(options['requests'])
+            return results, time.perf_counter() - started
+
+        return asyncio.run(main())
+
+    def _run_mode(self, mode, options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        rng = random.Random(options['seed'])
+        paths = self._paths(rng)
+        rng.shuffle(paths)
+
+        uses_async_views = asyncio.iscoroutinefunction(resolve(reverse('products')).func)
+        if mode == 'asgi-async' and not uses_async_views:
+            raise CommandError('The async views are off; run it with ASYNC_VIEWS=True')
+        if mode != 'asgi-async' and uses_async_views:
+            raise CommandError('The async views are on; run it with ASYNC_VIEWS=False')
+        # pool and request threads open their own connections
+        connections.close_all()
+        if options['db_latency']:
+            self._delay_queries(options['db_latency'])
+
+        with override_settings(BAG_FRAGMENT_MODE=settings.BAG_FRAGMENT_MODE and options['page_cache']):
+            if mode == 'wsgi':
+                results, seconds = self._wsgi(paths, options, 1)
+            elif mode == 'wsgi-threads':
+                results, seconds = self._wsgi(paths, options, options['concurrency'])
+            else:
+                results, seconds = self._asgi(paths, options)
+        result = summarize([elapsed for elapsed, _ in results], seconds)
+        result['errors'] = sum(error for _, error in results)
+        result['seconds'] = seconds
+        result['concurrency'] = 1 if mode == 'wsgi' else options['concurrency']
+        result['threads'] = threading.active_count()
+        return result
+
+    def _spawn(self, mode, options):
+        command = [
+            sys.executable, str(settings.BASE_DIR / 'manage.py'), 'asgi_benchmark', '--mode', mode,
+            '--requests', str(options['requests']), '--warmup', str(options['warmup']),
+            '--concurrency', str(options['concurrency']), '--db-latency', str(options['db_latency']),
+            '--seed', str(options['seed']),
+        ]
+        if options['page_cache']:
+            command.append('--page-cache')
+        # the views are picked when the URLs are loaded
+        env = dict(os.environ, ASYNC_VIEWS='True' if mode == 'asgi-async' else 'False')
+        finished = subprocess.run(command, env=env, capture_output=True, text=True)
+        if finished.returncode:
+            raise CommandError(f'{mode} failed:\n{finished.stderr}')
+        return json.loads(finished.stdout)
+
+    def handle(self, *args, **options):
+        if options['mode']:
+            self.stdout.write(json.dumps(self._run_mode(options['mode'], options)))
+            return
+
+        modes = [mode.strip() for mode in options['modes'].split(',') if mode.strip()]
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f'Unknown modes: {", ".join(sorted(unknown))}')
+        report = {
+            'started': datetime.now(timezone.utc).isoformat(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'cpus': os.cpu_count(),
+            'requests_per_mode': options['requests'],
+            'db_latency': options['db_latency'],
+            'page_cache': options['page_cache'],
+            'async_views_threads': settings.ASYNC_VIEWS_THREADS,
+            'modes': {},
+        }
+        for mode in modes:
+            result = report['modes'][mode] = self._spawn(mode, options)
+            self.stderr.write(
+                f'{mode} (concurrency {result["concurrency"]}): {result["throughput"]:.1f} req/s, '
+                f'p50 {result["p50_ms"]:.1f}ms, p95 {result["p95_ms"]:.1f}ms, '
+                f'p99 {result["p99_ms"]:.1f}ms, {result["errors"]} errors')
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,311 @@
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from checkout.models import Order
+from products import search
+from products.models import Category, Product
+
+SCENARIOS = ('listing', 'search', 'detail', 'bag', 'checkout', 'webhook')
+CLIENT_SECRET_RE = re.compile(r'value="([^"]+)" name="client_secret"')
+BAG_RESET_LINES = 20
+
+
+def percentile(ordered, fraction):
+    """ The nearest-rank percentile of an already sorted list """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarize(samples, seconds):
+    """ Count, throughput and latency percentiles in milliseconds """
+    ordered = sorted(samples)
+    return {
+        'requests': len(ordered),
+        'throughput': len(ordered) / seconds if seconds else 0.0,
+        'mean_ms': sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p95_ms': percentile(ordered, 0.95) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+    }
+
+
+class Run:
+    """ The timed requests of one scenario, shared by its worker threads """
+
+    def __init__(self, name, requests):
+        self.name = name
+        self.requests = requests
+        self._lock = threading.Lock()
+        self.samples = []
+        self.views = {}
+        self.errors = 0
+        self.recording = False
+
+    def done(self):
+        with self._lock:
+            return self.recording and len(self.samples) >= self.requests
+
+    def record(self, view, seconds, error):
+        if not self.recording:
+            return
+        with self._lock:
+            self.samples.append(seconds)
+            self.views.setdefault(view, []).append(seconds)
+            self.errors += error
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive the listing, search, product detail, bag, checkout and '
+        'webhook paths through the test client and print each one\'s '
+        'latency percentiles and throughput as JSON, so runs can be '
+        'compared. Stripe is replaced by the fake backend. Run it against '
+        'a database filled by generate_catalog; the checkout and webhook '
+        'scenarios add orders and webhook events to it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'Comma separated, from {", ".join(SCENARIOS)}')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Timed requests per scenario')
+        parser.add_argument('--warmup', type=int, default=20,
+                            help='Untimed iterations of each scenario first')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Threads sending requests, each with its own client')
+        parser.add_argument('--stripe-latency', type=float, default=None,
+                            help='Seconds each fake Stripe call takes; '
+                                 'defaults to STRIPE_FAKE_LATENCY')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the report to this file instead of stdout')
+
+    def _client(self):
+        return Client(HTTP_HOST='localhost')
+
+    def _request(self, run, client, method, url, data=None, **extra):
+        started = time.perf_counter()
+        try:
+            response = getattr(client, method)(url, data, **extra)
+        except Exception:
+            run.record('exception', time.perf_counter() - started, True)
+            return None
+        elapsed = time.perf_counter() - started
+        match = response.resolver_match
+        run.record(match.view_name if match else 'unresolved', elapsed, response.status_code >= 400)
+        return response
+
+    def _bag_line(self, rng):
+        product_id, has_sizes = rng.choice(self.products)
+        return product_id, {'quantity': rng.randint(1, 3), 'product_size': 's' if has_sizes else ''}
+
+    # Scenarios: each is one iteration, run over and over by every thread
+
+    def listing(self, run, client, rng):
+        params = {}
+        if rng.random() < 0.5:
+            params['category'] = ','.join(rng.sample(self.categories, min(2, len(self.categories))))
+        if rng.random() < 0.5:
+            params['sort'] = rng.choice(('price', 'rating', 'name', 'category'))
+            params['direction'] = rng.choice(('asc', 'desc'))
+        response = self._request(run, client, 'get', reverse('products'), params)
+        # and sometimes on to the next page, through its cursor
+        if response is not None and response.status_code == 200 and rng.random() < 0.3:
+            match = re.search(rb'href="([^"]*cursor=[^"]+)"', response.content)
+            if match:
+                self._request(run, client, 'get', match.group(1).decode().replace('&amp;', '&'))
+
+    def search(self, run, client, rng):
+        self._request(run, client, 'get', reverse('products'), {'q': rng.choice(self.terms)})
+
+    def detail(self, run, client, rng):
+        product_id, _ = rng.choice(self.products)
+        self._request(run, client, 'get', reverse('product_detail', args=[product_id]))
+
+    def bag(self, run, client, rng):
+        product_id, data = self._bag_line(rng)
+        self._request(run, client, 'post', reverse('api_add_to_bag', args=[product_id]), data)
+        self._request(run, client, 'get', reverse('view_bag'))
+        if rng.random() < 1 / BAG_RESET_LINES:
+            client.cookies.clear()
+
+    def checkout(self, run, client, rng):
+        client.cookies.clear()
+        for _ in range(rng.randint(1, 5)):
+            product_id, data = self._bag_line(rng)
+            client.post(reverse('api_add_to_bag', args=[product_id]), data)
+
+        response = self._request(run, client, 'get', reverse('checkout'))
+        if response is None or response.status_code != 200:
+            return
+        client_secret = CLIENT_SECRET_RE.search(response.content.decode()).group(1)
+        self._request(run, client, 'post', reverse('cache_checkout_data'), {
+            'client_secret': client_secret, 'save_info': 'false',
+        })
+        response = self._request(run, client, 'post', reverse('checkout'), {
+            'full_name': 'Benchmark Customer', 'email': 'benchmark@example.com',
+            'phone_number': '0123456789', 'country': 'IE', 'postcode': '',
+            'town_or_city': 'Dublin', 'street_address1': '1 Main Street',
+            'street_address2': '', 'county': '', 'client_secret': client_secret,
+        })
+        if response is not None and response.status_code == 302:
+            self._request(run, client, 'get', response.url)
+
+    def webhook(self, run, client, rng):
+        order = rng.choice(self.orders)
+        address = {
+            'city': order['town_or_city'], 'country': str(order['country']),
+            'line1': order['street_address1'], 'line2': '', 'postal_code': '', 'state': '',
+        }
+        payload = json.dumps({
+            'id': f'evt_benchmark_{uuid.uuid4().hex}',
+            'object': 'event',
+            'type': 'payment_intent.succeeded',
+            'data': {'object': {
+                'id': order['stripe_pid'],
+                'object': 'payment_intent',
+                'metadata': {
+                    'bag': order['original_bag'], 'save_info': '', 'username': 'AnonymousUser',
+                },
+                'shipping': {
+                    'name': order['full_name'], 'phone': order['phone_number'], 'address': address,
+                },
+                'charges': {'data': [{
+                    'amount': round(order['grand_total'] * 100),
+                    'billing_details': {'email': order['email'], 'address': address},
+                }]},
+            }},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(
+            settings.STRIPE_WH_SECRET.encode(), f'{timestamp}.{payload}'.encode(),
+            hashlib.sha256).hexdigest()
+        self._request(
+            run, client, 'post', reverse('webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+    def _run(self, name, options):
+        run = Run(name, options['requests'])
+        scenario = getattr(self, name)
+        concurrency = options['concurrency']
+        warmup = -(-options['warmup'] // concurrency)
+        started = None
+
+        def start():
+            # once every thread has warmed up
+            nonlocal started
+            run.recording = True
+            started = time.perf_counter()
+
+        barrier = threading.Barrier(concurrency, action=start)
+
+        def work(thread):
+            rng = random.Random(f'{options["seed"]}:{name}:{thread}')
+            client = self._client()
+            try:
+                for _ in range(warmup):
+                    scenario(run, client, rng)
+                barrier.wait()
+                while not run.done():
+                    scenario(run, client, rng)
+            except Exception:
+                barrier.abort()
+                raise
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(concurrency) as pool:
+            for future in [pool.submit(work, thread) for thread in range(concurrency)]:
+                future.result()
+        seconds = time.perf_counter() - started
+        result = summarize(run.samples, seconds)
+        result['errors'] = run.errors
+        result['seconds'] = seconds
+        result['views'] = {
+            view: summarize(samples, seconds) for view, samples in sorted(run.views.items())
+        }
+        return result
+
+    def _load(self, names):
+        self.products = list(Product.objects.values_list('pk', 'has_sizes'))
+        if not self.products:
+            raise CommandError('There are no products; fill the database with generate_catalog first')
+        self.categories = list(Category.objects.values_list('name', flat=True))
+        names = Product.objects.order_by('?').values_list('name', flat=True)[:200]
+        self.terms = sorted({
+            token for name in names for token in search.tokenize(name) if len(token) > 3
+        }) or ['shirt']
+        # webhooks are sent for recent orders, so they're found and confirmed
+        self.orders = list(Order.objects.order_by('-pk').values(
+            'stripe_pid', 'original_bag', 'full_name', 'email', 'phone_number',
+            'country', 'town_or_city', 'street_address1', 'grand_total')[:1000])
+        if not self.orders and 'webhook' in names:
+            raise CommandError('The webhook scenario needs orders; generate some with generate_catalog')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        stripe_latency = options['stripe_latency']
+        if stripe_latency is None:
+            stripe_latency = settings.STRIPE_FAKE_LATENCY
+        overrides = {
+            'STRIPE_BACKEND': 'fake',
+            'STRIPE_FAKE_LATENCY': stripe_latency,
+            'STRIPE_WH_SECRET': settings.STRIPE_WH_SECRET or 'whsec_benchmark',
+        }
+
+        with override_settings(**overrides):
+            self._load(names)
+            report = {
+                'started': datetime.now(timezone.utc).isoformat(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'concurrency': options['concurrency'],
+                'requests_per_scenario': options['requests'],
+                'stripe_latency': stripe_latency,
+                'webhook_worker_mode': settings.STRIPE_WH_WORKER_MODE,
+                'data': {
+                    'products': len(self.products),
+                    'categories': len(self.categories),
+                    'orders': Order.objects.count(),
+                    'users': User.objects.count(),
+                },
+                'scenarios': {},
+            }
+            for name in names:
+                report['scenarios'][name] = self._run(name, options)
+                if options['output']:
+                    result = report['scenarios'][name]
+                    self.stderr.write(
+                        f'{name}: {result["throughput"]:.1f} req/s, '
+                        f'p50 {result["p50_ms"]:.1f}ms, p95 {result["p95_ms"]:.1f}ms, '
+                        f'p99 {result["p99_ms"]:.1f}ms, {result["errors"]} errors')
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -1,3 +1,70 @@
-from django.test import TestCase
+import json
+import tempfile
+from io import StringIO
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+
+from boutique_ado.testing import QueryBudgetTestCase
+from checkout.models import Order
+from products.models import Product
+from profiles.models import UserProfile
+
+
+class HomeQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_index(self):
+        self.assertQueryBudget(2, reverse('home'), status=200)
+
+    def test_index_with_bag(self):
+        self.login()
+        self.fill_bag()
+        self.assertQueryBudget(4, reverse('home'), status=200)
+
+
+class BenchmarkCommandTests(TransactionTestCase):
+    # the benchmark's threads have their own connections, so they need
+    # the generated data committed
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        STRIPE_WH_WORKER_MODE='command',
+    )
+    def test_generate_and_run(self):
+        call_command(
+            'generate_catalog', products=50, users=5, orders=40, batch_size=16, stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 50)
+        self.assertEqual(UserProfile.objects.count(), 5)
+        self.assertEqual(Order.objects.count(), 40)
+        order = Order.objects.exclude(user_profile=None).first()
+        self.assertEqual(
+            order.order_total, sum(line.lineitem_total for line in order.lineitems.all()))
+
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command(
+                'run_benchmarks', requests=5, warmup=1, output=output.name, stderr=StringIO())
+            report = json.load(output)
+        self.assertEqual(set(report['scenarios']), {
+            'listing', 'search', 'detail', 'bag', 'checkout', 'webhook'})
+        for name, result in report['scenarios'].items():
+            self.assertGreaterEqual(result['requests'], 5, name)
+            self.assertEqual(result['errors'], 0, name)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'], name)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_asgi_benchmark_modes(self):
+        call_command('generate_catalog', products=30, users=0, orders=0, stdout=StringIO())
+        options = {'requests': 12, 'warmup': 2, 'concurrency': 4, 'db_latency': 0}
+        for mode, urlconf in (('wsgi-threads', 'boutique_ado.urls'),
+                              ('asgi', 'boutique_ado.urls'),
+                              ('asgi-async', 'boutique_ado.tests')):
+            with self.subTest(mode=mode), self.settings(ROOT_URLCONF=urlconf):
+                output = StringIO()
+                call_command('asgi_benchmark', mode=mode, stdout=output, **options)
+                result = json.loads(output.getvalue())
+                self.assertEqual(result['requests'], 12)
+                self.assertEqual(result['errors'], 0)
+
+        with self.assertRaisesMessage(CommandError, 'ASYNC_VIEWS=True'):
+            call_command('asgi_benchmark', mode='asgi-async', stdout=StringIO(), **options)
@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('', views.index, name='home')
+    path('', views.index_async if settings.ASYNC_VIEWS else views.index, name='home')
 ]
@@ -1,8 +1,19 @@
 from django.shortcuts import render
 
+from boutique_ado.async_utils import run_in_thread
+from products.caching import catalog_page
+
 # Create your views here.
 
+@catalog_page
 def index(request):
     """ A View to return the index page """
 
     return render(request, 'home/index.html')
+
+
+@catalog_page
+async def index_async(request):
+    """ index for ASGI """
+
+    return await run_in_thread(render, request, 'home/index.html')
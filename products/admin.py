@@ -13,6 +13,9 @@ class ProductAdmin(admin.ModelAdmin):
         'image',
     )
 
+    # category can be null, so the admin won't join it on its own
+    list_select_related = ('category',)
+
     ordering = ('sku',)
 
 class CategoryAdmin(admin.ModelAdmin):
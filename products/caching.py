@@ -0,0 +1,267 @@
+import asyncio
+import hashlib
+import json
+import uuid
+from calendar import timegm
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpResponse
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+
+from boutique_ado.async_utils import run_in_thread
+from .models import Product, Category
+
+CATALOG_VERSION_KEY = 'products:catalog_version'
+CARD_TEMPLATE = 'products/includes/product_card.html'
+CARD_VERSION_KEY = 'products:card_version:{}'
+CARD_KEY = 'products:card:{}:{}:{}'
+CARD_HITS_KEY = 'products:card_cache:hits'
+CARD_MISSES_KEY = 'products:card_cache:misses'
+PAGE_KEY = 'products:page:{}:{}'
+PAGE_HITS_KEY = 'products:page_cache:hits'
+PAGE_MISSES_KEY = 'products:page_cache:misses'
+
+
+def incr_counter(key, delta=1):
+    """ Add to a counter shared between processes through the cache """
+    if not delta:
+        return
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # evicted between the add and the incr
+        cache.set(key, delta, None)
+
+
+def _new_version():
+    # A fresh random token rather than a counter, so a version
+    # evicted from the cache can never bring an old fragment back
+    return uuid.uuid4().hex[:12]
+
+
+def bump_card_versions(product_ids):
+    """ Invalidate the cached cards for the given products """
+    cache.set_many({
+        CARD_VERSION_KEY.format(product_id): _new_version()
+        for product_id in product_ids
+    }, None)
+
+
+def card_versions(product_ids):
+    """ Return the current card version for each product id """
+    keys = {product_id: CARD_VERSION_KEY.format(product_id) for product_id in product_ids}
+    found = cache.get_many(keys.values())
+    versions = {}
+    missing = {}
+    for product_id, key in keys.items():
+        if key in found:
+            versions[product_id] = found[key]
+        else:
+            versions[product_id] = missing[key] = _new_version()
+    if missing:
+        cache.set_many(missing, None)
+    return versions
+
+
+def render_product_cards(products, is_superuser=False):
+    """
+    Render the listing card for each product, reusing cached fragments
+    where the product's card version hasn't changed.
+
+    Versions and fragments are each fetched with a single get_many,
+    so a full page costs two cache round trips when everything hits.
+    """
+    products = list(products)
+    versions = card_versions([product.pk for product in products])
+    variant = 'admin' if is_superuser else 'public'
+    keys = [
+        CARD_KEY.format(product.pk, versions[product.pk], variant)
+        for product in products
+    ]
+    cached = cache.get_many(keys)
+
+    template = None
+    cards = []
+    rendered = {}
+    for product, key in zip(products, keys):
+        if key not in cached:
+            if template is None:
+                template = get_template(CARD_TEMPLATE)
+            rendered[key] = template.render({
+                'product': product,
+                'is_superuser': is_superuser,
+                'MEDIA_URL': settings.MEDIA_URL,
+            })
+        cards.append(mark_safe(cached[key] if key in cached else rendered[key]))
+
+    if rendered:
+        cache.set_many(rendered, settings.PRODUCT_CARD_CACHE_TIMEOUT)
+    incr_counter(CARD_HITS_KEY, len(products) - len(rendered))
+    incr_counter(CARD_MISSES_KEY, len(rendered))
+    return cards
+
+
+def _cache_stats(hits_key, misses_key):
+    counts = cache.get_many([hits_key, misses_key])
+    hits = counts.get(hits_key, 0)
+    misses = counts.get(misses_key, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def card_cache_stats():
+    """ Return the card cache hit and miss counts and the hit ratio """
+    return _cache_stats(CARD_HITS_KEY, CARD_MISSES_KEY)
+
+
+def page_cache_stats():
+    """ Return the whole-page cache hit and miss counts and the hit ratio """
+    return _cache_stats(PAGE_HITS_KEY, PAGE_MISSES_KEY)
+
+
+def bump_catalog_version():
+    """ Mark the catalog as changed as of now """
+    cache.set(CATALOG_VERSION_KEY, (_new_version(), timezone.now()), None)
+
+
+def catalog_version():
+    """
+    Return a (version, last_modified) stamp for the whole catalog.
+
+    If the stamp has been evicted it's rebuilt from the latest
+    updated_at, with a new version so no stale ETag can match it.
+    """
+    stamp = cache.get(CATALOG_VERSION_KEY)
+    if stamp is None:
+        modified = [
+            Product.objects.aggregate(latest=Max('updated_at'))['latest'],
+            Category.objects.aggregate(latest=Max('updated_at'))['latest'],
+        ]
+        modified = max((m for m in modified if m), default=timezone.now())
+        cache.add(CATALOG_VERSION_KEY, (_new_version(), modified), None)
+        stamp = cache.get(CATALOG_VERSION_KEY) or (_new_version(), modified)
+    return stamp
+
+
+def _page_validators(request):
+    """
+    Work out the ETag and Last-Modified for a catalog page.
+
+    Pages rendered for the bag fragment only depend on the catalog.
+    Otherwise the ETag also covers who is logged in, their bag and their
+    CSRF cookie, pages with messages waiting are never revalidated, and
+    Last-Modified is only sent when nothing personal is on the page.
+    """
+    if hasattr(request, '_catalog_validators'):
+        return request._catalog_validators
+
+    validators = (None, None)
+    if getattr(request, 'bag_fragment', False):
+        version, modified = catalog_version()
+        validators = (hashlib.sha1(f'{version}:fragment'.encode()).hexdigest(), modified)
+    elif not len(get_messages(request)):
+        version, modified = catalog_version()
+        bag = request.session.get('bag', {})
+        csrf_cookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+        state = json.dumps(
+            [version, request.user.pk, bag, csrf_cookie], sort_keys=True, default=str)
+        etag = hashlib.sha1(state.encode()).hexdigest()
+        personalised = request.user.is_authenticated or bag or csrf_cookie
+        validators = (etag, None if personalised else modified)
+
+    request._catalog_validators = validators
+    return validators
+
+
+def _begin_page(request):
+    """
+    What catalog_page does before calling the view. Returns a 304, a
+    cached page or None, and the key to cache the page under, if any.
+    """
+    # ?personal is the link shared pages give visitors without javascript,
+    # to a copy with their own CSRF token in it
+    request.bag_fragment = (
+        settings.BAG_FRAGMENT_MODE and not request.user.is_authenticated
+        and 'personal' not in request.GET)
+    etag, last_modified = _page_validators(request)
+    response = get_conditional_response(
+        request,
+        etag=quote_etag(etag) if etag else None,
+        last_modified=timegm(last_modified.utctimetuple()) if last_modified else None,
+    )
+    if response is not None or not request.bag_fragment or request.method not in ('GET', 'HEAD'):
+        return response, None
+
+    # pages rendered for the bag fragment are cached whole, keyed on the
+    # catalog version so any catalog change expires them
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    key = PAGE_KEY.format(catalog_version()[0], path)
+    cached = cache.get(key)
+    if cached is None:
+        incr_counter(PAGE_MISSES_KEY)
+        return None, key
+    incr_counter(PAGE_HITS_KEY)
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type), key
+
+
+def _store_page(key, response):
+    if (key is not None and response.status_code == 200
+            and not response.streaming and not response.cookies):
+        cache.set(key, (response.content, response['Content-Type']),
+                  settings.CATALOG_PAGE_CACHE_TIMEOUT)
+
+
+def _end_page(request, response, key):
+    """ Add the caching headers; the validators were worked out already """
+    if key is not None:
+        patch_cache_control(response, public=True, max_age=0, must_revalidate=True)
+    if request.method in ('GET', 'HEAD'):
+        etag, last_modified = _page_validators(request)
+        if last_modified and not response.has_header('Last-Modified'):
+            response.headers['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+        if etag:
+            response.headers.setdefault('ETag', quote_etag(etag))
+    return response
+
+
+def catalog_page(view):
+    """
+    Serve a catalog page with conditional GET support.
+
+    With BAG_FRAGMENT_MODE on, anonymous visitors get a page with no
+    bag, messages or CSRF token in it, which is cached whole and shared
+    between them; the bag summary view fills those parts in.
+    Works for sync and async views.
+    """
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            response, key = await run_in_thread(_begin_page, request)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+                await run_in_thread(_store_page, key, response)
+            return _end_page(request, response, key)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response, key = _begin_page(request)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            _store_page(key, response)
+        return _end_page(request, response, key)
+    return wrapper
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from products.caching import card_cache_stats, page_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show hit and miss counts for the product card and catalog page caches'
+
+    def handle(self, *args, **options):
+        for name, stats in (('cards', card_cache_stats()), ('pages', page_cache_stats())):
+            self.stdout.write(
+                f'{name}: hits: {stats["hits"]}  misses: {stats["misses"]}  '
+                f'hit ratio: {stats["hit_ratio"]:.1%}')
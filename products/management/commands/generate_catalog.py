@@ -0,0 +1,204 @@
+import json
+import random
+import time
+import uuid
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from allauth.account.models import EmailAddress
+
+from checkout.models import Order, OrderLineItem
+from products import search
+from products.caching import bump_catalog_version
+from products.models import Category, Product
+from profiles.models import UserProfile
+
+FIXTURES = Path(__file__).resolve().parents[2] / 'fixtures'
+TOWNS = ('Dublin', 'Cork', 'Galway', 'Limerick', 'Belfast', 'London', 'Manchester')
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the database with a synthetic catalog, customers and order '
+        'history for load testing, made by varying the products and '
+        'categories fixtures. Customers can log in with the password '
+        'given by --password.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--orders', type=int, default=1000000)
+        parser.add_argument('--max-lines', type=int, default=6,
+                            help='Most line items in one order; each has 1 to this many')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--password', default='benchmark')
+
+    def _batches(self, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _categories(self):
+        """ The fixture's categories, created if missing, by fixture pk """
+        fixture = json.loads((FIXTURES / 'categories.json').read_text())
+        categories = {}
+        for entry in fixture:
+            category, _ = Category.objects.get_or_create(
+                name=entry['fields']['name'],
+                defaults={'friendly_name': entry['fields']['friendly_name']})
+            categories[entry['pk']] = category
+        return categories
+
+    def _products(self, count):
+        categories = self._categories()
+        templates = [entry['fields'] for entry in json.loads((FIXTURES / 'products.json').read_text())]
+        run = uuid.uuid4().hex[:6]
+
+        def rows():
+            for i in range(count):
+                template = templates[i % len(templates)]
+                price = Decimal(str(template['price'])) * Decimal(self.random.uniform(0.8, 1.2))
+                rating = template['rating']
+                yield Product(
+                    category=categories.get(template['category']),
+                    sku=f'{template["sku"] or "pp"}-{run}-{i}',
+                    name=f'{template["name"]} #{i // len(templates) + 1}',
+                    description=template['description'],
+                    # the fixtures don't say which products come in sizes
+                    has_sizes=template.get('has_sizes', i % 3 == 0),
+                    price=price.quantize(Decimal('0.01')),
+                    rating=None if rating is None else Decimal(str(rating)),
+                    image_url=template['image_url'],
+                    image=template['image'],
+                )
+
+        for batch in self._batches(rows()):
+            Product.objects.bulk_create(batch)
+        # bulk_create skips the signals that keep the search index and the
+        # page caches up to date
+        search.mark_changed(applied_locally=False)
+        bump_catalog_version()
+
+    def _users(self, count, password):
+        run = uuid.uuid4().hex[:6]
+        # hashing once rather than per user keeps a big run quick
+        password = make_password(password)
+
+        def rows():
+            for i in range(count):
+                username = f'shopper_{run}_{i}'
+                yield User(username=username, email=f'{username}@example.com', password=password)
+
+        for batch in self._batches(rows()):
+            with transaction.atomic():
+                self._add_users(batch)
+
+    def _add_users(self, batch):
+        User.objects.bulk_create(batch)
+        # bulk_create skips the post_save receiver that creates profiles,
+        # and allauth's mandatory verification needs an email address
+        users = User.objects.filter(username__in=[user.username for user in batch])
+        UserProfile.objects.bulk_create([
+            UserProfile(
+                user=user,
+                default_phone_number='0123456789',
+                default_street_address1=f'{user.pk} Main Street',
+                default_town_or_city=self.random.choice(TOWNS),
+                default_country='IE',
+            )
+            for user in users
+        ])
+        EmailAddress.objects.bulk_create([
+            EmailAddress(user=user, email=user.email, verified=True, primary=True)
+            for user in users
+        ])
+
+    def _order(self, profile, products, max_lines):
+        chosen = self.random.sample(products, self.random.randint(1, max_lines))
+        lines = []
+        for product_id, price, has_sizes in chosen:
+            size = self.random.choice(Product.SIZES) if has_sizes else None
+            lines.append((product_id, size, self.random.randint(1, 3), price))
+        order_total = sum(price * quantity for _, _, quantity, price in lines)
+        if order_total < settings.FREE_DELIVERY_THRESHOLD:
+            delivery_cost = order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
+        else:
+            delivery_cost = Decimal('0')
+        order = Order(
+            order_number=uuid.uuid4().hex.upper(),
+            user_profile_id=profile,
+            full_name=f'Customer {self.random.randint(1, 10 ** 6)}',
+            email='customer@example.com',
+            phone_number='0123456789',
+            country='IE',
+            town_or_city=self.random.choice(TOWNS),
+            street_address1=f'{self.random.randint(1, 500)} Main Street',
+            order_total=order_total,
+            delivery_cost=delivery_cost.quantize(Decimal('0.01')),
+            grand_total=(order_total + delivery_cost).quantize(Decimal('0.01')),
+            original_bag=json.dumps({
+                'v': 2,
+                'lines': [[str(product_id), size, quantity] for product_id, size, quantity, _ in lines],
+            }, separators=(',', ':')),
+            stripe_pid=f'pi_{uuid.uuid4().hex}',
+        )
+        return order, lines
+
+    def _orders(self, count, max_lines):
+        products = list(Product.objects.values_list('pk', 'price', 'has_sizes'))
+        profiles = list(UserProfile.objects.values_list('pk', flat=True))
+        if count and not products:
+            raise CommandError('There are no products to order')
+        max_lines = min(max_lines, len(products))
+
+        def rows():
+            for i in range(count):
+                # a few guest checkouts among the customers' orders
+                profile = self.random.choice(profiles) if profiles and i % 10 else None
+                yield self._order(profile, products, max_lines)
+
+        for batch in self._batches(rows()):
+            with transaction.atomic():
+                self._add_orders(batch)
+
+    def _add_orders(self, batch):
+        Order.objects.bulk_create([order for order, _ in batch])
+        # not every database returns the new primary keys from bulk_create
+        pks = dict(
+            Order.objects.filter(order_number__in=[order.order_number for order, _ in batch])
+            .values_list('order_number', 'pk'))
+        OrderLineItem.objects.bulk_create([
+            OrderLineItem(
+                order_id=pks[order.order_number], product_id=product_id,
+                product_size=size, quantity=quantity, lineitem_total=price * quantity)
+            for order, lines in batch
+            for product_id, size, quantity, price in lines
+        ])
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        # orders are for any product and customer, so orders can also be
+        # added to an existing catalog with --products 0 --users 0
+        for name, step in (
+            ('products', lambda: self._products(options['products'])),
+            ('users', lambda: self._users(options['users'], options['password'])),
+            ('orders', lambda: self._orders(options['orders'], options['max_lines'])),
+        ):
+            started = time.perf_counter()
+            step()
+            self.stdout.write(f'{options[name]} {name} in {time.perf_counter() - started:.1f}s')
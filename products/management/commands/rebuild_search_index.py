@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from products import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product search index and tell running processes to reload it'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        index = search.rebuild()
+        search.mark_changed(applied_locally=False)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {len(index)} products ({index.token_count} tokens) in {elapsed:.2f}s'))
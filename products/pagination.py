@@ -0,0 +1,129 @@
+from django.core import signing
+from django.db.models import F, Q
+
+
+class KeysetPage:
+    """ A single page of results plus the cursors either side of it """
+
+    def __init__(self, object_list, next_cursor=None, prev_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Cursor (keyset) pagination over a queryset ordered by one sort key,
+    with the primary key as a tie breaker.
+
+    Rather than OFFSET, each page filters on the sort value and pk of the
+    row at the edge of the previous page, so page N costs the same as page 1.
+    NULLs sort first when ascending and last when descending on every
+    database, which keeps "previous" a simple reversal of "next".
+    """
+
+    salt = 'products.pagination'
+
+    def __init__(self, queryset, sortkey='id', descending=False, per_page=24):
+        self.queryset = queryset
+        self.sortkey = sortkey
+        self.descending = descending
+        self.per_page = per_page
+
+    def _ordering(self, descending):
+        if self.sortkey == 'id':
+            return [F('id').desc() if descending else F('id').asc()]
+        if descending:
+            return [F(self.sortkey).desc(nulls_last=True), F('id').desc()]
+        return [F(self.sortkey).asc(nulls_first=True), F('id').asc()]
+
+    def _after(self, value, pk, descending):
+        """ Rows that come after (value, pk) in the given direction """
+        key = self.sortkey
+        if key == 'id':
+            return Q(id__lt=pk) if descending else Q(id__gt=pk)
+        pk_after = Q(id__lt=pk) if descending else Q(id__gt=pk)
+        if descending:
+            if value is None:
+                return Q(**{f'{key}__isnull': True}) & pk_after
+            return (Q(**{f'{key}__lt': value})
+                    | Q(**{key: value}) & pk_after
+                    | Q(**{f'{key}__isnull': True}))
+        if value is None:
+            return (Q(**{f'{key}__isnull': True}) & pk_after
+                    | Q(**{f'{key}__isnull': False}))
+        return Q(**{f'{key}__gt': value}) | Q(**{key: value}) & pk_after
+
+    def _value(self, obj):
+        value = obj
+        for attr in self.sortkey.split('__'):
+            value = getattr(value, attr, None)
+            if value is None:
+                return None
+        return value if isinstance(value, (int, str)) else str(value)
+
+    def _cursor(self, obj, direction):
+        return signing.dumps({
+            'k': self.sortkey,
+            'd': direction,
+            'v': self._value(obj),
+            'pk': obj.pk,
+        }, salt=self.salt, compress=True)
+
+    def _decode(self, cursor):
+        if not cursor:
+            return None
+        try:
+            data = signing.loads(cursor, salt=self.salt)
+        except signing.BadSignature:
+            return None
+        if data.get('k') != self.sortkey or data.get('d') not in ('next', 'prev'):
+            return None
+        return data
+
+    def page(self, cursor=None):
+        """
+        Return the page following (or preceding) the given cursor,
+        or the first page if the cursor is missing or invalid.
+        """
+        position = self._decode(cursor)
+        size = self.per_page
+
+        if position and position['d'] == 'prev':
+            rows = list(
+                self.queryset
+                .filter(self._after(position['v'], position['pk'], not self.descending))
+                .order_by(*self._ordering(not self.descending))[:size + 1]
+            )
+            has_previous = len(rows) > size
+            rows = rows[:size][::-1]
+            has_next = True
+        else:
+            queryset = self.queryset.order_by(*self._ordering(self.descending))
+            if position:
+                queryset = queryset.filter(
+                    self._after(position['v'], position['pk'], self.descending))
+            rows = list(queryset[:size + 1])
+            has_next = len(rows) > size
+            rows = rows[:size]
+            has_previous = position is not None
+
+        return KeysetPage(
+            rows,
+            next_cursor=self._cursor(rows[-1], 'next') if rows and has_next else None,
+            prev_cursor=self._cursor(rows[0], 'prev') if rows and has_previous else None,
+        )
@@ -0,0 +1,290 @@
+import bisect
+import re
+import threading
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Product
+
+VERSION_KEY = 'products:search_index_version'
+
+TOKEN_RE = re.compile(r'\w+')
+
+# How much a token counts for depending on where it appears in a product
+FIELD_WEIGHTS = {
+    'name': 3,
+    'category': 2,
+    'description': 1,
+}
+
+# How much a match counts for depending on how the query term matched
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.6
+SUBSTRING_MATCH = 0.3
+
+
+def tokenize(text):
+    """ Split text into lowercase word tokens """
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class SearchIndex:
+    """
+    An in-process inverted index over product names, descriptions
+    and category names.
+
+    Each token maps to the products containing it, weighted by field.
+    Query terms match tokens exactly, by prefix (via a sorted token list)
+    or as a substring (via a trigram index over the tokens), so searching
+    doesn't need a LIKE scan of the description column. Each product's
+    category name is kept too, so results can be narrowed to categories
+    before they're ranked and cut short.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.built = False
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}  # token -> {product_id: weight}
+        self._documents = {}  # product_id -> {token: weight}
+        self._categories = {}  # product_id -> category name
+        self._tokens = []  # every token, sorted for prefix lookups
+        self._trigrams = defaultdict(set)  # trigram -> tokens containing it
+
+    def __len__(self):
+        return len(self._documents)
+
+    @property
+    def token_count(self):
+        return len(self._tokens)
+
+    def _document(self, product):
+        fields = {
+            'name': product.name,
+            'description': product.description,
+            'category': '',
+        }
+        if product.category_id and product.category:
+            fields['category'] = f'{product.category.name} {product.category.friendly_name or ""}'
+
+        document = defaultdict(int)
+        for field, text in fields.items():
+            for token in set(tokenize(text)):
+                document[token] += FIELD_WEIGHTS[field]
+        return document
+
+    def _add_token(self, token):
+        self._postings[token] = {}
+        bisect.insort(self._tokens, token)
+        for trigram in trigrams(token):
+            self._trigrams[trigram].add(token)
+
+    def _drop_token(self, token):
+        del self._postings[token]
+        del self._tokens[bisect.bisect_left(self._tokens, token)]
+        for trigram in trigrams(token):
+            self._trigrams[trigram].discard(token)
+            if not self._trigrams[trigram]:
+                del self._trigrams[trigram]
+
+    def add(self, product):
+        """ Index a product, replacing any previous entry for it """
+        document = self._document(product)
+        with self._lock:
+            self.remove(product.pk)
+            for token, weight in document.items():
+                if token not in self._postings:
+                    self._add_token(token)
+                self._postings[token][product.pk] = weight
+            self._documents[product.pk] = document
+            self._categories[product.pk] = (
+                product.category.name if product.category_id and product.category else None)
+
+    def remove(self, product_id):
+        """ Drop a product from the index """
+        with self._lock:
+            document = self._documents.pop(product_id, None)
+            self._categories.pop(product_id, None)
+            if not document:
+                return
+            for token in document:
+                postings = self._postings[token]
+                postings.pop(product_id, None)
+                if not postings:
+                    self._drop_token(token)
+
+    def build(self, products=None):
+        """
+        Rebuild the whole index from the database. The new index is
+        built on the side and swapped in, so searches carry on against
+        the old one meanwhile.
+        """
+        if products is None:
+            products = (
+                Product.objects.select_related('category')
+                .only('name', 'description', 'category__name', 'category__friendly_name')
+                .iterator()
+            )
+        fresh = SearchIndex()
+        for product in products:
+            fresh.add(product)
+        with self._lock:
+            self._postings = fresh._postings
+            self._documents = fresh._documents
+            self._categories = fresh._categories
+            self._tokens = fresh._tokens
+            self._trigrams = fresh._trigrams
+            self.built = True
+
+    def _expand(self, term):
+        """ Map a query term to the indexed tokens it matches """
+        matches = {}
+        start = bisect.bisect_left(self._tokens, term)
+        for token in self._tokens[start:]:
+            if not token.startswith(term):
+                break
+            matches[token] = EXACT_MATCH if token == term else PREFIX_MATCH
+
+        if len(term) >= 3:
+            term_trigrams = trigrams(term)
+            candidates = set.intersection(
+                *(self._trigrams.get(trigram, set()) for trigram in term_trigrams))
+            for token in candidates:
+                if token not in matches and term in token:
+                    matches[token] = SUBSTRING_MATCH
+        return matches
+
+    def search(self, query, limit=None, categories=None):
+        """
+        Return the ids of products matching every term in the query,
+        most relevant first, optionally only those in the named categories
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        scores = None
+        with self._lock:
+            for term in terms:
+                term_scores = {}
+                for token, multiplier in self._expand(term).items():
+                    for product_id, weight in self._postings[token].items():
+                        score = weight * multiplier
+                        if score > term_scores.get(product_id, 0):
+                            term_scores[product_id] = score
+                if scores is None:
+                    scores = term_scores
+                    if categories is not None:
+                        categories = set(categories)
+                        scores = {
+                            product_id: score for product_id, score in scores.items()
+                            if self._categories.get(product_id) in categories
+                        }
+                else:
+                    scores = {
+                        product_id: score + term_scores[product_id]
+                        for product_id, score in scores.items()
+                        if product_id in term_scores
+                    }
+                if not scores:
+                    return []
+
+        ranked = sorted(scores, key=lambda product_id: (-scores[product_id], product_id))
+        return ranked[:limit] if limit else ranked
+
+
+index = SearchIndex()
+_rebuild_lock = threading.Lock()
+
+
+def _shared_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(VERSION_KEY, version, None)
+        version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def _publish(applied_locally):
+    current = index.built and index.version == _shared_version()
+    version = uuid.uuid4().hex
+    cache.set(VERSION_KEY, version, None)
+    if current and applied_locally:
+        index.version = version
+
+
+def _publish_applied():
+    _publish(applied_locally=True)
+
+
+def _publish_unapplied():
+    _publish(applied_locally=False)
+
+
+def mark_changed(applied_locally=True):
+    """
+    Tell every process its index is out of date, once the transaction
+    commits. However many products a transaction changes, like a bulk
+    edit in the admin, the other processes only rebuild once for it.
+    If this process has already applied the change and was up to date
+    beforehand, it keeps its index rather than rebuilding.
+    """
+    publish = _publish_applied if applied_locally else _publish_unapplied
+    connection = transaction.get_connection()
+    # outside a transaction on_commit runs it straight away
+    if not any(func is publish for _, func in connection.run_on_commit):
+        transaction.on_commit(publish)
+
+
+def _build():
+    version = _shared_version()
+    index.build()
+    index.version = version
+
+
+def rebuild():
+    """ Rebuild this process's index and mark it current """
+    with _rebuild_lock:
+        _build()
+    return index
+
+
+def _refresh():
+    """
+    Rebuild the index if it's out of date, unless another thread in
+    this process is already at it
+    """
+    if not _rebuild_lock.acquire(blocking=False):
+        return
+    try:
+        if index.version != _shared_version():
+            _build()
+    finally:
+        _rebuild_lock.release()
+
+
+def search(query, limit=None, categories=None):
+    """
+    Search the product index. A process that hasn't built its index
+    yet builds it first. Once another process has made it out of date,
+    the first request to notice rebuilds it while the process's other
+    threads carry on searching the old one.
+    """
+    if not index.built:
+        with _rebuild_lock:
+            if not index.built:
+                _build()
+    elif index.version != _shared_version():
+        _refresh()
+    return index.search(query, limit=limit, categories=categories)
@@ -0,0 +1,73 @@
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Product, Category
+from .caching import bump_card_versions, bump_catalog_version
+from . import search
+
+
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=Category)
+def stamp_fixture_rows(sender, instance, raw, **kwargs):
+    """
+    Fixtures are saved raw, which skips auto_now, and the fixtures
+    predate updated_at, so stamp their rows as they're loaded
+    """
+    if raw and instance.updated_at is None:
+        instance.updated_at = timezone.now()
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    """
+    Re-index the product and expire its card when it's added or edited
+    """
+    if search.index.built:
+        search.index.add(instance)
+    search.mark_changed()
+    bump_card_versions([instance.pk])
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    """
+    Drop a deleted product from the search index and expire its card
+    """
+    if search.index.built:
+        search.index.remove(instance.pk)
+    search.mark_changed()
+    bump_card_versions([instance.pk])
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    """
+    Re-index and re-render the products in a category when its names change
+    """
+    products = list(instance.product_set.select_related('category'))
+    if search.index.built:
+        for product in products:
+            search.index.add(product)
+    search.mark_changed()
+    bump_card_versions([product.pk for product in products])
+    bump_catalog_version()
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, **kwargs):
+    """
+    Expire the cards showing a category before it's removed from them
+    """
+    bump_card_versions(instance.product_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    """
+    Products lose their category without being saved, so rebuild lazily
+    """
+    search.mark_changed(applied_locally=False)
+    bump_catalog_version()
@@ -0,0 +1,12 @@
+from django import template
+
+from products.caching import render_product_cards
+
+
+register = template.Library()
+
+@register.simple_tag(takes_context=True)
+def product_cards(context, products):
+    request = context.get('request')
+    is_superuser = bool(request and request.user.is_superuser)
+    return render_product_cards(products, is_superuser=is_superuser)
@@ -1,3 +1,372 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from boutique_ado.testing import QueryBudgetTestCase
+
+from . import search
+from .caching import card_cache_stats, page_cache_stats, render_product_cards
+from .models import Category, Product
+from .pagination import KeysetPaginator
+
+
+class FixtureTests(TestCase):
+
+    def test_fixtures_load(self):
+        call_command('loaddata', 'categories', 'products', verbosity=0)
+        self.assertTrue(Category.objects.exists())
+        self.assertFalse(Product.objects.filter(updated_at__isnull=True).exists())
+
+
+class KeysetPaginatorTests(TestCase):
+    SORTKEYS = ('id', 'price', 'rating', 'lower_name', 'category__name')
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = [None] + [
+            Category.objects.create(name=name) for name in ('jackets', 'shirts', 'shoes')]
+        # lots of ties on every sort key, and NULL ratings and categories
+        for i in range(23):
+            Product.objects.create(
+                category=categories[i % 4],
+                name=('Shirt' if i % 2 else 'shirt') if i % 3 else f'Jacket {i % 5}',
+                description='',
+                price=Decimal(10 + i % 4),
+                rating=None if i % 5 == 0 else Decimal(i % 3),
+            )
+
+    def paginator(self, sortkey, descending):
+        queryset = Product.objects.select_related('category').annotate(lower_name=Lower('name'))
+        return KeysetPaginator(queryset, sortkey=sortkey, descending=descending, per_page=5)
+
+    def expected(self, paginator):
+        """ The order the paginator should give, worked out in Python """
+        products = list(paginator.queryset)
+        numeric = paginator.sortkey in ('price', 'rating')
+
+        def value(product):
+            value = paginator._value(product)
+            return Decimal(value) if numeric and value is not None else value
+
+        nulls = sorted((p for p in products if value(p) is None), key=lambda p: p.pk,
+                       reverse=paginator.descending)
+        others = sorted((p for p in products if value(p) is not None),
+                        key=lambda p: (value(p), p.pk), reverse=paginator.descending)
+        return others + nulls if paginator.descending else nulls + others
+
+    def test_pages_forwards_and_backwards(self):
+        for sortkey in self.SORTKEYS:
+            for descending in (False, True):
+                with self.subTest(sortkey=sortkey, descending=descending):
+                    paginator = self.paginator(sortkey, descending)
+                    expected = [p.pk for p in self.expected(paginator)]
+
+                    pages = [paginator.page()]
+                    self.assertFalse(pages[0].has_previous)
+                    while pages[-1].has_next:
+                        pages.append(paginator.page(pages[-1].next_cursor))
+                    self.assertEqual([p.pk for page in pages for p in page], expected)
+                    self.assertEqual(len(pages), 5)
+
+                    # and back again through the previous cursors
+                    page = pages[-1]
+                    for earlier in reversed(pages[:-1]):
+                        page = paginator.page(page.prev_cursor)
+                        self.assertEqual([p.pk for p in page], [p.pk for p in earlier])
+                    self.assertFalse(page.has_previous)
+
+    def test_bad_cursors_give_the_first_page(self):
+        paginator = self.paginator('price', False)
+        first = [p.pk for p in paginator.page()]
+        cursor = paginator.page().next_cursor
+        other_sortkey = self.paginator('rating', False).page().next_cursor
+        forged = signing.dumps({'k': 'price', 'd': 'next', 'v': '12', 'pk': 1}, salt='other')
+        for bad in ('', 'nonsense', cursor[:-2] + ('AA' if cursor[-2:] != 'AA' else 'BB'),
+                    other_sortkey, forged):
+            with self.subTest(cursor=bad):
+                page = paginator.page(bad)
+                self.assertEqual([p.pk for p in page], first)
+                self.assertFalse(page.has_previous)
+
+
+class SearchIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        shirts = Category(pk=1, name='shirts', friendly_name='Shirts')
+        jackets = Category(pk=2, name='jackets', friendly_name='Jackets')
+        self.index = search.SearchIndex()
+        self.index.build([
+            Product(pk=1, name='Shirt', description='Cotton', category=shirts),
+            Product(pk=2, name='Shirtdress', description='Linen', category=shirts),
+            Product(pk=3, name='Overshirt', description='Wool', category=jackets),
+            Product(pk=4, name='Jacket', description='Wear it over a shirt', category=jackets),
+        ])
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize('Blue T-Shirt, size XL!'), ['blue', 't', 'shirt', 'size', 'xl'])
+        self.assertEqual(search.tokenize(''), [])
+        self.assertEqual(search.tokenize(None), [])
+        self.assertEqual(search.trigrams('shirt'), {'shi', 'hir', 'irt'})
+        self.assertEqual(search.trigrams('xl'), set())
+
+    def test_ranking(self):
+        # an exact name match, then a name prefix, then an exact word in
+        # the description, then a substring of a name
+        self.assertEqual(self.index.search('shirt'), [1, 2, 4, 3])
+        self.assertEqual(self.index.search('SHIRT', limit=2), [1, 2])
+        self.assertEqual(self.index.search('shirt wool'), [3])
+        self.assertEqual(self.index.search('shirt nothing'), [])
+        self.assertEqual(self.index.search('!!'), [])
+
+    def test_prefix_and_substring_matches(self):
+        self.assertEqual(self.index.search('shirtd'), [2])
+        self.assertEqual(self.index.search('irtdr'), [2])
+        # too short for trigrams, so only prefixes match
+        self.assertEqual(self.index.search('ir'), [])
+        # a prefix of a name counts for more than one in a description
+        self.assertEqual(self.index.search('ov'), [3, 4])
+
+    def test_categories(self):
+        self.assertEqual(self.index.search('shirt', categories=['jackets']), [4, 3])
+        self.assertEqual(self.index.search('shirt', categories=['shoes']), [])
+        # category names are searchable too, with ties broken by id
+        self.assertEqual(self.index.search('jackets'), [3, 4])
+
+    def test_remove(self):
+        tokens = self.index.token_count
+        self.index.remove(2)
+        self.assertEqual(self.index.search('shirt'), [1, 4, 3])
+        self.assertEqual(self.index.search('shirtdress'), [])
+        self.assertEqual(self.index.token_count, tokens - 2)
+        self.assertEqual(len(self.index), 3)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SearchRebuildTests(TestCase):
+
+    def setUp(self):
+        self.shirt = Product.objects.create(name='Shirt', description='', price='10.00')
+        search.rebuild()
+
+    def add_elsewhere(self):
+        """ Add a product the way another process would """
+        Product.objects.bulk_create([Product(name='Shirtdress', description='', price='10.00')])
+        with self.captureOnCommitCallbacks(execute=True):
+            search.mark_changed(applied_locally=False)
+
+    def test_stale_index_is_rebuilt_once(self):
+        self.add_elsewhere()
+        self.assertEqual(len(search.search('shirt')), 2)
+        # and kept after, while nothing changes
+        with mock.patch.object(search.index, 'build') as build:
+            search.search('shirt')
+        build.assert_not_called()
+
+    def test_stale_index_is_served_while_rebuilding(self):
+        self.add_elsewhere()
+        # as if another thread were part way through rebuilding it
+        with search._rebuild_lock, mock.patch.object(search.index, 'build') as build:
+            self.assertEqual(search.search('shirt'), [self.shirt.pk])
+        build.assert_not_called()
+
+    @override_settings(PRODUCTS_SEARCH_RESULTS_LIMIT=2)
+    def test_every_match_is_counted(self):
+        for i in range(4):
+            Product.objects.create(name=f'Shirt {i}', description='', price='10.00')
+        response = self.client.get(reverse('products'), {'q': 'shirt'})
+        self.assertEqual(len(response.context['products']), 2)
+        self.assertEqual(response.context['total_products'], 5)
+        self.assertContains(response, 'showing the 2 most relevant')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CardCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        self.shirt = Product.objects.create(
+            category=self.category, name='Shirt', description='', price='10.00')
+        self.jacket = Product.objects.create(
+            category=self.category, name='Jacket', description='', price='50.00')
+
+    def render(self):
+        products = Product.objects.select_related('category').order_by('pk')
+        return render_product_cards(products)
+
+    def test_editing_a_product_expires_only_its_card(self):
+        self.render()
+        self.assertEqual(card_cache_stats()['misses'], 2)
+        self.render()
+        self.assertEqual(card_cache_stats()['hits'], 2)
+
+        self.shirt.price = '12.00'
+        self.shirt.save()
+        shirt, jacket = self.render()
+        self.assertIn('$12.00', shirt)
+        self.assertEqual(card_cache_stats(), {'hits': 3, 'misses': 3, 'hit_ratio': 0.5})
+
+    def test_renaming_a_category_expires_its_cards(self):
+        self.render()
+        self.category.friendly_name = 'Tops'
+        self.category.save()
+        for card in self.render():
+            self.assertIn('Tops', card)
+        self.assertEqual(card_cache_stats()['misses'], 4)
+
+    def test_deleting_a_category_expires_its_cards(self):
+        self.render()
+        self.category.delete()
+        for card in self.render():
+            self.assertNotIn('Shirts', card)
+        self.assertEqual(card_cache_stats()['misses'], 4)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    BAG_FRAGMENT_MODE=False,
+)
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Shirt', description='', price='10.00')
+
+    def test_validators_are_sent(self):
+        response = self.client.get(reverse('products'))
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.client.get(reverse('products'))['ETag']
+        response = self.client.get(reverse('products'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_saving_a_product_changes_the_etag(self):
+        etag = self.client.get(reverse('products'))['ETag']
+        self.product.price = '12.00'
+        self.product.save()
+        response = self.client.get(reverse('products'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_no_validators_while_messages_are_pending(self):
+        self.client.post(reverse('add_to_bag', args=[self.product.pk]), {
+            'quantity': 1, 'redirect_url': reverse('products')})
+        response = self.client.get(reverse('products'))
+        self.assertContains(response, 'Added Shirt to your bag')
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+        # once they've been shown the page can be revalidated again
+        self.assertTrue(self.client.get(reverse('products')).has_header('ETag'))
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    BAG_FRAGMENT_MODE=True,
+)
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='Shirt', description='', price='10.00')
+
+    def test_anonymous_visitors_share_a_page(self):
+        first = self.client_class().get(reverse('products'))
+        second = self.client_class().get(reverse('products'))
+        self.assertEqual(page_cache_stats()['hits'], 1)
+        self.assertEqual(first.content, second.content)
+        self.assertFalse(second.cookies)
+
+    def test_pages_are_keyed_on_the_catalog_version(self):
+        self.client.get(reverse('products'))
+        self.product.name = 'Renamed shirt'
+        self.product.save()
+        response = self.client.get(reverse('products'))
+        self.assertContains(response, 'Renamed shirt')
+        self.assertEqual(page_cache_stats(), {'hits': 0, 'misses': 2, 'hit_ratio': 0.0})
+
+    def test_personal_copy_has_a_token(self):
+        url = reverse('product_detail', args=[self.product.pk])
+        self.assertContains(self.client.get(url), f'{url}?personal=1')
+        response = self.client.get(url, {'personal': 1})
+        self.assertNotContains(response, '?personal=1')
+        self.assertRegex(response.content.decode(), r'name="csrfmiddlewaretoken" value="\w+"')
+        self.assertEqual(page_cache_stats()['misses'], 1)
+
+    def test_logged_in_pages_are_not_shared(self):
+        user = User.objects.create_user('shopper', password='password')
+        self.client.force_login(user)
+        self.client.get(reverse('products'))
+        self.client.get(reverse('products'))
+        self.assertEqual(page_cache_stats(), {'hits': 0, 'misses': 0, 'hit_ratio': 0.0})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SearchVersionTests(TransactionTestCase):
+    # the version is only bumped once a transaction commits
+
+    def setUp(self):
+        search.rebuild()
+
+    def test_a_transaction_marks_the_index_changed_once(self):
+        version = search._shared_version()
+        with mock.patch.object(search, '_publish', wraps=search._publish) as publish:
+            with transaction.atomic():
+                for i in range(5):
+                    Product.objects.create(name=f'Shirt {i}', description='', price='10.00')
+                publish.assert_not_called()
+        publish.assert_called_once_with(applied_locally=True)
+        self.assertNotEqual(search._shared_version(), version)
+        # this process applied them as they were saved, so it doesn't rebuild
+        self.assertEqual(search.index.version, search._shared_version())
+        self.assertEqual(len(search.search('shirt')), 5)
+
+    def test_a_rolled_back_change_is_not_published(self):
+        version = search._shared_version()
+        with self.assertRaises(ValueError), transaction.atomic():
+            Product.objects.create(name='Shirt', description='', price='10.00')
+            raise ValueError
+        self.assertEqual(search._shared_version(), version)
+        # and the next transaction still publishes its change
+        Product.objects.create(name='Shirt', description='', price='10.00')
+        self.assertNotEqual(search._shared_version(), version)
+
+
+class ProductQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_all_products(self):
+        self.assertQueryBudget(4, reverse('products'), status=200)
+
+    def test_search(self):
+        self.assertQueryBudget(5, reverse('products'), {'q': 'shirt'}, status=200)
+
+    def test_categories_and_sort(self):
+        self.assertQueryBudget(5, reverse('products'), {
+            'category': 'category_1,category_2', 'sort': 'price', 'direction': 'desc',
+        }, status=200)
+
+    def test_next_page(self):
+        response = self.client.get(reverse('products'))
+        self.assertQueryBudget(1, response.context['next_url'], status=200)
+
+    def test_product_detail(self):
+        self.login()
+        self.fill_bag()
+        self.assertQueryBudget(6, reverse('product_detail', args=[self.products[0].pk]), status=200)
+
+    def test_product_management(self):
+        self.login('admin')
+        product = self.products[0]
+        self.assertQueryBudget(2, reverse('add_product'), status=200)
+        self.assertQueryBudget(3, reverse('edit_product', args=[product.pk]), status=200)
+        self.assertQueryBudget(8, reverse('delete_product', args=[product.pk]), status=302)
@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('', views.all_products, name='products'),
-    path('<int:product_id>/', views.product_detail, name='product_detail'),
+    path('', views.all_products_async if settings.ASYNC_VIEWS else views.all_products,
+         name='products'),
+    path('<int:product_id>/',
+         views.product_detail_async if settings.ASYNC_VIEWS else views.product_detail,
+         name='product_detail'),
     path('add/', views.add_product, name='add_product'),
     path('edit/<int:product_id>/', views.edit_product, name='edit_product'),
     path('delete/<int:product_id>/', views.delete_product, name='delete_product'),
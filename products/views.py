@@ -1,22 +1,55 @@
+import asyncio
+import hashlib
+
 from django.shortcuts import render, redirect, reverse, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, When, Value, IntegerField
 from django.db.models.functions import Lower
 
+from boutique_ado.async_utils import run_in_thread
 from .models import Product, Category
 from .forms import ProductForm
+from .caching import catalog_page, catalog_version
+from .pagination import KeysetPaginator
+from . import search
 
 # Create your views here.
 
-def all_products(request):
-    """ A view to show all products, including sorting and search queries """
+def _count_products(products, categories):
+    """
+    Count the filtered products, caching the result per catalog version
+    so paging through a listing doesn't re-run COUNT(*) on every page
+    """
+    filters = f'{catalog_version()[0]}|{sorted(categories or [])}'
+    key = 'products:count:' + hashlib.md5(filters.encode()).hexdigest()
+    return cache.get_or_set(key, products.count, settings.PRODUCTS_COUNT_CACHE_TIMEOUT)
+
+
+def _page_url(request, cursor):
+    """ Build a listing url with the current filters and the given cursor """
+    params = request.GET.copy()
+    params['cursor'] = cursor
+    return f'{reverse("products")}?{params.urlencode()}'
 
-    products = Product.objects.all()
+
+def _product_listing(request):
+    """
+    Filter, search and sort the products as the query string asks.
+    Returns the listing's paginator and the filters it used, or None
+    if the search box was submitted empty.
+    """
+
+    products = Product.objects.select_related('category')
     query = None
     categories = None
     sort = None
     direction = None
+    sortkey = 'id'
+    category_names = None
+    search_total = None
 
     if request.GET:
         if 'sort' in request.GET:
@@ -27,38 +60,115 @@ def all_products(request):
                 products = products.annotate(lower_name=Lower('name'))
             if sortkey == 'category':
                 sortkey = 'category__name'
+            if sortkey not in ('price', 'rating', 'lower_name', 'category__name'):
+                sortkey = 'id'
             if 'direction' in request.GET:
                 direction = request.GET['direction']
-                if direction == 'desc':
-                    sortkey = f'-{sortkey}'
-            products = products.order_by(sortkey)
-            
+
         if 'category' in request.GET:
-            categories = request.GET['category'].split(',')
-            products = products.filter(category__name__in=categories)
-            categories = Category.objects.filter(name__in=categories)
+            category_names = request.GET['category'].split(',')
+            products = products.filter(category__name__in=category_names)
+            categories = Category.objects.filter(name__in=category_names)
 
         if 'q' in request.GET:
             query = request.GET['q']
             if not query:
-                messages.error(request, "You didn't enter any search criteria!")
-                return redirect(reverse('products'))
+                return None
             
-            queries = Q(name__icontains=query) | Q(description__icontains=query)
-            products = products.filter(queries)
-
-    current_sorting = f'{sort}_{direction}'
+            # every match is counted, but only the most relevant are fetched
+            matches = search.search(query, categories=category_names)
+            search_total = len(matches)
+            product_ids = matches[:settings.PRODUCTS_SEARCH_RESULTS_LIMIT]
+            products = products.filter(pk__in=product_ids)
+            if sort is None:
+                # rank results by relevance unless the user picked a sort
+                sortkey = 'relevance'
+                products = products.annotate(relevance=Case(
+                    *[When(pk=pk, then=Value(rank)) for rank, pk in enumerate(product_ids)],
+                    default=Value(len(product_ids)),
+                    output_field=IntegerField(),
+                ))
 
-    context = {
+    return {
         'products': products,
-        'search_term': query,
-        'current_categories': categories,
-        'current_sorting': current_sorting,
+        'paginator': KeysetPaginator(
+            products,
+            sortkey=sortkey,
+            descending=direction == 'desc',
+            per_page=settings.PRODUCTS_PER_PAGE,
+        ),
+        'query': query,
+        'categories': categories,
+        'category_names': category_names,
+        'search_total': search_total,
+        'current_sorting': f'{sort}_{direction}',
     }
 
+
+def _total_products(listing):
+    if listing['search_total'] is not None:
+        return listing['search_total']
+    return _count_products(listing['products'], listing['category_names'])
+
+
+def _search_was_empty(request):
+    messages.error(request, "You didn't enter any search criteria!")
+    return redirect(reverse('products'))
+
+
+def _listing_context(request, listing, page, total_products):
+    return {
+        'products': page,
+        'total_products': total_products,
+        # a search only pages through its most relevant matches
+        'results_limit': (
+            settings.PRODUCTS_SEARCH_RESULTS_LIMIT
+            if total_products > settings.PRODUCTS_SEARCH_RESULTS_LIMIT
+            and listing['search_total'] is not None else None),
+        'next_url': _page_url(request, page.next_cursor) if page.has_next else None,
+        'prev_url': _page_url(request, page.prev_cursor) if page.has_previous else None,
+        'search_term': listing['query'],
+        'current_categories': listing['categories'],
+        'current_sorting': listing['current_sorting'],
+    }
+
+
+@catalog_page
+def all_products(request):
+    """ A view to show all products, including sorting and search queries """
+
+    listing = _product_listing(request)
+    if listing is None:
+        return _search_was_empty(request)
+
+    page = listing['paginator'].page(request.GET.get('cursor'))
+    total_products = _total_products(listing)
+    context = _listing_context(request, listing, page, total_products)
+
     return render(request, 'products/products.html', context)
 
 
+@catalog_page
+async def all_products_async(request):
+    """
+    all_products for ASGI: the page of products and the count are
+    fetched at the same time, on separate connections
+    """
+
+    listing = await run_in_thread(_product_listing, request)
+    if listing is None:
+        return _search_was_empty(request)
+
+    page, total_products = await asyncio.gather(
+        run_in_thread(listing['paginator'].page, request.GET.get('cursor')),
+        run_in_thread(_total_products, listing),
+    )
+    context = _listing_context(request, listing, page, total_products)
+
+    return await run_in_thread(render, request, 'products/products.html', context)
+
+
+@catalog_page
 def product_detail(request, product_id):
     """ A view to show individual product details """
 
@@ -71,6 +181,19 @@ def product_detail(request, product_id):
     return render(request, 'products/product_detail.html', context)
 
 
+@catalog_page
+async def product_detail_async(request, product_id):
+    """ product_detail for ASGI """
+
+    product = await run_in_thread(get_object_or_404, Product, pk=product_id)
+
+    context = {
+        'product': product,
+    }
+
+    return await run_in_thread(render, request, 'products/product_detail.html', context)
+
+
 @login_required
 def add_product(request):
     """ Add a product to the store """
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum
+
+from checkout.models import Order
+
+SUMMARY_KEY = 'profiles:order-summary:{}'
+
+
+def order_summary(profile):
+    """
+    The number of orders a profile has placed and their lifetime spend,
+    cached until one of the profile's orders changes
+    """
+    key = SUMMARY_KEY.format(profile.pk)
+    summary = cache.get(key)
+    if summary is None:
+        totals = Order.objects.filter(user_profile=profile).aggregate(
+            count=Count('id'), lifetime_spend=Sum('grand_total'))
+        summary = {
+            'count': totals['count'],
+            'lifetime_spend': totals['lifetime_spend'] or 0,
+        }
+        cache.set(key, summary, settings.PROFILE_SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+
+def invalidate_order_summary(*profile_ids):
+    cache.delete_many([
+        SUMMARY_KEY.format(profile_id) for profile_id in profile_ids if profile_id
+    ])
@@ -0,0 +1,54 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from allauth.account.models import EmailAddress
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Log a burst of users in through the allauth login form and count '
+        'the queries each login makes, in a transaction that is rolled back'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=50)
+
+    # a fast hasher, so the burst measures queries rather than password hashing
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def handle(self, *args, **options):
+        logins = options['logins']
+        try:
+            with transaction.atomic():
+                users = []
+                for i in range(logins):
+                    user = User.objects.create_user(
+                        f'benchmark{i}', f'benchmark{i}@example.com', 'password')
+                    EmailAddress.objects.create(
+                        user=user, email=user.email, verified=True, primary=True)
+                    users.append(user)
+
+                with CaptureQueriesContext(connection) as queries:
+                    for user in users:
+                        client = Client(HTTP_HOST='localhost')
+                        client.post('/accounts/login/', {
+                            'login': user.username,
+                            'password': 'password',
+                        })
+                raise Rollback
+        except Rollback:
+            pass
+
+        profile_queries = [
+            query for query in queries.captured_queries
+            if 'profiles_userprofile' in query['sql']
+        ]
+        self.stdout.write(
+            f'{logins} logins: {len(queries) / logins:.2f} queries/login, '
+            f'{len(profile_queries) / logins:.2f} profile queries/login')
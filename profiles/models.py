@@ -28,16 +28,19 @@ class UserProfile(models.Model):
 
 
 @receiver(post_save, sender=User)
-def create_or_update_user_profile(sender, instance, created, **kwargs):  #  each time a user object is saved. We'll automatically either create a
-# profile for them if the user has just been created.
-# Or just save the profile to update it if the user already existed.
+def create_or_update_user_profile(sender, instance, created, update_fields=None, **kwargs):  #  each time a user object is saved. We'll automatically
+# create a profile for them if the user has just been created.
     """
-    Create or update the user profile
+    Create the user profile, if the user doesn't have one yet
     """
     if created:
         UserProfile.objects.create(user=instance)
-    # Existing users: just save the profile
-    instance.userprofile.save()
-
-    # since there's only one signal I'm not putting it in a separate signals.py module
-    # like we did for the ones on the order model.
+        return
+    # Nothing on the profile comes from the user, so there's nothing to update.
+    # Saves of a few fields, like the last_login update on every login,
+    # come from users who already have a profile, so skip the lookup.
+    if update_fields is not None:
+        return
+    # Existing users saved in full, e.g. from the admin: make sure they
+    # have a profile in case they were created without one
+    UserProfile.objects.get_or_create(user=instance)
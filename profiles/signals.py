@@ -0,0 +1,31 @@
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from checkout.models import Order
+from .caching import invalidate_order_summary
+
+
+@receiver(post_init, sender=Order)
+def remember_order_profile(sender, instance, **kwargs):
+    """
+    Note which profile an order belonged to when loaded, so moving it
+    to another profile updates both profiles' summaries
+    """
+    instance._loaded_user_profile_id = instance.__dict__.get('user_profile_id')
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, **kwargs):
+    """
+    Update the order summary of the profile the order belongs to
+    """
+    invalidate_order_summary(instance.user_profile_id, instance._loaded_user_profile_id)
+    instance._loaded_user_profile_id = instance.user_profile_id
+
+
+@receiver(post_delete, sender=Order)
+def order_deleted(sender, instance, **kwargs):
+    """
+    Update the order summary of the profile the order belonged to
+    """
+    invalidate_order_summary(instance.user_profile_id)
@@ -1,3 +1,102 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.urls import reverse
+
+from boutique_ado.testing import QueryBudgetTestCase
+from checkout.models import Order, OrderLineItem
+from products.models import Category, Product
+from .caching import order_summary
+from .models import UserProfile
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class OrderHistoryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+        category = Category.objects.create(name='shirts', friendly_name='Shirts')
+        cls.product = Product.objects.create(
+            category=category, name='Shirt', description='A shirt', price=Decimal('10.00'))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _add_orders(self, count):
+        for i in range(count):
+            order = Order.objects.create(
+                user_profile=self.user.userprofile, full_name='Shopper',
+                email='shopper@example.com', phone_number='123', country='IE',
+                town_or_city='Dublin', street_address1='1 Main St')
+            OrderLineItem.objects.create(order=order, product=self.product, quantity=2)
+
+    def _profile_queries(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('profile'), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_queries_do_not_grow_with_orders(self):
+        self._add_orders(2)
+        response, few = self._profile_queries()
+        self.assertEqual(len(response.context['orders']), 2)
+
+        self._add_orders(20)
+        response, many = self._profile_queries(page=2)
+        self.assertEqual(len(response.context['orders']), 10)
+        self.assertEqual(few, many)
+
+    def test_summary_is_cached_and_updated(self):
+        self._add_orders(2)
+        profile = self.user.userprofile
+        self.assertEqual(order_summary(profile)['count'], 2)
+        with self.assertNumQueries(0):
+            summary = order_summary(profile)
+        self.assertEqual(summary['lifetime_spend'], 44)
+
+        self._add_orders(1)
+        self.assertEqual(order_summary(profile)['count'], 3)
+        Order.objects.first().delete()
+        self.assertEqual(order_summary(profile)['count'], 2)
+
+
+class ProfileSyncTests(TestCase):
+
+    def test_logins_do_not_touch_profiles(self):
+        users = [User.objects.create_user(f'shopper{i}', password='password') for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            for user in users:
+                self.client.force_login(user)
+        self.assertEqual(
+            [query['sql'] for query in queries if 'profiles_userprofile' in query['sql']], [])
+
+    def test_full_save_creates_missing_profile(self):
+        user = User.objects.create_user('shopper', password='password')
+        UserProfile.objects.filter(user=user).delete()
+        User.objects.get(pk=user.pk).save()
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
+
+
+class ProfileQueryBudgetTests(QueryBudgetTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.login()
+
+    def test_profile(self):
+        self.assertQueryBudget(6, reverse('profile'), status=200)
+        self.assertQueryBudget(5, reverse('profile'), {'page': 3}, status=200)
+
+    def test_update_profile(self):
+        self.assertQueryBudget(7, reverse('profile'), {
+            'default_phone_number': '0123456789', 'default_country': 'IE',
+            'default_town_or_city': 'Dublin', 'default_street_address1': '1 Main Street',
+        }, method='post', status=200)
+
+    def test_order_history(self):
+        order = self.orders[0]
+        self.assertQueryBudget(3, reverse('order_history', args=[order.order_number]), status=200)
@@ -1,8 +1,11 @@
 from django.shortcuts import render, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
+from django.conf import settings
 from .models import UserProfile
 from .forms import UserProfileForm
+from .caching import order_summary
 
 from checkout.models import Order
 
@@ -26,12 +29,17 @@ def profile(request):
             messages.error(request, 'Update failed. Please ensure the form is valid.')
     else:
         form = UserProfileForm(instance=profile)
-    orders = profile.orders.all()
+
+    # One page of orders, with all their line items and products fetched
+    # in two more queries rather than two per order
+    orders = profile.orders.lean().order_by('-date').with_lineitems()
+    orders_page = Paginator(orders, settings.PROFILE_ORDERS_PER_PAGE).get_page(request.GET.get('page'))
 
     template = 'profiles/profile.html'
     context = {
         'form': form,
-        'orders': orders,
+        'orders': orders_page,
+        'order_summary': order_summary(profile),
         'on_profile_page': True
     }
 
@@ -39,7 +47,7 @@ def profile(request):
 
 
 def order_history(request, order_number):
-    order = get_object_or_404(Order, order_number=order_number)
+    order = get_object_or_404(Order.objects.lean().with_lineitems(), order_number=order_number)
 
     messages.info(request, (  # message letting the user know they're looking at a past order confirmation.
         f'This is a past confirmation for order number {order_number}. '